@@ -8,4 +8,8 @@ __email__ = '37776145+Fledermann@users.noreply.github.com'
 __status__ = 'Prototype'
 
 from paletti.main import get_plugins_from_repo
+from paletti.manager import DownloadManager
 from paletti.web_api import download, play, metadata, search, streams
+from paletti.web_api import configure_cache, configure_postprocessing
+from paletti.web_api import limit_bandwidth, metadata_many, search_iter
+from paletti.web_api import download_async, metadata_async, streams_async
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+
+""" The AsyncDownload class, an asyncio counterpart of `downloader.Download`.
+All transfers use non-blocking sockets, so one event loop can drive a large
+number of downloads at the same time.
+"""
+
+import asyncio
+import ssl
+import urllib.parse
+import weakref
+
+import session
+import throttle
+from downloader import (Download, OutputFile, check_range_response, known_sizes,
+                        segment_ranges)
+
+
+class Response:
+    """ A minimal HTTP/1.1 response.
+
+    :param asyncio.StreamReader reader: the reader of the connection.
+    :param int status: the status code.
+    :param dict headers: the response headers with lowercase names.
+    :param bool body: whether the response has a body.
+    :param float timeout: the maximum time in seconds to wait for data.
+    """
+    def __init__(self, reader, status, headers, body=True, timeout=None):
+        self.reader = reader
+        self.status = status
+        self.headers = headers
+        self.timeout = timeout
+        self.complete = not body
+        self._chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        self._remaining = int(headers.get('content-length', -1)) if body else 0
+
+    def __repr__(self):
+        return f'<Response: {self.status}>'
+
+    async def _read(self, n):
+        return await asyncio.wait_for(self.reader.read(n), self.timeout)
+
+    async def _readline(self):
+        return await asyncio.wait_for(self.reader.readline(), self.timeout)
+
+    async def read(self):
+        """ Read the whole body.
+
+        :rtype: bytes
+        """
+        return b''.join([chunk async for chunk in self.stream(131_072)])
+
+    async def stream(self, chunk_size):
+        """ Iterate over the body in pieces of up to `chunk_size` bytes.
+
+        :param int chunk_size: the maximum length of a piece.
+        :rtype: async iterator(bytes)
+        """
+        if self._chunked:
+            while True:
+                size = int((await self._readline()).split(b';')[0], 16)
+                if not size:
+                    await self._readline()
+                    break
+                while size:
+                    data = await self._read(min(chunk_size, size))
+                    if not data:
+                        raise ConnectionError('Connection closed during transfer.')
+                    size -= len(data)
+                    yield data
+                await self._readline()
+        elif self._remaining >= 0:
+            while self._remaining:
+                data = await self._read(min(chunk_size, self._remaining))
+                if not data:
+                    raise ConnectionError('Connection closed during transfer.')
+                self._remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await self._read(chunk_size)
+                if not data:
+                    break
+                yield data
+            return
+        self.complete = True
+
+
+class ConnectionPool:
+    """ Keeps idle keep-alive connections per host for reuse. A pool belongs
+    to one event loop, use `get_pool` to get the one of the running loop.
+
+    :param int maxsize: the maximum number of idle connections per host.
+    :param float timeout: the maximum time in seconds to wait for a
+                          connection or for data, like the timeout of the
+                          `session`. Default: the `session` setting.
+    """
+    def __init__(self, maxsize=10, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._ssl = None
+
+    def __repr__(self):
+        return f'<ConnectionPool: {sum(len(c) for c in self._idle.values())} idle>'
+
+    async def _connect(self, scheme, host, port, timeout):
+        if scheme == 'https' and self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        return await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=self._ssl if scheme == 'https' else None), timeout)
+
+    async def request(self, method, url, headers=None, redirects=5):
+        """ Send a request and read the response head. The body has to be
+        consumed (or the response passed to `release`) before the connection
+        can be used again.
+
+        :param str method: the HTTP method.
+        :param str url: the url.
+        :param dict headers: additional request headers.
+        :param int redirects: the maximum number of redirects to follow.
+        :return: the response, with the connection key and writer attached.
+        :rtype: Response
+        :raises asyncio.TimeoutError: if the server doesn't answer within the
+                                      timeout.
+        """
+        timeout = self.timeout if self.timeout is not None \
+            else session.settings()['timeout']
+        parsed = urllib.parse.urlsplit(url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        target = parsed.path or '/'
+        if parsed.query:
+            target += f'?{parsed.query}'
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {parsed.netloc}',
+                 'User-Agent: paletti', 'Accept-Encoding: identity']
+        lines += [f'{k}: {v}' for k, v in (headers or {}).items()]
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        idle = self._idle.get(key, [])
+        while True:
+            # Idle connections may have been closed by the server in the
+            # meantime, so only an error on a new connection is raised.
+            reused = bool(idle)
+            reader, writer = idle.pop() if reused else await self._connect(*key, timeout)
+            try:
+                writer.write(head)
+                await asyncio.wait_for(writer.drain(), timeout)
+                status_line = await asyncio.wait_for(reader.readline(), timeout)
+                if not status_line:
+                    raise ConnectionError('Connection closed by the server.')
+                break
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                writer.close()
+                if not reused:
+                    raise
+        status = int(status_line.split()[1])
+        response_headers = {}
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                line = line.decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            writer.close()
+            raise
+        body = method != 'HEAD' and status not in (204, 304) and status >= 200
+        response = Response(reader, status, response_headers, body, timeout)
+        response.key, response.writer = key, writer
+        if status in (301, 302, 303, 307, 308) and redirects:
+            await response.read()
+            self.release(response)
+            location = urllib.parse.urljoin(url, response_headers['location'])
+            return await self.request(method, location, headers, redirects - 1)
+        return response
+
+    def release(self, response):
+        """ Return the connection of a response to the pool, or close it if
+        the body was not read completely.
+
+        :param Response response: the response.
+        :return: None
+        """
+        idle = self._idle.setdefault(response.key, [])
+        keep_alive = response.headers.get('connection', '').lower() != 'close'
+        if response.complete and keep_alive and len(idle) < self.maxsize:
+            idle.append((response.reader, response.writer))
+        else:
+            response.writer.close()
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_pool():
+    """ Get the connection pool of the running event loop.
+
+    :rtype: ConnectionPool
+    """
+    loop = asyncio.get_event_loop()
+    if loop not in _pools:
+        _pools[loop] = ConnectionPool()
+    return _pools[loop]
+
+
+class AsyncDownload(Download):
+    """ A download which runs in an asyncio event loop. It has the same
+    attributes (`status`, `progress`, `filesize`, ...), journal and
+    `cancel`/`pause` behavior as `downloader.Download`, but transfers which
+    are waiting for data stop at once. Every wait for the server ends after
+    the timeout of the `session`. The filesize is
+    unknown until `analyze` has been awaited; `web_api.download_async` does
+    that already.
+
+    :param list(dict) streams: the audio and video stream dicts.
+    :param str output: the local file path where the fill will be saved.
+    :param callable postprocessing: called with the output path and the
+                                    stream files once all streams are
+                                    finished. It runs in the default
+                                    executor.
+    :param int segments: the number of byte ranges per stream which are
+                         fetched at the same time.
+    :param list(int) sizes: the known sizes of the streams.
+    :param str output_mode: how the data is written, see
+                            `downloader.OutputFile`. Writes run in the
+                            default executor. Default: 'pwrite'.
+    """
+    def __init__(self, streams, output, postprocessing, segments=1, sizes=None,
+                 output_mode='pwrite'):
+        self.task = None
+        self._loop = None
+        self._transfers = None
+        super().__init__(streams, output, postprocessing, segments, sizes,
+                         output_mode)
+
+    def __repr__(self):
+        return super().__repr__().replace('<Download', '<AsyncDownload', 1)
+
+    def _analyze(self, sizes=None):
+        self.sizes = known_sizes(self.streams, sizes)
+        return sum(self.sizes) if None not in self.sizes else 0
+
+    def _stop_transfers(self):
+        # Transfers which are waiting for data stop at once, not only after
+        # their next chunk.
+        if self._transfers is not None and not self._transfers.done():
+            self._loop.call_soon_threadsafe(self._transfers.cancel)
+
+    async def _probe(self, url):
+        pool = get_pool()
+        response = await pool.request('HEAD', url)
+        pool.release(response)
+        if response.status == 200 and 'content-length' in response.headers:
+            return int(response.headers['content-length'])
+        response = await pool.request('GET', url, {'Range': 'bytes=0-0'})
+        # Only the head is needed. The body is not read, in case the server
+        # ignores the range, so `release` closes the connection.
+        pool.release(response)
+        if response.status not in (200, 206):
+            raise ConnectionError(f'Could not fetch {url}: {response.status}')
+        if 'content-range' in response.headers:
+            return int(response.headers['content-range'].rsplit('/', 1)[1])
+        return int(response.headers['content-length'])
+
+    async def _fetch_range(self, stream, output, start, end):
+        dash_chunk_size = 10_485_760
+        dl_chunk_size = 131_072
+        dash_params = {'key': 'range', 'format': '-'}
+        filepath = self._filepath(stream)
+        index = self.streams.index(stream)
+        loop = asyncio.get_event_loop()
+        pool = get_pool()
+        host = urllib.parse.urlsplit(stream['url']).hostname
+        chunk_start = start
+        while chunk_start <= end:
+            chunk_end = min(chunk_start + dash_chunk_size - 1, end)
+            dash_url = f'{stream["url"]}&{dash_params["key"]}={chunk_start}' \
+                       f'{dash_params["format"]}{chunk_end}'
+            response = await pool.request('GET', dash_url)
+            try:
+                check_range_response(dash_url, response.status,
+                                     response.headers.get('content-length'),
+                                     chunk_start, chunk_end)
+            except ConnectionError:
+                response.writer.close()
+                raise
+            expected = chunk_end - chunk_start + 1
+            written = 0
+            write = None
+            try:
+                async for chunk in response.stream(dl_chunk_size):
+                    if self.status != 'active':
+                        return False
+                    chunk = chunk[:expected - written]
+                    write = loop.run_in_executor(None, output.write,
+                                                 chunk_start + written, chunk)
+                    await asyncio.shield(write)
+                    written += len(chunk)
+                    self._count(index, len(chunk))
+                    wait = throttle.delay(host, len(chunk))
+                    if wait:
+                        await asyncio.sleep(wait)
+                    if written == expected:
+                        break
+            finally:
+                pool.release(response)
+                if write is not None:
+                    # A stopped transfer doesn't cancel the running write;
+                    # the file is flushed and closed only after it.
+                    await asyncio.wait([write])
+                output.flush()
+                # Only the data of a checked response is recorded.
+                await loop.run_in_executor(None, self._journal.add, filepath,
+                                           chunk_start, chunk_start + written - 1)
+            if not written:
+                raise ConnectionError(f'No data received for {dash_url}.')
+            chunk_start += written
+        return True
+
+    async def analyze(self):
+        """ Probe the unknown sizes of all streams at the same time.
+
+        :returns: the filesize in bytes.
+        :rtype: int
+        """
+        unknown = [i for i, size in enumerate(self.sizes) if size is None]
+        sizes = await asyncio.gather(*[self._probe(self.streams[i]['url'])
+                                       for i in unknown])
+        for i, size in zip(unknown, sizes):
+            self.sizes[i] = size
+        self.filesize = sum(self.sizes)
+        return self.filesize
+
+    async def download_file(self, stream):
+        """ Download a single stream.
+
+        :param dict stream: the stream dict.
+        :return: True if the stream is complete, False if the download was
+                 stopped before.
+        :rtype: bool
+        """
+        if not stream:
+            return None
+        loop = asyncio.get_event_loop()
+        missing = await loop.run_in_executor(None, self._prepare, stream,
+                                             self.segments > 1)
+        size = self.sizes[self.streams.index(stream)]
+        ranges = [(max(start, m_start), min(end, m_end))
+                  for start, end in segment_ranges(size, self.segments)
+                  for m_start, m_end in missing
+                  if m_start <= end and m_end >= start]
+        output = OutputFile(self._filepath(stream), size, self.output_mode)
+        try:
+            results = await asyncio.gather(
+                *[self._fetch_range(stream, output, start, end) for start, end in ranges])
+        finally:
+            output.close()
+        completed = all(results)
+        if completed:
+            await loop.run_in_executor(None, self.stream_finished, stream)
+        return completed
+
+    async def _run(self):
+        if None in self.sizes:
+            await self.analyze()
+        if self.status != 'active':
+            return
+        self._loop = asyncio.get_event_loop()
+        self._transfers = asyncio.gather(*[self.download_file(s) for s in self.streams])
+        try:
+            await self._transfers
+        except asyncio.CancelledError:
+            # Stopped by `cancel` or `pause`, unless the task itself was
+            # cancelled.
+            if self.status == 'active':
+                raise
+        except Exception as e:
+            self.fail(e)
+            raise
+
+    def cancel(self):
+        super().cancel()
+        self._stop_transfers()
+
+    def events(self):
+        """ Subscribe to all events of the download (see
+        `downloader.Download.subscribe`) through an asyncio queue. Iterating
+        over the result with `async for` yields the events until the download
+        is finished, failed or cancelled. Call it before `start()` to receive
+        every event.
+
+        :return: an async generator of events.
+        """
+        loop = asyncio.get_event_loop()
+        events = asyncio.Queue()
+
+        def callback(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        self.subscribe(callback)
+
+        async def iterate():
+            try:
+                while True:
+                    event = await events.get()
+                    yield event
+                    if event['event'] in ('finished', 'failed', 'cancelled'):
+                        return
+            finally:
+                self.unsubscribe(callback)
+
+        return iterate()
+
+    def pause(self):
+        super().pause()
+        self._stop_transfers()
+
+    async def run(self):
+        """ Download all streams and wait for them to finish.
+
+        :return: None
+        """
+        self.activate()
+        await self._run()
+
+    def start(self):
+        """ Schedule the download in the running event loop.
+
+        :return: the task, which can be awaited.
+        :rtype: asyncio.Task
+        """
+        self.activate()
+        self.task = asyncio.ensure_future(self._run())
+        return self.task
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+""" Caches for the results of plugin lookups, see `web_api.cache`. Results
+are kept in memory, and optionally in a database which is shared by all
+processes (see `configure`).
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+MISSING = object()
+
+
+class LRUCache:
+    """ A thread-safe in-memory cache with a maximum size and an expiry time
+    for every entry. If the cache is full, the least recently used entry is
+    evicted.
+
+    :param int maxsize: the maximum number of entries.
+    :param float ttl: the default time to live of an entry in seconds, or
+                      None if entries never expire.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def __contains__(self, key):
+        return self.get(key, MISSING, count=False) is not MISSING
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f'<LRUCache: {len(self)}/{self.maxsize} entries>'
+
+    def clear(self):
+        """ Remove all entries.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def delete(self, key):
+        """ Remove an entry, if it exists.
+
+        :param key: the key.
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get(self, key, default=None, count=True):
+        """ Look up an entry.
+
+        :param key: the key.
+        :param default: the value returned if there is no valid entry.
+        :param bool count: whether the lookup is counted in the statistics.
+        :return: the value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None \
+                    and entry[1] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+                self._stats['expired'] += 1
+            if entry is None:
+                if count:
+                    self._stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            if count:
+                self._stats['hits'] += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=MISSING):
+        """ Add or replace an entry.
+
+        :param key: the key.
+        :param value: the value.
+        :param float ttl: the time to live in seconds. Default: the `ttl` of
+                          the cache.
+        :return: None
+        """
+        ttl = self.ttl if ttl is MISSING else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        """ The statistics of the cache.
+
+        :return: the number of `hits`, `misses`, `evictions` and `expired`
+                 entries since the cache was created, and the current `size`
+                 and `maxsize`.
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._stats, size=len(self._entries),
+                        maxsize=self.maxsize)
+
+
+class SQLiteCache:
+    """ A persistent cache in an SQLite database, which can be shared by
+    several threads and processes. Entries expire like in `LRUCache`; the
+    least recently used entries beyond `maxsize` are removed every
+    `prune_interval` writes, so the size may exceed `maxsize` in between.
+    Values have to be picklable.
+
+    :param str path: the path of the database file.
+    :param int maxsize: the maximum number of entries.
+    :param float ttl: the default time to live of an entry in seconds, or
+                      None if entries never expire.
+    """
+    prune_interval = 64
+
+    def __init__(self, path, maxsize=65536, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+        db = self._connect()
+        db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                   'value BLOB, expires REAL, accessed REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+    def __contains__(self, key):
+        return self.lookup(key, count=False) is not MISSING
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def __repr__(self):
+        return f'<SQLiteCache: {self.path}>'
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    @staticmethod
+    def _key(key):
+        return key if isinstance(key, str) else repr(key)
+
+    def clear(self):
+        """ Remove all entries.
+
+        :return: None
+        """
+        self._connect().execute('DELETE FROM cache')
+
+    def delete(self, key):
+        """ Remove an entry, if it exists.
+
+        :param key: the key.
+        :return: None
+        """
+        self._connect().execute('DELETE FROM cache WHERE key = ?', (self._key(key),))
+
+    def get(self, key, default=None, count=True):
+        """ Look up an entry.
+
+        :param key: the key. Keys which aren't strings are stored as their
+                    `repr`.
+        :param default: the value returned if there is no valid entry.
+        :param bool count: whether the lookup is counted in the statistics.
+        :return: the value.
+        """
+        entry = self.lookup(key, count)
+        return default if entry is MISSING else entry[0]
+
+    def lookup(self, key, count=True):
+        """ Look up an entry and its remaining time to live.
+
+        :param key: the key.
+        :param bool count: whether the lookup is counted in the statistics.
+        :return: the value and the time to live in seconds (or None), or
+                 `MISSING` if there is no valid entry.
+        :rtype: tuple
+        """
+        db = self._connect()
+        key = self._key(key)
+        now = time.time()
+        row = db.execute('SELECT value, expires FROM cache WHERE key = ?',
+                         (key,)).fetchone()
+        if row is not None and row[1] is not None and row[1] <= now:
+            db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._count('expired')
+            row = None
+        if row is None:
+            if count:
+                self._count('misses')
+            return MISSING
+        db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        if count:
+            self._count('hits')
+        return pickle.loads(row[0]), None if row[1] is None else row[1] - now
+
+    def prune(self):
+        """ Remove all expired entries and the least recently used entries
+        beyond `maxsize`.
+
+        :return: None
+        """
+        db = self._connect()
+        expired = db.execute('DELETE FROM cache WHERE expires <= ?',
+                             (time.time(),)).rowcount
+        evicted = db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM '
+                             'cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                             (self.maxsize,)).rowcount
+        self._count('expired', expired)
+        self._count('evictions', evicted)
+
+    def set(self, key, value, ttl=MISSING):
+        """ Add or replace an entry.
+
+        :param key: the key.
+        :param value: the value.
+        :param float ttl: the time to live in seconds. Default: the `ttl` of
+                          the cache.
+        :return: None
+        """
+        ttl = self.ttl if ttl is MISSING else ttl
+        now = time.time()
+        self._connect().execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+            (self._key(key), pickle.dumps(value),
+             now + ttl if ttl is not None else None, now))
+        with self._lock:
+            self._writes += 1
+            prune = not self._writes % self.prune_interval
+        if prune:
+            self.prune()
+
+    def stats(self):
+        """ The statistics of the cache. The counters only cover the lookups
+        of this process.
+
+        :return: the number of `hits`, `misses`, `evictions` and `expired`
+                 entries, and the current `size` and `maxsize`.
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        return dict(stats, size=len(self), maxsize=self.maxsize)
+
+
+class SingleFlight:
+    """ Deduplicates concurrent calls: while a call for a key is running,
+    further calls for the same key wait for it and get its result (or its
+    exception) instead of running again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+
+    def __repr__(self):
+        return f'<SingleFlight: {len(self._calls) + len(self._tasks)} in flight>'
+
+    def do(self, key, func, *args, **kwargs):
+        """ Call `func(*args, **kwargs)`, unless a call for `key` is already
+        running in another thread.
+
+        :param key: the key.
+        :param callable func: the function.
+        :return: the result of the function.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = concurrent.futures.Future()
+                self._calls[key] = call
+        if not leader:
+            return call.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def do_async(self, key, factory):
+        """ Await the awaitable returned by `factory()`, unless one for `key`
+        is already running in the same event loop. Cancelling one caller
+        doesn't cancel the call for the others.
+
+        :param key: the key.
+        :param callable factory: returns the awaitable.
+        :return: the result of the awaitable.
+        """
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get((loop, key))
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[(loop, key)] = task
+            task.add_done_callback(lambda _: self._tasks.pop((loop, key), None))
+        return await asyncio.shield(task)
+
+
+_config = {'directory': None, 'maxsize': 65536}
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def configure(**options):
+    """ Change the settings of the persistent cache.
+
+    :keyword str directory: the directory of the cache database, or None to
+                            cache in memory only.
+    :keyword int maxsize: the maximum number of entries in the database.
+    :return: the new settings.
+    :rtype: dict
+    """
+    global _backend
+    unknown = set(options) - set(_config)
+    if unknown:
+        raise TypeError(f'Unknown cache options: {", ".join(sorted(unknown))}')
+    with _backend_lock:
+        _config.update(options)
+        _backend = None
+    return dict(_config)
+
+
+def get_backend():
+    """ Get the persistent cache, if a directory is configured.
+
+    :rtype: SQLiteCache
+    """
+    global _backend
+    if _config['directory'] is None:
+        return None
+    with _backend_lock:
+        if _backend is None:
+            os.makedirs(_config['directory'], exist_ok=True)
+            path = os.path.join(_config['directory'], 'cache.sqlite')
+            _backend = SQLiteCache(path, _config['maxsize'])
+        return _backend
@@ -3,10 +3,280 @@
 """ The Download class.
 """
 
-import sys
+import collections
+import concurrent.futures
+import mmap
+import os
+import queue
 import threading
+import time
+
 import urllib3
 
+import session
+import throttle
+from journal import get_journal
+from postprocessing import StreamingMux, can_mux
+
+
+def probe_size(url):
+    """ Find the size of a remote file without downloading it. A HEAD
+    request is tried first; if the server does not answer it properly, a
+    GET request for the first byte is sent and the size is read from the
+    `Content-Range` header, without reading the body.
+
+    :param str url: the url.
+    :return: the size in bytes.
+    :rtype: int
+    :raises ConnectionError: if the server answers with an error status.
+    """
+    response = session.request('HEAD', url)
+    if response.status == 200 and 'Content-Length' in response.headers:
+        return int(response.headers['Content-Length'])
+    response = session.request('GET', url, headers={'Range': 'bytes=0-0'},
+                               preload_content=False)
+    # Only the headers are needed. A server which ignores the range sends the
+    # whole stream, so the connection is closed instead of read to the end.
+    response.close()
+    response.release_conn()
+    if response.status not in (200, 206):
+        raise ConnectionError(f'Could not fetch {url}: {response.status}')
+    if 'Content-Range' in response.headers:
+        return int(response.headers['Content-Range'].rsplit('/', 1)[1])
+    return int(response.headers['Content-Length'])
+
+
+def check_range_response(url, status, length, start, end):
+    """ Make sure that the response to a request for the bytes `start` to
+    `end` of a stream contains them. The servers answer the `range=` url
+    parameter with 206 or with 200 and just the requested bytes. A 200 with
+    more than that is only accepted from the first byte on, where the rest
+    is cut off; elsewhere the server has ignored the range.
+
+    :param str url: the requested url.
+    :param int status: the status code of the response.
+    :param int length: the `Content-Length` of the response, or None.
+    :param int start: the first requested byte.
+    :param int end: the last requested byte.
+    :return: None
+    :raises ConnectionError: if the response doesn't contain the range.
+    """
+    if status == 206:
+        return
+    if status != 200:
+        raise ConnectionError(f'Could not fetch {url}: {status}')
+    if start and (length is None or int(length) > end - start + 1):
+        raise ConnectionError(f'The server ignored the range of {url}.')
+
+
+def known_sizes(streams, sizes=None):
+    """ Combine the given sizes with the `filesize` keys of the streams.
+
+    :param list(dict) streams: the stream dicts.
+    :param list(int) sizes: the known sizes, or None.
+    :return: the sizes; 0 for a skipped stream, None if it is unknown.
+    :rtype: list(int)
+    """
+    sizes = sizes or [None] * len(streams)
+    return [0 if not stream else size if size is not None else stream.get('filesize')
+            for stream, size in zip(streams, sizes)]
+
+
+def stream_path(output, stream):
+    """ The path of the file of a stream.
+
+    :param str output: the base path of the download.
+    :param dict stream: the stream dict.
+    :return: `{output}.{container}.{type}.{codec}`
+    :rtype: str
+    """
+    return f'{output}.{stream["container"]}.{stream["type"]}.{stream["codec"]}'
+
+
+def preallocate_file(f, size):
+    """ Extend a file to its final size. Where possible, the disk space is
+    actually reserved, which keeps the file from fragmenting.
+
+    :param file f: the file object, opened for writing.
+    :param int size: the size in bytes.
+    :return: None
+    """
+    f.truncate(size)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            # Not supported by the filesystem, the sparse file will do.
+            pass
+
+
+def segment_ranges(size, segments):
+    """ Split a file of `size` bytes into byte ranges of roughly equal length.
+
+    :param int size: the filesize in bytes.
+    :param int segments: the number of ranges.
+    :return: the inclusive (start, end) byte positions of each range.
+    :rtype: list(tuple(int, int))
+    """
+    segments = max(1, min(segments, size))
+    length, rest = divmod(size, segments)
+    ranges = []
+    start = 0
+    for i in range(segments):
+        end = start + length + (1 if i < rest else 0) - 1
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
+def sequential_ranges(missing, head_size, piece_size):
+    """ Split the missing byte ranges of a stream into pieces for the
+    sequential strategy: the part before `head_size` in one piece, the rest
+    in pieces of `piece_size` bytes, in order.
+
+    :param list(tuple(int, int)) missing: the missing ranges, in order.
+    :param int head_size: the size of the beginning.
+    :param int piece_size: the size of the other pieces.
+    :return: the inclusive (start, end) byte positions of each piece.
+    :rtype: list(tuple(int, int))
+    """
+    pieces = []
+    for start, end in missing:
+        while start <= end:
+            limit = head_size if start < head_size else start + piece_size
+            pieces.append((start, min(end, limit - 1)))
+            start = pieces[-1][1] + 1
+    return pieces
+
+
+class OutputFile:
+    """ A stream file which stays open for the whole download and is written
+    at arbitrary offsets, so segments may complete in any order.
+
+    :param str path: the file path. The file must exist.
+    :param int size: the final size of the file.
+    :param str mode: 'file' writes through a buffered file object, 'pwrite'
+                     with `os.pwrite` (or seek and write where it is not
+                     available) and 'mmap' into a memory map of the file.
+                     The last two need a preallocated file.
+    """
+    modes = ('file', 'pwrite', 'mmap')
+    # The completed ranges are recorded in the journal.
+    resumable = True
+
+    def __init__(self, path, size, mode='file'):
+        if mode not in self.modes:
+            raise ValueError(f'Unknown output mode {mode}, use one of {self.modes}.')
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._map = None
+        self._file = open(path, 'r+b', buffering=-1 if mode == 'file' else 0)
+        if mode == 'mmap' and size:
+            if os.fstat(self._file.fileno()).st_size < size:
+                preallocate_file(self._file, size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+
+    def __repr__(self):
+        return f'<OutputFile: {self.path} ({self.mode})>'
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+        self._file.close()
+
+    def flush(self):
+        """ Hand buffered data to the operating system. """
+        if self.mode == 'file':
+            with self._lock:
+                self._file.flush()
+
+    def read(self, offset, size):
+        """ Read up to `size` bytes at `offset`. This works through the open
+        file, even after the path was removed.
+
+        :param int offset: the position in the file.
+        :param int size: the number of bytes.
+        :rtype: bytes
+        """
+        if self._map is not None:
+            return self._map[offset:offset + size]
+        if self.mode != 'file' and hasattr(os, 'pread'):
+            return os.pread(self._file.fileno(), size, offset)
+        with self._lock:
+            self._file.flush()
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def write(self, offset, data):
+        """ Write `data` at `offset`.
+
+        :param int offset: the position in the file.
+        :param bytes data: the data.
+        :return: None
+        """
+        if self._map is not None:
+            self._map[offset:offset + len(data)] = data
+        elif self.mode != 'file' and hasattr(os, 'pwrite'):
+            os.pwrite(self._file.fileno(), data, offset)
+        else:
+            with self._lock:
+                self._file.seek(offset)
+                self._file.write(data)
+
+
+class PipeOutput:
+    """ The input pipe of a stream in a `postprocessing.StreamingMux`. It has
+    the interface of `OutputFile`, but the data has to be written in order
+    from the first byte on, and an interrupted stream can't be resumed.
+
+    :param StreamingMux mux: the mux.
+    :param int index: the index of the stream.
+    """
+    resumable = False
+
+    def __init__(self, mux, index):
+        self.mux = mux
+        self.index = index
+        self._position = 0
+        self._fd = mux.open_input(index)
+
+    def __repr__(self):
+        return f'<PipeOutput: {self.index} of {self.mux}>'
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def flush(self):
+        """ Pipes are not buffered. """
+
+    def write(self, offset, data):
+        """ Write `data`, which has to start at the current position.
+
+        :param int offset: the position in the stream.
+        :param bytes data: the data.
+        :return: None
+        :raises subprocess.CalledProcessError: if ffmpeg has failed.
+        """
+        if offset != self._position:
+            raise ValueError(f'Pipes are written in order, expected offset '
+                             f'{self._position}, got {offset}.')
+        if self._fd is None:
+            return
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(self._fd, view):]
+        except BrokenPipeError:
+            if self.mux.aborted:
+                return
+            self.mux.check()
+            raise
+        self._position += len(data)
+
 
 class Download:
     """ A download class specifically for downloading videos.
@@ -15,76 +285,598 @@ class Download:
                                audio stream dicts. If one of these is not
                                provided, the stream will be skipped.
     :param str output: the local file path where the fill will be saved.
+    :param callable postprocessing: called with the output path and the
+                                    stream files as (path, container, type,
+                                    codec) tuples (`files` keyword) once all
+                                    streams are finished.
+    :param int segments: the number of byte ranges each stream is split
+                         into and fetched in parallel. Default: 1, i.e.
+                         one connection per stream.
+    :param list(int) sizes: the sizes of the streams, if they are known
+                            already. Streams without a size (or with None)
+                            use the size in the journal, if it was recorded
+                            for the same url, or the `filesize` key of the
+                            stream dict, if the plugin provides one, or are
+                            probed.
+    :param str output_mode: how the data is written, see `OutputFile`.
+                            'pwrite' and 'mmap' preallocate the files.
+    :param str strategy: the order in which the bytes are fetched.
+                         'parallel' fetches `segments` equal parts of each
+                         stream at the same time, for the best throughput.
+                         'sequential' fetches the first `head_size` bytes of
+                         all streams first and then continues from start to
+                         end, with up to `segments` pieces in flight, so the
+                         download becomes playable early (see `playable`).
+    :param bool mux: remux the streams into the final file while they are
+                     downloaded, without writing stream files (see
+                     `postprocessing.StreamingMux`). The postprocessing then
+                     gets the final file as `result` keyword. This needs
+                     containers which can be read without seeking; for
+                     other streams, and for streams run by a
+                     `manager.DownloadManager`, it falls back to stream
+                     files. A muxed download starts over after a pause.
+
+    The completed byte ranges are recorded in the journal `{output}.journal`.
+    A new `Download` for the same output continues where the last one stopped,
+    unless the size of a stream has changed in the meantime.
     """
-    def __init__(self, streams, output, postprocessing):
+    def __init__(self, streams, output, postprocessing, segments=1, sizes=None,
+                 output_mode='file', mux=False, strategy='parallel'):
+        if strategy not in self.strategies:
+            raise ValueError(f'Unknown strategy {strategy}, use one of {self.strategies}.')
         self.output = output
+        self.output_mode = output_mode
+        self.strategy = strategy
+        self.mux = mux and can_mux(streams)
         self.postprocessing = postprocessing
         self.progress = 0
+        self.segments = segments
+        self.sizes = []
         self.status = 'idle'
+        self.error = None
         self.streams = streams
+        self.stream_progress = [0 for _ in streams]
         self.threads = []
-        self.filesize = self._analyze()
+        self._journal = get_journal(f'{output}.journal')
+        self.filesize = self._analyze(self._recorded_sizes(sizes))
+        self._mux = None
+        self._lock = threading.Lock()
+        self._heads = set()
+        self._heads_done = threading.Condition(self._lock)
+        self._pending = 0
+        self._prepared = set()
+        self._started = None
+        self._samples = collections.deque([(time.monotonic(), 0)],
+                                          maxlen=self.rate_window * 4 + 1)
+        self._transferred = 0
+        self._subscribers = []
+        self._notified = 0.0
+
+    # The transfer rate is averaged over `rate_window` seconds, with one
+    # sample per `sample_interval` seconds.
+    rate_window = 5
+    sample_interval = 0.25
+    # The minimum time in seconds between two progress events.
+    progress_interval = 0.5
+    strategies = ('parallel', 'sequential')
+    # The sequential strategy fetches the first `head_size` bytes of every
+    # stream first, then pieces of `piece_size` bytes.
+    head_size = 524_288
+    piece_size = 2_097_152
 
     def __repr__(self):
-        output = self.__dict__.copy()
+        output = {k: v for k, v in self.__dict__.items()
+                  if not k.startswith('_')}
         del(output['streams'])
         del(output['threads'])
         return f'<Download: {output}>'
 
-    def _analyze(self):
-        """ Get the total filesize of all streams.
+    def _analyze(self, sizes=None):
+        """ Get the filesize of every stream and the total filesize. Unknown
+        sizes are probed at the same time.
 
+        :param list(int) sizes: the known sizes of the streams.
         :returns: the filesize in bytes.
         :rtype: int
         """
-        http = urllib3.PoolManager()
-        filesize = 0
-        for stream in self.streams:
-            if stream:
-                response = http.request('GET', stream['url'], preload_content=False)
-                filesize += int(response.headers['Content-Length'])
-        return filesize
+        self.sizes = known_sizes(self.streams, sizes)
+        unknown = [i for i, size in enumerate(self.sizes) if size is None]
+        if unknown:
+            with concurrent.futures.ThreadPoolExecutor(len(unknown)) as pool:
+                urls = [self.streams[i]['url'] for i in unknown]
+                for i, size in zip(unknown, pool.map(probe_size, urls)):
+                    self.sizes[i] = size
+        return sum(self.sizes)
 
-    def cancel(self):
-        self.status = 'cancelled'
+    def _filepath(self, stream):
+        return stream_path(self.output, stream)
 
-    def download_file(self, stream):
-        if not stream:
-            return None
-        http = urllib3.PoolManager()
+    def _recorded_sizes(self, sizes=None):
+        """ Add the sizes which the journal has recorded for the same stream
+        urls, so they don't need to be probed again.
+
+        :param list(int) sizes: the known sizes of the streams.
+        :rtype: list(int)
+        """
+        sizes = list(sizes or [None] * len(self.streams))
+        if not self._journal.entries:
+            return sizes
+        for i, stream in enumerate(self.streams):
+            if stream and sizes[i] is None and stream.get('filesize') is None:
+                sizes[i] = self._journal.size(self._filepath(stream), stream['url'])
+        return sizes
+
+    def _count(self, index, n):
+        """ Add `n` downloaded bytes to the counters of a stream and record a
+        sample for the transfer rate.
+
+        :param int index: the index of the stream.
+        :param int n: the number of bytes.
+        :return: None
+        """
+        now = time.monotonic()
+        notify = False
+        with self._lock:
+            self.stream_progress[index] += n
+            self.progress += n
+            self._transferred += n
+            if now - self._samples[-1][0] >= self.sample_interval:
+                self._samples.append((now, self._transferred))
+            if self._subscribers and now - self._notified >= self.progress_interval:
+                self._notified = now
+                notify = True
+        if notify:
+            self._emit('progress')
+
+    def _emit(self, event, **data):
+        """ Call the subscribers of an event. Every event is a dict with the
+        name of the `event`, the `download`, a snapshot of its `stats` and
+        the additional `data`.
+
+        :param str event: the name of the event.
+        :return: None
+        """
+        subscribers = [callback for callback, events in list(self._subscribers)
+                       if events is None or event in events]
+        if not subscribers:
+            return
+        payload = {'event': event, 'download': self, 'stats': self.stats(), **data}
+        for callback in subscribers:
+            callback(payload)
+
+    def _fetch_range(self, http, stream, output, start, end):
+        """ Download the bytes `start` to `end` (inclusive) of a stream and
+        write them at their offset into the output file.
+
+        :param urllib3.PoolManager http: the connection pool.
+        :param dict stream: the stream dict.
+        :param OutputFile output: the output file.
+        :param int start: the first byte.
+        :param int end: the last byte.
+        :return: True if the range is complete, False if the download was
+                 stopped.
+        :rtype: bool
+        :raises ConnectionError: if the server answers with an error or
+                                 sends no data for a range.
+        """
         dash_chunk_size = 10_485_760
         dl_chunk_size = 131_072
-        chunk_start = 0
         dash_params = {'key': 'range', 'format': '-'}
-        while self.progress < self.filesize:
-            chunk_end = chunk_start + dash_chunk_size - 1
+        filepath = self._filepath(stream)
+        index = self.streams.index(stream)
+        host = urllib3.util.parse_url(stream['url']).host
+        chunk_start = start
+        while chunk_start <= end:
+            chunk_end = min(chunk_start + dash_chunk_size - 1, end)
             dash_url = f'{stream["url"]}&{dash_params["key"]}={chunk_start}' \
                        f'{dash_params["format"]}{chunk_end}'
             response = http.request('GET', dash_url, preload_content=False)
-            filepath = f'{self.output}.{stream["container"]}.{stream["type"]}.{stream["codec"]}'
-            with open(filepath, 'ab') as f:
+            try:
+                check_range_response(dash_url, response.status,
+                                     response.headers.get('Content-Length'),
+                                     chunk_start, chunk_end)
+            except ConnectionError:
+                # The body may be a whole stream, it is not read.
+                response.close()
+                response.release_conn()
+                raise
+            expected = chunk_end - chunk_start + 1
+            written = 0
+            try:
                 for chunk in response.stream(dl_chunk_size):
                     if self.status != 'active':
+                        return False
+                    # Never write beyond the requested range, in case the
+                    # server sends more than that.
+                    chunk = chunk[:expected - written]
+                    output.write(chunk_start + written, chunk)
+                    written += len(chunk)
+                    self._count(index, len(chunk))
+                    throttle.throttle(host, len(chunk))
+                    if written == expected:
+                        break
+            finally:
+                output.flush()
+                # The status was checked above, so only stream data is
+                # recorded, never the body of an error response.
+                if output.resumable:
+                    self._journal.add(filepath, chunk_start,
+                                      chunk_start + written - 1)
+            if not written:
+                raise ConnectionError(f'No data received for {dash_url}.')
+            # A short response is continued with the next request.
+            chunk_start += written
+        return True
+
+    def _fetch_sequential(self, http, stream, output, missing):
+        """ Download the missing ranges of a stream with the sequential
+        strategy. The pieces beyond the beginning wait until the beginnings
+        of the other running streams are complete, and a piece only starts
+        when it is at most `segments` pieces ahead of the first unfinished
+        one.
+
+        :param urllib3.PoolManager http: the connection pool.
+        :param dict stream: the stream dict.
+        :param OutputFile output: the output file.
+        :param list(tuple(int, int)) missing: the missing ranges.
+        :return: True if the stream is complete, False if the download was
+                 stopped.
+        :rtype: bool
+        """
+        index = self.streams.index(stream)
+        pieces = sequential_ranges(missing, self.head_size, self.piece_size)
+        head = [piece for piece in pieces if piece[0] < self.head_size]
+        with self._lock:
+            self._heads.add(index)
+        try:
+            completed = all(self._fetch_range(http, stream, output, start, end)
+                            for start, end in head)
+        finally:
+            with self._heads_done:
+                self._heads.discard(index)
+                self._heads_done.notify_all()
+        if not completed:
+            return False
+        with self._heads_done:
+            while self._heads and self.status == 'active':
+                self._heads_done.wait(0.1)
+        window = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max(self.segments, 1)) as pool:
+            for start, end in pieces[len(head):]:
+                if len(window) >= max(self.segments, 1):
+                    if not self._wait(window, window[0]):
+                        return False
+                    window.popleft()
+                window.append(pool.submit(self._fetch_range, http, stream,
+                                          output, start, end))
+            return self._wait(window)
+
+    def _wait(self, jobs, until=None):
+        """ Wait for the jobs of a stream, or only for one of them. If a job
+        raises in the meantime, the download is marked as failed, so the
+        other jobs stop after their current chunk, and the error is raised.
+
+        :param list(concurrent.futures.Future) jobs: the running jobs.
+        :param concurrent.futures.Future until: the job to wait for, or None
+                                                to wait for all.
+        :return: True if the awaited ranges are complete.
+        :rtype: bool
+        """
+        targets = [until] if until is not None else list(jobs)
+        while True:
+            for job in jobs:
+                if job.done() and job.exception() is not None:
+                    with self._lock:
+                        if self.status == 'active':
+                            self.error = job.exception()
+                            self.status = 'failed'
+                    raise job.exception()
+            if all(job.done() for job in targets):
+                return all([job.result() for job in targets])
+            concurrent.futures.wait([job for job in jobs if not job.done()],
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def _prepare(self, stream, preallocate=False):
+        """ Check the journal for previous progress of the stream. If there
+        is none, the output file is created (or emptied).
+
+        :param dict stream: the stream dict.
+        :param bool preallocate: extend a new file to its final size.
+        :return: the byte ranges which still need to be downloaded.
+        :rtype: list(tuple(int, int))
+        """
+        size = self.sizes[self.streams.index(stream)]
+        filepath = self._filepath(stream)
+        if self._journal.open(filepath, stream['url'], size):
+            # Count bytes from an earlier run only once; after a pause they
+            # are already part of the progress.
+            if filepath not in self._prepared:
+                completed = self._journal.completed(filepath)
+                with self._lock:
+                    self.stream_progress[self.streams.index(stream)] += completed
+                    self.progress += completed
+        else:
+            with open(filepath, 'wb') as f:
+                if preallocate or self.output_mode != 'file':
+                    preallocate_file(f, size)
+        self._prepared.add(filepath)
+        return self._journal.missing(filepath, 0, size - 1)
+
+    def activate(self):
+        """ Mark the download as active without starting any threads. This
+        allows the streams to be run by `download_file` elsewhere, e.g. by the
+        workers of a `manager.DownloadManager`.
+
+        :return: None
+        """
+        with self._lock:
+            self.status = 'active'
+            self._pending = len([s for s in self.streams if s])
+            if self._started is None:
+                self._started = time.monotonic()
+        self._emit('started')
+
+    def _abort_mux(self):
+        mux, self._mux = self._mux, None
+        if mux is not None:
+            mux.abort()
+
+    def cancel(self):
+        self.status = 'cancelled'
+        self._abort_mux()
+        self._emit('cancelled')
+
+    def download_file(self, stream):
+        """ Download a single stream in the calling thread. With more than
+        one segment, the missing ranges of the stream are split up and
+        fetched at the same time, see `strategy`.
+
+        :param dict stream: the stream dict.
+        :return: True if the stream is complete, False if the download was
+                 stopped before.
+        :rtype: bool
+        """
+        if not stream:
+            return None
+        index = self.streams.index(stream)
+        size = self.sizes[index]
+        http = session.get_pool(stream['url'])
+        if self._mux is not None:
+            # A pipe is written from start to end in one piece.
+            missing = [(0, size - 1)]
+            output = PipeOutput(self._mux, index)
+        else:
+            missing = self._prepare(stream, preallocate=self.segments > 1)
+            if self.segments > 1 and self.strategy == 'parallel':
+                missing = [(max(start, m_start), min(end, m_end))
+                           for start, end in segment_ranges(size, self.segments)
+                           for m_start, m_end in missing
+                           if m_start <= end and m_end >= start]
+            output = OutputFile(self._filepath(stream), size, self.output_mode)
+        try:
+            if self.strategy == 'sequential' and self._mux is None:
+                completed = self._fetch_sequential(http, stream, output, missing)
+            elif self.segments > 1 and len(missing) > 1:
+                with concurrent.futures.ThreadPoolExecutor(len(missing)) as pool:
+                    jobs = [pool.submit(self._fetch_range, http, stream, output,
+                                        start, end)
+                            for start, end in missing]
+                    completed = self._wait(jobs)
+            else:
+                completed = all(self._fetch_range(http, stream, output, start, end)
+                                for start, end in missing)
+        finally:
+            output.close()
+        if completed:
+            self.stream_finished(stream)
+        return completed
+
+    def events(self, timeout=None):
+        """ Subscribe to all events of the download through a thread-safe
+        queue. Iterating over the result yields the events until the
+        download is finished, failed or cancelled. Call it before `start()`
+        to receive every event.
+
+        :param float timeout: the maximum time to wait for the next event.
+        :return: a generator of events (see `subscribe`).
+        :raises queue.Empty: if no event arrives within `timeout`.
+        """
+        events = queue.Queue()
+        self.subscribe(events.put)
+
+        def iterate():
+            try:
+                while True:
+                    event = events.get(timeout=timeout)
+                    yield event
+                    if event['event'] in ('finished', 'failed', 'cancelled'):
                         return
-                    f.write(chunk)
-                    # Check whether the chunk was smaller than our chunk size,
-                    # to get the correct progress for the last iteration.
-                    if sys.getsizeof(chunk) == dl_chunk_size:
-                        self.progress += dl_chunk_size
-                    else:
-                        self.progress += sys.getsizeof(chunk)
-            chunk_start = chunk_end + 1
-        self.status = 'finished'
-        self.trigger_pp()
-        return
+            finally:
+                self.unsubscribe(events.put)
+
+        return iterate()
+
+    def fail(self, error):
+        """ Stop the download because of an error.
+
+        :param Exception error: the error.
+        :return: None
+        """
+        self.error = error
+        self.status = 'failed'
+        self._abort_mux()
+        self._emit('failed', error=error)
+
+    def pause(self):
+        """ Stop all streams. The progress is kept in the journal, so the
+        download continues where it stopped when it is started again.
+        """
+        if self.status == 'active':
+            self.status = 'paused'
+            self._abort_mux()
+            self._emit('paused')
+
+    def run_stream(self, stream):
+        """ Download a stream like `download_file`, but stop the whole
+        download with the error instead of raising it.
+
+        :param dict stream: the stream dict.
+        :return: None
+        """
+        try:
+            self.download_file(stream)
+        except Exception as e:
+            self.fail(e)
 
     def start(self):
-        self.status = 'active'
+        if self.mux:
+            # The mux can't continue the last run, it starts over.
+            with self._lock:
+                self.progress = 0
+                self.stream_progress = [0 for _ in self.streams]
+            self._mux = StreamingMux(self.output, self.streams)
+        if self.strategy == 'sequential':
+            # All streams start now, so none runs ahead of the beginning of
+            # the others.
+            with self._lock:
+                self._heads.update(i for i, stream in enumerate(self.streams)
+                                   if stream)
+        self.activate()
         for stream in self.streams:
-            t = threading.Thread(target=self.download_file, args=[stream])
+            t = threading.Thread(target=self.run_stream, args=[stream])
             self.threads.append(t)
             t.start()
 
+    def playable(self):
+        """ The number of bytes of every stream which are complete from the
+        start on, i.e. up to which the stream can be played.
+
+        :return: the number of bytes for every stream; 0 for a skipped one.
+        :rtype: list(int)
+        """
+        if self.status == 'finished':
+            return list(self.sizes)
+        result = []
+        for index, (stream, size) in enumerate(zip(self.streams, self.sizes)):
+            filepath = self._filepath(stream) if stream else None
+            if not stream:
+                result.append(0)
+            elif self._mux is not None:
+                # Pipes are written in order.
+                result.append(self.stream_progress[index])
+            elif filepath not in self._journal.entries:
+                result.append(0)
+            else:
+                missing = self._journal.missing(filepath, 0, size - 1)
+                result.append(missing[0][0] if missing else size)
+        return result
+
+    def rate(self):
+        """ The transfer rate, averaged over the last `rate_window` seconds.
+        Bytes from an earlier run (see the journal) are not included.
+
+        :return: the rate in bytes per second.
+        :rtype: float
+        """
+        now = time.monotonic()
+        with self._lock:
+            transferred = self._transferred
+            for sample_time, sample_bytes in self._samples:
+                if now - sample_time <= self.rate_window:
+                    break
+            else:
+                sample_time, sample_bytes = self._samples[-1]
+        if now - sample_time <= 0:
+            return 0.0
+        return (transferred - sample_bytes) / (now - sample_time)
+
+    def stats(self):
+        """ A consistent snapshot of the progress, cheap enough to be polled
+        at a high frequency.
+
+        :return: the `status`, `progress` and `filesize` in bytes, the
+                 `progress`, `size` and `playable` bytes (see `playable`)
+                 of every stream, the `rate` in bytes
+                 per second, the `eta` in seconds (None if unknown) and the
+                 `elapsed` time in seconds since the start.
+        :rtype: dict
+        """
+        rate = self.rate()
+        playable = self.playable()
+        with self._lock:
+            progress = self.progress
+            streams = [{'progress': p, 'size': size, 'playable': n}
+                       for p, size, n in zip(self.stream_progress, self.sizes,
+                                             playable)]
+            started = self._started
+        remaining = self.filesize - progress
+        if not remaining:
+            eta = 0.0
+        else:
+            eta = remaining / rate if rate else None
+        return {'status': self.status,
+                'progress': progress,
+                'filesize': self.filesize,
+                'streams': streams,
+                'rate': rate,
+                'eta': eta,
+                'elapsed': time.monotonic() - started if started else 0.0}
+
+    def stream_finished(self, stream=None):
+        """ Mark one stream as finished. The last finishing stream sets the
+        status and triggers the postprocessing.
+
+        :param dict stream: the finished stream.
+        :return: None
+        """
+        self._emit('stream_finished', stream=stream)
+        with self._lock:
+            self._pending -= 1
+            if self._pending or self.status != 'active':
+                return
+            self.status = 'finished'
+        self._journal.remove()
+        self._emit('postprocessing')
+        try:
+            result = self.trigger_pp()
+        except Exception as e:
+            self.fail(e)
+            return
+        self._emit('finished', result=result)
+
+    def subscribe(self, callback, events=None):
+        """ Call `callback` with every event of the download. The events
+        are 'started', 'progress' (at most every `progress_interval`
+        seconds), 'stream_finished', 'paused', 'postprocessing', 'finished',
+        'failed' and 'cancelled'. An event is a dict with the name of the
+        `event`, the `download`, a snapshot of its `stats()` and, depending
+        on the event, the `stream` or the `error`. Callbacks run in the
+        download threads, so they should return quickly.
+
+        :param callable callback: the callback.
+        :param list(str) events: the names of the events to receive.
+                                 Default: all.
+        :return: None
+        """
+        self._subscribers.append((callback, set(events) if events else None))
+
+    def unsubscribe(self, callback):
+        """ Remove all subscriptions of a callback.
+
+        :param callable callback: the callback.
+        :return: None
+        """
+        self._subscribers = [(c, e) for c, e in self._subscribers if c != callback]
+
     def trigger_pp(self):
-        if not ([t.isAlive() for t in self.threads].count(True) - 1):
-            self.postprocessing(self.output)
+        """ Run the postprocessing with the output path and the stream files,
+        or with the final file of the mux.
+
+        :return: the result of the postprocessing.
+        """
+        if self._mux is not None:
+            mux, self._mux = self._mux, None
+            return self.postprocessing(self.output, files=[], result=mux.finish())
+        files = [(self._filepath(stream), stream['container'], stream['type'],
+                  stream['codec']) for stream in self.streams if stream]
+        return self.postprocessing(self.output, files=files)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+""" A sidecar journal which records the completed byte ranges of a download,
+so an interrupted download can be resumed later on.
+"""
+
+import json
+import os
+import threading
+import weakref
+
+_journals = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def merge_ranges(ranges):
+    """ Sort and merge overlapping or adjacent byte ranges.
+
+    :param list ranges: inclusive (start, end) byte positions.
+    :return: the merged ranges.
+    :rtype: list(list(int, int))
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def get_journal(path):
+    """ Get the journal of a path. Everything which records ranges in the
+    same journal file, like a `downloader.Download` and the
+    `proxy.StreamProxy`, has to share one instance, since every save
+    rewrites the whole file.
+
+    :param str path: the path of the journal file.
+    :rtype: Journal
+    """
+    key = os.path.abspath(path)
+    with _lock:
+        journal = _journals.get(key)
+        if journal is None:
+            journal = _journals[key] = Journal(path)
+        return journal
+
+
+class Journal:
+    """ The journal is a json file next to the output, containing the url,
+    the expected size and the completed byte ranges of every stream file.
+    Use `get_journal` to get the shared instance of a path.
+
+    :param str path: the path of the journal file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.removed = False
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)['streams']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def __repr__(self):
+        return f'<Journal: {self.path}>'
+
+    def _save(self):
+        if self.removed:
+            return
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'streams': self.entries}, f)
+        os.replace(tmp, self.path)
+
+    def add(self, filepath, start, end):
+        """ Record the bytes `start` to `end` (inclusive) as completed.
+
+        :param str filepath: the stream file.
+        :param int start: the first byte.
+        :param int end: the last byte.
+        :return: None
+        """
+        if end < start:
+            return
+        with self._lock:
+            entry = self.entries[filepath]
+            entry['done'] = merge_ranges(entry['done'] + [[start, end]])
+            self._save()
+
+    def completed(self, filepath):
+        """ The number of completed bytes of a stream file.
+
+        :param str filepath: the stream file.
+        :rtype: int
+        """
+        entry = self.entries.get(filepath, {'done': []})
+        return sum(end - start + 1 for start, end in entry['done'])
+
+    def missing(self, filepath, start, end):
+        """ Find the parts of a byte range which are not completed yet.
+
+        :param str filepath: the stream file.
+        :param int start: the first byte.
+        :param int end: the last byte.
+        :return: the missing (start, end) ranges.
+        :rtype: list(tuple(int, int))
+        """
+        result = []
+        for done_start, done_end in self.entries[filepath]['done']:
+            if done_end < start or done_start > end:
+                continue
+            if done_start > start:
+                result.append((start, done_start - 1))
+            start = max(start, done_end + 1)
+        if start <= end:
+            result.append((start, end))
+        return result
+
+    def open(self, filepath, url, size):
+        """ Look up the entry of a stream file. The previous progress is
+        discarded when the remote size has changed or the file is gone. The
+        url is recorded, but not compared, since stream urls usually carry
+        signatures which change between requests.
+
+        :param str filepath: the stream file.
+        :param str url: the stream url.
+        :param int size: the expected size of the stream.
+        :return: True if previous progress can be reused, False otherwise.
+        :rtype: bool
+        """
+        with self._lock:
+            entry = self.entries.get(filepath)
+            resume = bool(entry and entry['size'] == size and entry['done']
+                          and os.path.exists(filepath))
+            if not resume:
+                entry = {'url': url, 'size': size, 'done': []}
+            entry['url'] = url
+            self.entries[filepath] = entry
+            self._save()
+        return resume
+
+    def size(self, filepath, url):
+        """ The recorded size of a stream file, if it was recorded for the
+        same url, e.g. by a `proxy.StreamProxy` while playing.
+
+        :param str filepath: the stream file.
+        :param str url: the stream url.
+        :return: the size, or None.
+        :rtype: int
+        """
+        entry = self.entries.get(filepath)
+        if entry and entry.get('url') == url and os.path.exists(filepath):
+            return entry['size']
+        return None
+
+    def remove(self):
+        """ Delete the journal file once the download is complete. The
+        entries stay in memory for the users which still hold the instance,
+        like the `proxy.StreamProxy` while it plays the streams, but they
+        are not saved anymore; `get_journal` returns a new instance.
+
+        :return: None
+        """
+        with self._lock:
+            self.removed = True
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        with _lock:
+            key = os.path.abspath(self.path)
+            if _journals.get(key) is self:
+                del _journals[key]
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
+import concurrent.futures
+import hashlib
+import json
 import pathlib
 import os
+import shutil
 import sys
+import tempfile
 import urllib.parse
 
 import urllib3.util
@@ -11,44 +16,150 @@ PATH = os.path.dirname(__file__)
 sys.path.append(PATH)
 PLUGIN_FOLDER = os.path.join(PATH, 'plugins')
 
+import session
 
-def get_plugins_from_repo(url, branch='master'):
-    """ Find and download all the plugins from the github repository.
 
-    :param url: the .git url.
+PLUGIN_FILES = ('{name}.py', 'test_unittest.py', 'test_functional.py')
+SYNC_LOCKFILE = '.sync.json'
+
+
+def _plugin_source(url, branch):
+    """ The base of the plugin folder in a repository, which is either a
+    local directory or an https url.
+    """
+    if url.startswith('file://'):
+        return urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+    if os.path.isdir(url):
+        return url
+    url = url.replace('.git', '/')
+    parsed_url = urllib3.util.parse_url(url)
+    branch_root = urllib.parse.urljoin(parsed_url.path, branch + '/')
+    plugin_path = urllib.parse.urljoin(branch_root, 'plugins/')
+    return f'https://raw.githubusercontent.com{plugin_path}'
+
+
+def _fetch(source, path, lock, local):
+    """ Fetch a file of the plugin folder, unless it is the same as the
+    local file.
+
+    :param str source: the base of the plugin folder, see `_plugin_source`.
+    :param str path: the relative path of the file.
+    :param dict lock: the lockfile entry of the file, or None.
+    :param bool local: whether the local file exists.
+    :return: the data, or None if it hasn't changed, and the new lockfile
+             entry (None if the file doesn't exist).
+    :rtype: tuple
+    """
+    entry = {}
+    if source.startswith('https://'):
+        headers = {}
+        if lock and local:
+            if lock.get('etag'):
+                headers['If-None-Match'] = lock['etag']
+            if lock.get('last_modified'):
+                headers['If-Modified-Since'] = lock['last_modified']
+        response = session.request('GET', urllib.parse.urljoin(source, path),
+                                   headers=headers)
+        if response.status == 304:
+            return None, lock
+        if response.status == 404:
+            return None, None
+        if response.status != 200:
+            raise ConnectionError(f'Could not fetch {path}: {response.status}')
+        data = response.data
+        entry = {'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified')}
+    else:
+        try:
+            with open(os.path.join(source, path), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None
+    entry['sha256'] = hashlib.sha256(data).hexdigest()
+    if lock and local and lock.get('sha256') == entry['sha256']:
+        return None, entry
+    return data, entry
+
+
+def _install_plugin(name, files):
+    """ Replace the folder of a plugin with the new files at once, so a
+    half-written plugin is never loaded.
+
+    :param str name: the plugin name.
+    :param dict files: the file names and their new data, or None for files
+                       which are kept.
+    :return: the written files.
+    :rtype: list(pathlib.Path)
+    """
+    plugin_folder = pathlib.Path(PLUGIN_FOLDER)
+    folder = plugin_folder / name
+    tmp = pathlib.Path(tempfile.mkdtemp(prefix=f'.sync-{name}-', dir=plugin_folder))
+    written = []
+    for filename, data in files.items():
+        if data is None:
+            if (folder / filename).exists():
+                shutil.copy2(folder / filename, tmp / filename)
+            continue
+        with open(tmp / filename, 'wb') as f:
+            f.write(data)
+        written.append(folder / filename)
+    old = None
+    if folder.exists():
+        old = plugin_folder / f'.old-{tmp.name}'
+        os.rename(folder, old)
+    os.rename(tmp, folder)
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+    return written
+
+
+def get_plugins_from_repo(url, branch='master', force=False, max_workers=8):
+    """ Find and download all the plugins from the github repository. The
+    files are fetched concurrently, and only if they changed since the last
+    sync (which is recorded in the `SYNC_LOCKFILE` of the plugin folder).
+    Each plugin is replaced as a whole.
+
+    :param url: the .git url, or a local directory (or file:// url) with a
+                copy of the plugin folder of the repository.
     :type url: str
     :param branch: the branch, default: "master"
     :type branch: str
+    :param force: download all files, even if they haven't changed.
+    :type force: bool
+    :param max_workers: the number of files fetched at the same time.
+    :type max_workers: int
     :return: the written files.
     :rtype: list(str)
     """
+    source = _plugin_source(url, branch)
+    lockfile = os.path.join(PLUGIN_FOLDER, SYNC_LOCKFILE)
+    try:
+        with open(lockfile) as f:
+            locks = {} if force else json.load(f)
+    except (OSError, ValueError):
+        locks = {}
+    index, _ = _fetch(source, 'index.txt', None, False)
+    names = [name.decode('utf-8') for name in (index or b'').split()]
+
+    paths = [f'{name}/{filename.format(name=name)}'
+             for name in names for filename in PLUGIN_FILES]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        jobs = [pool.submit(_fetch, source, path, locks.get(path),
+                            os.path.exists(os.path.join(PLUGIN_FOLDER, path)))
+                for path in paths]
+        results = dict(zip(paths, [job.result() for job in jobs]))
+
     local_files_written = []
-    url = url.replace('.git', '/')
-    host = 'raw.githubusercontent.com'
-    parsed_url = urllib3.util.parse_url(url)
-    branch_root = urllib.parse.urljoin(parsed_url.path, branch + '/')
-    plugin_path = urllib.parse.urljoin(branch_root, 'plugins/')
-    plugin_index = urllib.parse.urljoin(plugin_path, 'index.txt')
-    http = urllib3.HTTPSConnectionPool(host)
-    response = http.request('GET', plugin_index)
-    for name in response.data.split():
-        name = name.decode('utf-8')
-        folder = pathlib.Path(PLUGIN_FOLDER) / name
-        module = folder / f'{name}.py'
-        test_unit = folder / 'test_unittest.py'
-        test_func = folder / 'test_functional.py'
-        if not os.path.exists(folder):
-            os.mkdir(folder)
-        module_url = urllib.parse.urljoin(plugin_path, f'{name}/{name}.py')
-        test_unit_url = urllib.parse.urljoin(plugin_path, f'{name}/test_unittest.py')
-        test_func_url = urllib.parse.urljoin(plugin_path, f'{name}/test_functional.py')
-
-        files = zip([module, test_unit, test_func],
-                    [module_url, test_unit_url, test_func_url])
-
-        for local, remote in files:
-            r = http.request('GET', remote)
-            with open(local, 'wb') as f:
-                f.write(r.data)
-            local_files_written.append(local)
-    return local_files_written
+    for name in names:
+        files = {}
+        for filename in PLUGIN_FILES:
+            path = f'{name}/{filename.format(name=name)}'
+            data, locks[path] = results[path]
+            files[filename.format(name=name)] = data
+        if any(data is not None for data in files.values()):
+            local_files_written += _install_plugin(name, files)
+    locks = {path: locks[path] for path in paths if locks.get(path)}
+    with open(f'{lockfile}.tmp', 'w') as f:
+        json.dump(locks, f, indent=1)
+    os.replace(f'{lockfile}.tmp', lockfile)
+    return [str(path) for path in local_files_written]
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+""" The DownloadManager runs many downloads on a fixed number of worker
+threads.
+"""
+
+import bisect
+import functools
+import itertools
+import threading
+
+import urllib3.util
+
+
+class Job:
+    """ A download which was added to the manager.
+
+    :param int job_id: the id of the job.
+    :param Download download: the download.
+    :param int priority: the priority, higher values run first.
+    """
+    def __init__(self, job_id, download, priority):
+        self.id = job_id
+        self.download = download
+        self.priority = priority
+        self.running = set()
+
+    def __repr__(self):
+        return f'<Job {self.id}: {self.status}, priority {self.priority}>'
+
+    @property
+    def error(self):
+        return self.download.error
+
+    @property
+    def status(self):
+        if self.download.status == 'active' and not self.running:
+            return 'queued'
+        return self.download.status
+
+
+class DownloadManager:
+    """ Run the streams of many `Download` instances on a bounded pool of
+    worker threads. Every stream is one unit of work; a stream which is
+    downloaded in several segments occupies that many connections to its host.
+
+    :param int workers: the number of worker threads, i.e. the maximum
+                        number of streams downloaded at the same time.
+    :param int host_limit: the maximum number of connections per host.
+                           Default: no limit.
+    """
+    def __init__(self, workers=4, host_limit=None):
+        self.host_limit = host_limit
+        self.jobs = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._connections = {}
+        self._ids = itertools.count(1)
+        self._queue = []
+        self._seq = itertools.count()
+        self._subscribers = []
+        self._workers = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        for t in self._workers:
+            t.start()
+
+    def __repr__(self):
+        return f'<DownloadManager: {len(self._workers)} workers, ' \
+               f'{len(self.jobs)} jobs>'
+
+    @staticmethod
+    def _host(stream):
+        return urllib3.util.parse_url(stream['url']).host
+
+    def _enqueue(self, job):
+        for index, stream in enumerate(job.download.streams):
+            if stream and index not in job.running:
+                task = (-job.priority, next(self._seq), job.id, index)
+                bisect.insort(self._queue, task)
+        self._cond.notify_all()
+
+    def _next_task(self):
+        """ Take the task with the highest priority whose host has a free
+        connection off the queue.
+        """
+        for i, task in enumerate(self._queue):
+            job = self.jobs[task[2]]
+            stream = job.download.streams[task[3]]
+            used = self._connections.get(self._host(stream), 0)
+            if self.host_limit is None or used + job.download.segments <= self.host_limit \
+                    or not used:
+                return self._queue.pop(i)
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    if self._closed and not self._queue:
+                        return
+                    self._cond.wait()
+                    task = self._next_task()
+                job, index = self.jobs[task[2]], task[3]
+                stream = job.download.streams[index]
+                host = self._host(stream)
+                weight = job.download.segments
+                self._connections[host] = self._connections.get(host, 0) + weight
+                job.running.add(index)
+            completed = False
+            try:
+                completed = job.download.download_file(stream)
+            except Exception as e:
+                with self._cond:
+                    # The other streams of the job must not start anymore.
+                    self._remove_tasks(job.id)
+                job.download.fail(e)
+            finally:
+                with self._cond:
+                    self._connections[host] -= weight
+                    job.running.discard(index)
+                    # The stream was stopped by a pause, but the job has been
+                    # resumed in the meantime.
+                    if not completed and job.download.status == 'active':
+                        bisect.insort(self._queue, task)
+                    self._cond.notify_all()
+
+    def _forward(self, job_id, event):
+        event = dict(event, job=job_id)
+        for callback in list(self._subscribers):
+            callback(event)
+
+    def _remove_tasks(self, job_id):
+        self._queue = [t for t in self._queue if t[2] != job_id]
+
+    def add(self, download, priority=0):
+        """ Add a download to the queue.
+
+        :param Download download: the download.
+        :param int priority: the priority, higher values run first.
+        :return: the job id.
+        :rtype: int
+        """
+        with self._cond:
+            job = Job(next(self._ids), download, priority)
+            self.jobs[job.id] = job
+            download.subscribe(functools.partial(self._forward, job.id))
+            download.activate()
+            self._enqueue(job)
+        return job.id
+
+    def cancel(self, job_id):
+        """ Cancel a job. Running streams stop after their current chunk.
+
+        :param int job_id: the job id.
+        :return: None
+        """
+        with self._cond:
+            self._remove_tasks(job_id)
+            self.jobs[job_id].download.cancel()
+            self._cond.notify_all()
+
+    def join(self):
+        """ Block until no job is queued or running anymore.
+
+        :return: None
+        """
+        with self._cond:
+            while self._queue or any(j.running for j in self.jobs.values()):
+                self._cond.wait()
+
+    def pause(self, job_id):
+        """ Pause a job. Its progress is kept in the journal of the download.
+
+        :param int job_id: the job id.
+        :return: None
+        """
+        with self._cond:
+            self._remove_tasks(job_id)
+            self.jobs[job_id].download.pause()
+            self._cond.notify_all()
+
+    def progress(self):
+        """ The aggregated progress of all jobs.
+
+        :return: the downloaded and total bytes, and the number of jobs for
+                 every status.
+        :rtype: dict
+        """
+        result = {'progress': 0, 'filesize': 0, 'jobs': {}}
+        with self._cond:
+            for job in self.jobs.values():
+                result['progress'] += job.download.progress
+                result['filesize'] += job.download.filesize
+                status = job.status
+                result['jobs'][status] = result['jobs'].get(status, 0) + 1
+        return result
+
+    def resume(self, job_id):
+        """ Resume a paused job.
+
+        :param int job_id: the job id.
+        :return: None
+        """
+        with self._cond:
+            job = self.jobs[job_id]
+            if job.download.status != 'paused':
+                return
+            job.download.activate()
+            self._enqueue(job)
+
+    def subscribe(self, callback):
+        """ Call `callback` with the events of all jobs, see
+        `downloader.Download.subscribe`. Every event also contains the `job`
+        id. This replaces polling the status of every single job.
+
+        :param callable callback: the callback.
+        :return: None
+        """
+        self._subscribers.append(callback)
+
+    def shutdown(self, cancel=False):
+        """ Stop the workers once the queue is empty.
+
+        :param bool cancel: cancel all unfinished jobs instead of waiting for
+                            them.
+        :return: None
+        """
+        if cancel:
+            for job_id in list(self.jobs):
+                self.cancel(job_id)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._workers:
+            t.join()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+""" The postprocessing of finished downloads. A job runs a chain of steps
+(merging the streams, embedding subtitles and the thumbnail) on a pool of
+worker threads, so only a limited number of ffmpeg processes run at the
+same time. Alternatively, the streams are remuxed while they are downloaded,
+see `StreamingMux`.
+"""
+
+import concurrent.futures
+import errno
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, which has no FIFOs for `StreamingMux` anyway.
+    fcntl = None
+
+import utils
+
+# The subtitle codec for each output container.
+SUBTITLE_CODECS = {'.mp4': 'mov_text', '.m4a': 'mov_text', '.mkv': 'srt',
+                   '.webm': 'webvtt'}
+# Containers which can hold a thumbnail as cover art.
+THUMBNAIL_CONTAINERS = ('.mp4', '.m4a', '.mkv')
+# Stream containers which ffmpeg reads from start to end, without seeking.
+MUX_CONTAINERS = ('webm', 'mkv')
+# The buffer size of the pipes of a `StreamingMux`, where it can be set.
+PIPE_SIZE = 1_048_576
+
+
+class PostprocessingError(Exception):
+    """ A step of a postprocessing job failed.
+
+    :param list(dict) report: the report of the job, see `Pipeline.submit`.
+    """
+    def __init__(self, report):
+        self.report = report
+        failed = report[-1]
+        super().__init__(f'Postprocessing step {failed["step"]} failed: '
+                         f'{failed["error"]}')
+
+
+def _ffmpeg(*args, output):
+    """ Run ffmpeg and replace `output` with its result.
+
+    :return: the exit status.
+    :rtype: int
+    """
+    base, ext = os.path.splitext(output)
+    tmp = f'{base}.tmp{ext}'
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', *args, tmp]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise subprocess.CalledProcessError(result.returncode, cmd,
+                                            stderr=result.stderr)
+    os.replace(tmp, output)
+    return result.returncode
+
+
+def merge(job):
+    """ Merge the stream files of the job into one file, see
+    `utils.merge_files`. Sets the `result` path of the job, unless the job
+    has a `result` already, i.e. the streams were remuxed while downloading.
+
+    :param dict job: the job.
+    :return: the exit status, or None if nothing was done.
+    """
+    if job.get('result'):
+        return None
+    job['result'] = utils.merge_files(job['output'], files=job['files'])
+    return 0 if job['result'] else None
+
+
+def embed_subtitles(job):
+    """ Embed the `subtitles` file of the job into the result, if the
+    container supports it.
+
+    :param dict job: the job.
+    :return: the exit status, or None if nothing was done.
+    """
+    subtitles, result = job.get('subtitles'), job.get('result')
+    if not subtitles or not result or not os.path.exists(subtitles):
+        return None
+    codec = SUBTITLE_CODECS.get(os.path.splitext(result)[1])
+    if codec is None:
+        return None
+    return _ffmpeg('-i', result, '-i', subtitles, '-map', '0', '-map', '1',
+                   '-c', 'copy', '-c:s', codec, output=result)
+
+
+def embed_thumbnail(job):
+    """ Embed the `thumbnail` image of the job into the result as cover
+    art, if the container supports it.
+
+    :param dict job: the job.
+    :return: the exit status, or None if nothing was done.
+    """
+    thumbnail, result = job.get('thumbnail'), job.get('result')
+    if not thumbnail or not result or \
+            os.path.splitext(result)[1] not in THUMBNAIL_CONTAINERS:
+        return None
+    return _ffmpeg('-i', result, '-i', thumbnail, '-map', '0', '-map', '1',
+                   '-c', 'copy', '-disposition:v:1', 'attached_pic',
+                   output=result)
+
+
+STEPS = {'merge': merge,
+         'embed_subtitles': embed_subtitles,
+         'embed_thumbnail': embed_thumbnail}
+DEFAULT_STEPS = ('merge', 'embed_subtitles', 'embed_thumbnail')
+
+
+class Pipeline:
+    """ Runs postprocessing jobs on a pool of worker threads. Jobs wait in a
+    queue of limited size; when it is full, `submit` blocks until a worker
+    is free.
+
+    :param int workers: the number of jobs which run at the same time.
+    :param int queue_size: the number of jobs which may wait.
+    """
+    def __init__(self, workers=2, queue_size=16):
+        self.workers = workers
+        self._queue = queue.Queue(queue_size)
+        self._threads = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __repr__(self):
+        return f'<Pipeline: {self.workers} workers, {self._queue.qsize()} queued>'
+
+    def __call__(self, output, files=None, **job):
+        """ Run a job and wait for it, see `submit`. This makes a pipeline
+        usable as the `postprocessing` of a `downloader.Download`.
+
+        :return: the report.
+        :rtype: list(dict)
+        :raises PostprocessingError: if a step failed.
+        """
+        return self.submit(output, files, **job).result()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, job = item
+            if future.set_running_or_notify_cancel():
+                report = self.run(job)
+                if report and report[-1]['status'] == 'failed':
+                    future.set_exception(PostprocessingError(report))
+                else:
+                    future.set_result(report)
+
+    @staticmethod
+    def run(job):
+        """ Run the steps of a job one after another. The chain stops at the
+        first failed step.
+
+        :param dict job: the job.
+        :return: the report, a dict for every step with its name, `status`
+                 ('ok', 'skipped' or 'failed'), `returncode`, `duration` in
+                 seconds and `error`.
+        :rtype: list(dict)
+        """
+        report = []
+        for name in job['steps']:
+            start = time.monotonic()
+            entry = {'step': name, 'status': 'ok', 'returncode': None,
+                     'error': None}
+            try:
+                entry['returncode'] = STEPS[name](job)
+                if entry['returncode'] is None:
+                    entry['status'] = 'skipped'
+            except subprocess.CalledProcessError as e:
+                entry.update(status='failed', returncode=e.returncode, error=e)
+            except Exception as e:
+                entry.update(status='failed', error=e)
+            entry['duration'] = time.monotonic() - start
+            report.append(entry)
+            if entry['status'] == 'failed':
+                break
+        return report
+
+    def shutdown(self):
+        """ Stop the workers after the queued jobs.
+
+        :return: None
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, output, files=None, steps=DEFAULT_STEPS, **job):
+        """ Queue a job. Blocks while the queue is full.
+
+        :param str output: the base path of the download.
+        :param list(tuple) files: the stream files, see `utils.merge_files`.
+        :param list(str) steps: the names of the steps, see `STEPS`.
+        :keyword str subtitles: the path of a subtitle file to embed.
+        :keyword str thumbnail: the path of an image to embed.
+        :return: a future of the report (see `run`), which raises a
+                 `PostprocessingError` if a step failed.
+        :rtype: concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+        job.update(output=output, files=files, steps=steps)
+        self._queue.put((future, job))
+        return future
+
+
+def can_mux(streams):
+    """ Check whether the streams of a download can be remuxed while they are
+    downloaded, see `StreamingMux`.
+
+    :param list(dict) streams: the stream dicts; None for a skipped stream.
+    :rtype: bool
+    """
+    streams = [stream for stream in streams if stream]
+    return hasattr(os, 'mkfifo') and len(streams) > 1 and \
+        all(stream['container'] in MUX_CONTAINERS for stream in streams)
+
+
+class StreamingMux:
+    """ A running ffmpeg process which remuxes the streams of a download into
+    the final file while they are downloaded. Every stream is written into a
+    FIFO which ffmpeg reads from, so there are no stream files and the final
+    file is ready as soon as the last byte has arrived. This only works for
+    containers which ffmpeg can read without seeking (see `can_mux`), and
+    the streams have to be written at the same time and in order.
+
+    :param str output: the base path of the download.
+    :param list(dict) streams: the stream dicts; None for a skipped stream.
+    """
+    def __init__(self, output, streams):
+        containers = {stream['container'] for stream in streams if stream}
+        ext = 'webm' if containers == {'webm'} else 'mkv'
+        self.result = f'{output}.{ext}'
+        self.aborted = False
+        self._tmp = f'{output}.tmp.{ext}'
+        self._folder = tempfile.mkdtemp(prefix='paletti-mux-')
+        self._inputs = {}
+        args = []
+        for index, stream in enumerate(streams):
+            if stream:
+                path = os.path.join(self._folder, f'{index}.{stream["container"]}')
+                os.mkfifo(path)
+                self._inputs[index] = path
+                args += ['-i', path]
+        for n in range(len(self._inputs)):
+            args += ['-map', str(n)]
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', *args, '-c', 'copy', self._tmp]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+
+    def __repr__(self):
+        return f'<StreamingMux: {self.result}>'
+
+    def _cleanup(self):
+        shutil.rmtree(self._folder, ignore_errors=True)
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def abort(self):
+        """ Stop ffmpeg and remove the unfinished file. Writes to the pipes
+        are ignored from now on.
+
+        :return: None
+        """
+        self.aborted = True
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.communicate()
+        self._cleanup()
+
+    def check(self):
+        """ Raise an error if ffmpeg has failed.
+
+        :return: None
+        :raises subprocess.CalledProcessError: if ffmpeg has failed.
+        """
+        returncode = self.process.poll()
+        if returncode and not self.aborted:
+            raise subprocess.CalledProcessError(returncode, self.process.args,
+                                                stderr=self.process.stderr.read())
+
+    def finish(self):
+        """ Wait for ffmpeg once all pipes are closed.
+
+        :return: the path of the final file.
+        :rtype: str
+        :raises subprocess.CalledProcessError: if ffmpeg has failed.
+        """
+        try:
+            _, stderr = self.process.communicate()
+            if self.process.returncode:
+                raise subprocess.CalledProcessError(self.process.returncode,
+                                                    self.process.args,
+                                                    stderr=stderr)
+            os.replace(self._tmp, self.result)
+        finally:
+            self._cleanup()
+        return self.result
+
+    def open_input(self, index):
+        """ Open the pipe of a stream for writing. Blocks until ffmpeg opens
+        it for reading.
+
+        :param int index: the index of the stream.
+        :return: the file descriptor, or None if the mux has been aborted.
+        :rtype: int
+        :raises subprocess.CalledProcessError: if ffmpeg has failed.
+        """
+        path = self._inputs[index]
+        while True:
+            if self.aborted:
+                return None
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                # There is no reader yet.
+                if e.errno != errno.ENXIO:
+                    raise
+            self.check()
+            if self.process.poll() is not None:
+                raise BrokenPipeError(f'ffmpeg exited before reading {path}.')
+            time.sleep(0.01)
+        os.set_blocking(fd, True)
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+            except OSError:
+                pass
+        return fd
+
+
+_config = {'workers': 2, 'queue_size': 16}
+_pipeline = None
+_lock = threading.Lock()
+
+
+def configure(**options):
+    """ Change the settings of the shared pipeline. Jobs which are already
+    queued still run on the old one.
+
+    :keyword int workers: the number of jobs which run at the same time.
+    :keyword int queue_size: the number of jobs which may wait.
+    :return: the new settings.
+    :rtype: dict
+    """
+    global _pipeline
+    unknown = set(options) - set(_config)
+    if unknown:
+        raise TypeError(f'Unknown postprocessing options: {", ".join(sorted(unknown))}')
+    with _lock:
+        _config.update(options)
+        old, _pipeline = _pipeline, None
+    if old is not None:
+        threading.Thread(target=old.shutdown, daemon=True).start()
+    return dict(_config)
+
+
+def get_pipeline():
+    """ Get the pipeline shared by all downloads.
+
+    :rtype: Pipeline
+    """
+    global _pipeline
+    with _lock:
+        if _pipeline is None:
+            _pipeline = Pipeline(**_config)
+        return _pipeline
+
+
+def postprocess(output, files=None, **job):
+    """ Run a job on the shared pipeline and wait for it. This is the
+    default `postprocessing` of the downloads of `web_api`.
+
+    :param str output: the base path of the download.
+    :param list(tuple) files: the stream files, see `utils.merge_files`.
+    :return: the report, see `Pipeline.run`.
+    :rtype: list(dict)
+    :raises PostprocessingError: if a step failed.
+    """
+    return get_pipeline()(output, files, **job)
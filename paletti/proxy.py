@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+""" A local HTTP proxy which lets a player stream from the cache on disk, see
+`StreamProxy`.
+"""
+
+import hashlib
+import http.server
+import os
+import re
+import threading
+import time
+
+import urllib3.util
+
+import session
+import throttle
+from downloader import OutputFile, check_range_response, probe_size, stream_path
+from journal import get_journal
+
+
+def parse_range(header, size):
+    """ Parse the `Range` header of a request. Only the first range is used.
+
+    :param str header: the header, e.g. 'bytes=0-1023', 'bytes=1024-' or
+                       'bytes=-512'.
+    :param int size: the size of the file.
+    :return: the inclusive (start, end) byte positions, or None if the
+             range can't be satisfied.
+    :rtype: tuple(int, int)
+    """
+    match = re.match(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)', header)
+    if not match or not (match[1] or match[2]):
+        return None
+    if not match[1]:
+        start, end = max(size - int(match[2]), 0), size - 1
+    else:
+        start = int(match[1])
+        end = min(int(match[2]), size - 1) if match[2] else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+class CachedStream:
+    """ A stream file which is filled on demand. Missing parts are fetched
+    from the server, at least `read_ahead` bytes at a time, and recorded in
+    the journal of the download, so a `downloader.Download` to the same
+    output only fetches what is still missing. The file is sparse, so only
+    the parts which were played take up space.
+
+    :param dict stream: the stream dict.
+    :param str filepath: the stream file.
+    :param int size: the size of the stream.
+    :param Journal journal: the journal of the download.
+    :param int read_ahead: the minimum number of bytes per request.
+    """
+    # The size of the blocks which are read from the file and from the
+    # server.
+    block_size = 131_072
+
+    def __init__(self, stream, filepath, size, journal, read_ahead):
+        self.stream = stream
+        self.filepath = filepath
+        self.size = size
+        self.journal = journal
+        self.read_ahead = read_ahead
+        # The number of running reads and the time of the last one.
+        self.readers = 0
+        self.used = time.monotonic()
+        self._lock = threading.Lock()
+        self._state = threading.Lock()
+        if not journal.open(filepath, stream['url'], size):
+            with open(filepath, 'wb') as f:
+                f.truncate(size)
+        self._output = OutputFile(filepath, size, 'pwrite')
+
+    def __repr__(self):
+        return f'<CachedStream: {self.filepath}>'
+
+    def _fetch(self, start, end):
+        """ Download the bytes `start` to `end` (inclusive) into the file and
+        record them in the journal.
+
+        :raises ConnectionError: if the server answers with an error or
+                                 sends no data.
+        """
+        url = f'{self.stream["url"]}&range={start}-{end}'
+        host = urllib3.util.parse_url(url).host
+        response = session.get_pool(url).request('GET', url, preload_content=False)
+        try:
+            check_range_response(url, response.status,
+                                 response.headers.get('Content-Length'), start, end)
+        except ConnectionError:
+            response.close()
+            response.release_conn()
+            raise
+        written = 0
+        try:
+            for chunk in response.stream(self.block_size):
+                chunk = chunk[:end - start + 1 - written]
+                self._output.write(start + written, chunk)
+                written += len(chunk)
+                throttle.throttle(host, len(chunk))
+                if start + written > end:
+                    break
+        finally:
+            response.release_conn()
+            self.journal.add(self.filepath, start, start + written - 1)
+        if not written:
+            raise ConnectionError(f'No data received for {url}.')
+
+    def close(self):
+        self._output.close()
+
+    def read(self, start, end):
+        """ Read the bytes `start` to `end` (inclusive), from the file where
+        they are cached and from the server otherwise.
+
+        :param int start: the first byte.
+        :param int end: the last byte.
+        :return: a generator of blocks of bytes.
+        """
+        with self._state:
+            self.readers += 1
+        try:
+            yield from self._read(start, end)
+        finally:
+            with self._state:
+                self.readers -= 1
+                self.used = time.monotonic()
+
+    def _read(self, start, end):
+        position = start
+        while position <= end:
+            missing = self.journal.missing(self.filepath, position, end)
+            if missing and missing[0][0] == position:
+                # The gap is fetched into the file before it is served, so
+                # the lock isn't held while the player reads.
+                with self._lock:
+                    # Another request may have fetched it in the meantime.
+                    gaps = self.journal.missing(
+                        self.filepath, position,
+                        min(position + self.read_ahead - 1, self.size - 1))
+                    if gaps and gaps[0][0] == position:
+                        self._fetch(*gaps[0])
+                continue
+            cached_end = missing[0][0] - 1 if missing else end
+            # The open file is read, since a finished download removes the
+            # path after merging.
+            while position <= cached_end:
+                block = self._output.read(
+                    position, min(self.block_size, cached_end - position + 1))
+                if not block:
+                    raise OSError(f'{self.filepath} is shorter than expected.')
+                yield block
+                position += len(block)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self, body):
+        cached = self.server.streams.get(self.path.lstrip('/'))
+        if cached is None:
+            self.send_error(404)
+            return
+        start, end = 0, cached.size - 1
+        if 'Range' in self.headers:
+            requested = parse_range(self.headers['Range'], cached.size)
+            if requested is None:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{cached.size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = requested
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{cached.size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', f'video/{cached.stream["container"]}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        try:
+            for block in cached.read(start, end):
+                self.wfile.write(block)
+        except (BrokenPipeError, ConnectionResetError):
+            # The player has closed the connection, e.g. to seek.
+            pass
+        except Exception:
+            # The headers are sent already, so the connection is closed
+            # and the player may retry.
+            self.close_connection = True
+
+
+class StreamProxy:
+    """ A local HTTP server which serves streams to a player, like mpv, from
+    a cache on disk. Byte ranges which aren't cached yet are fetched from the
+    server when they are requested, so seeking back doesn't download
+    anything again. The cache is made of the stream files and the journal of
+    a `downloader.Download` with the same output, so a later download only
+    fetches what hasn't been played, and nothing once the streams were
+    played to the end.
+
+    :param int read_ahead: the minimum number of bytes which are fetched
+                           from the server at a time.
+    :param int port: the local port, by default a free one.
+    :param float idle_timeout: the time in seconds after which a stream
+                               which isn't read anymore is closed and
+                               removed from the proxy.
+    """
+    def __init__(self, read_ahead=4_194_304, port=0, idle_timeout=600):
+        self.read_ahead = read_ahead
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon_threads = True
+        self._server.streams = {}
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def __repr__(self):
+        return f'<StreamProxy: {self.address}, {len(self._server.streams)} streams>'
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def add(self, stream, output, size=None):
+        """ Make a stream available through the proxy.
+
+        :param dict stream: the stream dict.
+        :param str output: the base path of the download (see
+                           `downloader.Download`), i.e. the cache.
+        :param int size: the size of the stream, if it is known. Otherwise
+                         it is taken from the journal, the stream dict or
+                         the server.
+        :return: the local url of the stream.
+        :rtype: str
+        """
+        filepath = stream_path(output, stream)
+        key = hashlib.sha1(filepath.encode()).hexdigest()[:16]
+        key = f'{key}.{stream["container"]}'
+        journal = get_journal(f'{output}.journal')
+        size = size or journal.size(filepath, stream['url']) \
+            or stream.get('filesize') or probe_size(stream['url'])
+        with self._lock:
+            self._evict()
+            cached = self._server.streams.get(key)
+            if cached is None or cached.size != size \
+                    or cached.stream['url'] != stream['url'] \
+                    or not os.path.exists(filepath):
+                if cached is not None:
+                    cached.close()
+                cached = CachedStream(stream, filepath, size, journal,
+                                      self.read_ahead)
+                self._server.streams[key] = cached
+        return f'{self.address}/{key}'
+
+    def _evict(self):
+        """ Close and remove the streams which haven't been read for
+        `idle_timeout` seconds.
+        """
+        now = time.monotonic()
+        for key, cached in list(self._server.streams.items()):
+            if not cached.readers and now - cached.used > self.idle_timeout:
+                del self._server.streams[key]
+                cached.close()
+
+    def shutdown(self):
+        """ Stop the server and close the files.
+
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        for cached in self._server.streams.values():
+            cached.close()
+
+
+_proxy = None
+_lock = threading.Lock()
+
+
+def get_proxy():
+    """ Get the proxy shared by all players, which is started on first use.
+
+    :rtype: StreamProxy
+    """
+    global _proxy
+    with _lock:
+        if _proxy is None:
+            _proxy = StreamProxy()
+        return _proxy
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+""" The registry of installed plugins, which finds the plugin for a plugin
+name or url.
+"""
+
+import threading
+
+import urllib3.exceptions
+import urllib3.util
+
+import utils
+
+# Subdomains which are served by the same plugin as the bare domain.
+ALIAS_PREFIXES = ('www.', 'm.')
+
+
+def normalize_host(host):
+    """ Normalize a host for the lookup: lowercase, without a trailing dot
+    and without one of the `ALIAS_PREFIXES`.
+
+    :param str host: the host.
+    :rtype: str
+    """
+    host = host.lower().rstrip('.')
+    for prefix in ALIAS_PREFIXES:
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
+
+class PluginRegistry:
+    """ Maps plugin names and hosts to plugins. The plugins are found with
+    `utils.find_modules` on first use. A host in the `HOSTS` of a plugin
+    also matches its `www.` and `m.` subdomains, and a host like
+    `*.example.com` matches all subdomains of example.com.
+
+    The index is replaced as a whole when plugins are added, removed or
+    reloaded (see `refresh` and `watch`), so lookups don't need a lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._watcher = None
+
+    def __contains__(self, name):
+        return name in self._get()[0]
+
+    def __iter__(self):
+        return iter(list(self._get()[0].values()))
+
+    def __len__(self):
+        return len(self._get()[0])
+
+    def __repr__(self):
+        return f'<PluginRegistry: {len(self)} plugins>'
+
+    def _get(self):
+        index = self._index
+        if index is None:
+            with self._lock:
+                if self._index is None:
+                    self._set(utils.find_modules('plugins'))
+                index = self._index
+        return index
+
+    def _set(self, plugin_list):
+        names, hosts, wildcards = {}, {}, {}
+        for plugin in plugin_list:
+            names[plugin['name']] = plugin
+            for host in plugin['hosts']:
+                if host.startswith('*.'):
+                    wildcards[host[2:].lower()] = plugin
+                else:
+                    hosts[normalize_host(host)] = plugin
+        self._index = (names, hosts, wildcards)
+
+    def add(self, plugin):
+        """ Add a plugin, or replace the plugin with the same name.
+
+        :param dict plugin: the plugin dict, see `utils.find_modules`.
+        :return: None
+        """
+        self._get()
+        with self._lock:
+            plugins = dict(self._index[0])
+            plugins[plugin['name']] = plugin
+            self._set(plugins.values())
+
+    def find(self, plugin_name_or_url):
+        """ Find the plugin for a plugin name or url.
+
+        :param str plugin_name_or_url: the plugin name or url.
+        :return: the plugin dict.
+        :rtype: dict
+        :raises ModuleNotFoundError: if there is no plugin.
+        """
+        names, hosts, wildcards = self._get()
+        try:
+            host = urllib3.util.parse_url(plugin_name_or_url).host
+        except urllib3.exceptions.LocationParseError:
+            host = None
+        if host in names:
+            return names[host]
+        if host:
+            host = normalize_host(host)
+            if host in hosts:
+                return hosts[host]
+            labels = host.split('.')
+            for i in range(1, len(labels)):
+                plugin = wildcards.get('.'.join(labels[i:]))
+                if plugin is not None:
+                    return plugin
+        raise ModuleNotFoundError(f'No plugin found for {plugin_name_or_url}.')
+
+    def refresh(self):
+        """ Find the installed plugins again. Plugins whose file hasn't
+        changed are kept as they are. Changed plugins are replaced by a new
+        entry, whose module is imported on first use; calls which already
+        got the old module finish with it.
+
+        :return: the names of the added, changed and removed plugins.
+        :rtype: set(str)
+        """
+        plugin_list = utils.find_modules('plugins')
+        with self._lock:
+            old = self._index[0] if self._index is not None else {}
+            new = {}
+            for plugin in plugin_list:
+                current = old.get(plugin['name'])
+                if current is not None and \
+                        current.get('path') == plugin.get('path') and \
+                        current.get('version') == plugin.get('version'):
+                    plugin = current
+                new[plugin['name']] = plugin
+            self._set(new.values())
+        return {name for name in set(old) | set(new)
+                if old.get(name) is not new.get(name)}
+
+    def remove(self, name):
+        """ Remove a plugin.
+
+        :param str name: the plugin name.
+        :return: None
+        """
+        self._get()
+        with self._lock:
+            plugins = dict(self._index[0])
+            plugins.pop(name, None)
+            self._set(plugins.values())
+
+    def unwatch(self):
+        """ Stop watching the plugin folder.
+
+        :return: None
+        """
+        watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            watcher.set()
+
+    def watch(self, interval=5.0):
+        """ Watch the plugin folder in a background thread and `refresh` the
+        plugins every `interval` seconds, so long-running processes pick up
+        new and changed plugins. Only the modification times of the plugin
+        files are checked, unchanged plugins aren't imported again.
+
+        :param float interval: the interval in seconds.
+        :return: None
+        """
+        self.unwatch()
+        stop = self._watcher = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    # A plugin may be half-written right now, keep the
+                    # current plugins and try again later.
+                    pass
+
+        threading.Thread(target=run, daemon=True).start()
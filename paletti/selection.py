@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+""" The selection of audio and video streams from the stream dicts of the
+metadata, see `StreamIndex`.
+"""
+
+import re
+
+
+def quality_value(stream):
+    """ The numeric quality of a stream, e.g. 720 for '720p'. It is taken
+    from `quality_int`, which plugins may give as int or str, or else from
+    the digits of `quality`.
+
+    :param dict stream: the stream dict.
+    :rtype: int
+    """
+    try:
+        return int(stream.get('quality_int'))
+    except (TypeError, ValueError):
+        match = re.match(r'\d+', str(stream.get('quality', '')))
+        return int(match[0]) if match else 0
+
+
+def parse_quality(quality):
+    """ Parse a quality selector: 'best', an exact quality like '720p', or a
+    maximum like '<=720p' (or the int 720).
+
+    :param quality: the selector.
+    :return: the operator ('best', '==' or '<=') and the numeric quality,
+             which is None for an exact quality without a number.
+    :rtype: tuple(str, int)
+    """
+    if quality in (None, 'best'):
+        return 'best', 0
+    if isinstance(quality, int):
+        return '<=', quality
+    match = re.match(r'\s*(<=|≤)?\s*(\d+)', quality)
+    if not match:
+        return '==', None
+    return '<=' if match[1] else '==', int(match[2])
+
+
+class StreamIndex:
+    """ An index of the streams of one media item, which is built once and
+    answers the selections of `web_api.streams`. The streams are grouped by
+    (type, container) and sorted by their numeric quality, best first, and
+    every (type, container, quality) has a direct entry.
+
+    :param list(dict) streams: the stream dicts of the metadata.
+    """
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self._groups = {}
+        self._exact = {}
+        ranked = sorted(self.streams, key=lambda s: (quality_value(s),
+                                                     s.get('bitrate') or 0),
+                        reverse=True)
+        for stream in ranked:
+            for key in ((stream['type'], stream['container']),
+                        (stream['type'], None)):
+                self._groups.setdefault(key, []).append(stream)
+            self._exact.setdefault(
+                (stream['type'], stream['container'], stream['quality']), stream)
+
+    def __repr__(self):
+        return f'<StreamIndex: {len(self.streams)} streams>'
+
+    def select(self, type_, quality='best', container='webm', codecs=None,
+               max_bitrate=None):
+        """ Select a stream. If there is no stream of the type, an
+        'audio+video' stream is used for video; if there is none in the
+        container, another container is used for video. If the quality is
+        not available, the best one is used.
+
+        :param str type_: 'audio', 'video' or 'audio+video'.
+        :param quality: 'best', an exact quality like '720p', or the best
+                        quality up to a limit like '<=720p'.
+        :param str container: the container format, e.g. 'webm'.
+        :param list(str) codecs: the preferred codecs, most preferred first.
+                                 Streams with other codecs are only used if
+                                 none of these is available.
+        :param int max_bitrate: the maximum bitrate. Streams without a
+                                bitrate are not limited. If every stream
+                                exceeds it, the one with the lowest bitrate
+                                is used.
+        :return: the stream dict, or None.
+        :rtype: dict
+        """
+        kind = type_
+        if not self._groups.get((kind, None)):
+            if type_ == 'audio':
+                return None
+            kind = 'audio+video'
+        result = self._groups.get((kind, container))
+        if not result and type_ == 'video':
+            kind = 'audio+video'
+            result = self._groups.get((kind, None))
+        if not result:
+            print(f'Container {container} not available, choosing another one.')
+            return None
+        op, value = parse_quality(quality)
+        if op == '==' and not codecs and not max_bitrate:
+            stream = self._exact.get((kind, container, quality))
+            if stream is not None:
+                return stream
+        if max_bitrate:
+            limited = [s for s in result
+                       if not s.get('bitrate') or s['bitrate'] <= max_bitrate]
+            result = limited or [min(result, key=lambda s: s['bitrate'])]
+        if codecs:
+            for codec in codecs:
+                preferred = [s for s in result if s.get('codec') == codec]
+                if preferred:
+                    result = preferred
+                    break
+        if op == '==':
+            exact = [s for s in result if s['quality'] == quality
+                     or value is not None and quality_value(s) == value]
+            return exact[0] if exact else result[0]
+        if op == '<=':
+            limited = [s for s in result if quality_value(s) <= value]
+            return limited[0] if limited else result[-1]
+        return result[0]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+""" The HTTP session shared by all paletti modules and plugins. Connections
+are kept alive and reused across calls, so every module (and plugin) should
+send its requests through `request` or the pool from `get_pool`, instead of
+creating its own `urllib3.PoolManager`.
+"""
+
+import threading
+
+import urllib3
+
+_config = {'num_pools': 20,
+           'maxsize': 10,
+           'host_maxsize': {},
+           'timeout': 30.0,
+           'retries': 3,
+           'backoff_factor': 0.5,
+           'proxy': None}
+_lock = threading.Lock()
+_pools = {}
+
+
+def _new_pool(maxsize):
+    kwargs = {'num_pools': _config['num_pools'],
+              'maxsize': maxsize,
+              'timeout': urllib3.Timeout(total=_config['timeout']),
+              'retries': urllib3.Retry(total=_config['retries'],
+                                       backoff_factor=_config['backoff_factor'],
+                                       status_forcelist=(500, 502, 503, 504),
+                                       raise_on_status=False)}
+    if _config['proxy']:
+        return urllib3.ProxyManager(_config['proxy'], **kwargs)
+    return urllib3.PoolManager(**kwargs)
+
+
+def configure(**options):
+    """ Change the session settings. Existing connections are closed, new
+    ones use the new settings.
+
+    :keyword int num_pools: the number of hosts to keep connections for.
+    :keyword int maxsize: the number of connections kept per host.
+    :keyword dict host_maxsize: a different `maxsize` for single hosts, e.g.
+                                `{'example.com': 32}`.
+    :keyword float timeout: the timeout of a request in seconds.
+    :keyword int retries: the number of retries for failed requests.
+    :keyword float backoff_factor: the backoff between retries, see
+                                   `urllib3.Retry`.
+    :keyword str proxy: the url of an HTTP proxy, or None.
+    :return: the new settings.
+    :rtype: dict
+    """
+    unknown = set(options) - set(_config)
+    if unknown:
+        raise TypeError(f'Unknown session options: {", ".join(sorted(unknown))}')
+    with _lock:
+        _config.update(options)
+        for pool in _pools.values():
+            pool.clear()
+        _pools.clear()
+    return dict(_config)
+
+
+def get_pool(url=None):
+    """ Get the connection pool for a url. Hosts with their own `maxsize`
+    have a pool of their own, all other hosts share one.
+
+    :param str url: the url, or None for the shared pool.
+    :rtype: urllib3.PoolManager
+    """
+    host = urllib3.util.parse_url(url).host if url else None
+    if host not in _config['host_maxsize']:
+        host = None
+    pool = _pools.get(host)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(host)
+            if pool is None:
+                pool = _new_pool(_config['host_maxsize'].get(host, _config['maxsize']))
+                _pools[host] = pool
+    return pool
+
+
+def request(method, url, **kwargs):
+    """ Send a request through the shared session. The keyword arguments are
+    passed on to `urllib3.PoolManager.request`.
+
+    :param str method: the HTTP method.
+    :param str url: the url.
+    :rtype: urllib3.response.HTTPResponse
+    """
+    return get_pool(url).request(method, url, **kwargs)
+
+
+def settings():
+    """ The current session settings, see `configure`.
+
+    :rtype: dict
+    """
+    return dict(_config)
+
+
+def stats():
+    """ The connection statistics of every host. The number of reused
+    connections is the number of requests minus the number of new
+    connections.
+
+    :return: a dict for every host, with the number of `connections` opened,
+             `requests` sent and `idle` connections.
+    :rtype: dict
+    """
+    result = {}
+    with _lock:
+        managers = list(_pools.values())
+    for manager in managers:
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            host = f'{key.key_scheme}://{key.key_host}:{key.key_port}'
+            entry = result.setdefault(host, {'connections': 0, 'requests': 0,
+                                             'idle': 0})
+            entry['connections'] += pool.num_connections
+            entry['requests'] += pool.num_requests
+            entry['idle'] += len([c for c in list(pool.pool.queue) if c]) if pool.pool else 0
+    return result
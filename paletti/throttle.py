@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+""" Bandwidth limits shared by all downloads of the process. There is one
+total limit and an optional limit per host; both can be changed at any
+time, also while downloads are running.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """ A token bucket which hands out bytes at a fixed rate. Consumers
+    reserve their bytes in the order they arrive and then wait until the
+    reservation is covered, so all streams get a fair share of the rate.
+
+    :param int rate: the rate in bytes per second, or None for no limit.
+    :param int burst: the maximum number of bytes which can be consumed at
+                      once after an idle period. Default: one second's worth.
+    """
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def __repr__(self):
+        return f'<TokenBucket: {self.rate} bytes/s>'
+
+    def reserve(self, n):
+        """ Take `n` bytes from the bucket.
+
+        :param int n: the number of bytes.
+        :return: the time in seconds the caller has to wait before it may
+                 transfer the bytes.
+        :rtype: float
+        """
+        if self.rate is None:
+            return 0.0
+        with self._lock:
+            rate = self.rate
+            if rate is None:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / rate
+
+    def set_rate(self, rate, burst=None):
+        """ Change the rate.
+
+        :param int rate: the rate in bytes per second, or None for no limit.
+        :param int burst: the burst size in bytes. Default: the rate.
+        :return: None
+        """
+        with self._lock:
+            if rate is None or self.rate is None:
+                self._tokens = 0.0
+            else:
+                # Bring the tokens up to date with the old rate first, so a
+                # reserved debt is paid off at the new rate.
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self.rate = rate
+            self.burst = burst or rate
+            if self.burst is not None:
+                self._tokens = min(self._tokens, self.burst)
+            self._updated = time.monotonic()
+
+
+total = TokenBucket()
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def delay(host, n):
+    """ Reserve `n` bytes from the total and the host limit.
+
+    :param str host: the host the bytes come from.
+    :param int n: the number of bytes.
+    :return: the time in seconds to wait before the bytes may be used.
+    :rtype: float
+    """
+    wait = total.reserve(n)
+    bucket = _hosts.get(host)
+    if bucket is not None:
+        wait = max(wait, bucket.reserve(n))
+    return wait
+
+
+def limit(rate, host=None, burst=None):
+    """ Set the total bandwidth limit, or the limit of a single host.
+
+    :param int rate: the rate in bytes per second, or None for no limit.
+    :param str host: the host. Default: the total limit for all hosts.
+    :param int burst: the burst size in bytes (see `TokenBucket`).
+    :return: None
+    """
+    if host is None:
+        total.set_rate(rate, burst)
+        return
+    with _hosts_lock:
+        if rate is None:
+            _hosts.pop(host, None)
+        elif host in _hosts:
+            _hosts[host].set_rate(rate, burst)
+        else:
+            _hosts[host] = TokenBucket(rate, burst)
+
+
+def throttle(host, n):
+    """ Block until `n` bytes from `host` may be used.
+
+    :param str host: the host the bytes come from.
+    :param int n: the number of bytes.
+    :return: None
+    """
+    wait = delay(host, n)
+    if wait:
+        time.sleep(wait)
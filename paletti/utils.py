@@ -1,65 +1,183 @@
 #!/usr/bin/env python
 
+import ast
 import importlib
 import importlib.util
+import json
 import os
 import pathlib
 import re
 import subprocess
 import sys
+import threading
 
 PATH = os.path.dirname(__file__)
 sys.path.append(PATH)
 PLUGIN_FOLDER = os.path.join(PATH, 'plugins')
+MANIFEST_NAME = '.manifest.json'
+
+_plugin_lock = threading.RLock()
+
+
+class Plugin(dict):
+    """ The data of a plugin: its `name`, `hosts`, stream `type`, `path` and
+    `version` (which changes with the file). The plugin module is only
+    imported when the `module` key is accessed for the first time; it has
+    the version as `__plugin_version__` attribute.
+    """
+    def __missing__(self, key):
+        if key != 'module':
+            raise KeyError(key)
+        with _plugin_lock:
+            if 'module' not in self:
+                mod = load_plugin(self['path'])
+                mod.__plugin_version__ = self.get('version')
+                self['module'] = mod
+            return dict.__getitem__(self, 'module')
+
+    def __repr__(self):
+        return f'<Plugin: {self["name"]}>'
+
+
+def _read_manifests():
+    try:
+        with open(os.path.join(PLUGIN_FOLDER, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifests(manifests):
+    path = os.path.join(PLUGIN_FOLDER, MANIFEST_NAME)
+    try:
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(manifests, f)
+        os.replace(f'{path}.tmp', path)
+    except OSError:
+        # The plugin folder may be read-only; the manifests are read from
+        # the plugins again next time.
+        pass
 
 
 def find_modules(type_):
+    """ Find the plugins or the plugin tests. Plugins are not imported, their
+    `HOSTS` and `STREAM_TYPE` are read from the source (see `read_manifest`)
+    and cached in the manifest file of the plugin folder until the plugin
+    file changes.
+
+    :param str type_: either 'plugins' or 'tests'.
+    :return: a `Plugin` for every plugin, or a dict for every test module.
+    :rtype: list(dict)
+    """
     plugin_list = []
     plugin_folder = pathlib.Path(PLUGIN_FOLDER)
     directories = os.listdir(plugin_folder)
+    manifests = _read_manifests() if type_ == 'plugins' else {}
+    changed = False
     for d in directories:
-        if str(d).startswith('_') and (type_ != 'tests'):
+        if str(d).startswith('.') or (str(d).startswith('_') and type_ != 'tests'):
             continue
         subfolder = plugin_folder / d
-        # Temporarily add the folder to sys.path so the tests will find
-        # everything.
-        if str(subfolder) not in sys.path:
-            sys.path.insert(0, str(subfolder))
+        if not subfolder.is_dir():
+            continue
         files = [f for f in os.listdir(subfolder) if not f.startswith('__')]
         for plugin_file in files:
             if type_ == 'plugins':
-                if plugin_file.startswith('test_'):
+                if plugin_file.startswith('test_') \
+                        or not plugin_file.endswith('.py'):
                     continue
                 name = plugin_file.split('.')[0]
-                mod = load_module_from_file(subfolder / plugin_file)
-                plugin_data = {'name': name,
-                               'module': mod,
-                               'hosts': mod.HOSTS,
-                               'type': mod.STREAM_TYPE}
+                path = subfolder / plugin_file
+                stat = os.stat(path)
+                entry = manifests.get(str(path))
+                if not entry or entry['mtime'] != stat.st_mtime_ns \
+                        or entry['size'] != stat.st_size:
+                    entry = dict(read_manifest(path), mtime=stat.st_mtime_ns,
+                                 size=stat.st_size)
+                    manifests[str(path)] = entry
+                    changed = True
+                plugin_data = Plugin(name=name, path=str(path),
+                                     hosts=entry['hosts'], type=entry['type'],
+                                     version=f'{entry["mtime"]}-{entry["size"]}')
                 plugin_list.append(plugin_data)
             if type_ == 'tests':
                 if not plugin_file.startswith('test_'):
                     continue
                 name = plugin_file.split('.')[0]
                 importlib.invalidate_caches()
-                mod = load_module_from_file(subfolder / plugin_file)
+                # The folder is on sys.path meanwhile, so the tests will find
+                # everything.
+                mod = load_plugin(subfolder / plugin_file)
                 plugin_data = {'name': name,
                                'plugin': subfolder.parts[-1],
                                'type': name.replace('test_', ''),
                                'module': mod}
                 plugin_list.append(plugin_data)
-        while str(subfolder) in sys.path:
-            sys.path.remove(str(subfolder))
+    if type_ == 'plugins':
+        paths = {p['path'] for p in plugin_list}
+        if changed or set(manifests) - paths:
+            _write_manifests({k: v for k, v in manifests.items() if k in paths})
     return plugin_list
 
 
+def load_plugin(path):
+    """ Import a plugin module. Its folder is on `sys.path` meanwhile, so the
+    plugin can import its own modules.
+
+    :param str path: the path of the plugin file.
+    :return: the module.
+    """
+    folder = str(pathlib.Path(path).parent)
+    with _plugin_lock:
+        sys.path.insert(0, folder)
+        try:
+            return load_module_from_file(path)
+        finally:
+            sys.path.remove(folder)
+
+
 def load_module_from_file(path):
-    spec = importlib.util.spec_from_file_location('name', path)
+    """ Import a python file as a new module object. The module is named
+    after its folder and file, e.g. `plugins.foo.foo`, but it isn't added to
+    `sys.modules`, so every call returns a fresh module.
+
+    :param str path: the path of the file.
+    :return: the module.
+    """
+    path = pathlib.Path(path)
+    name = f'plugins.{path.parent.name}.{path.stem}'
+    spec = importlib.util.spec_from_file_location(name, path)
     mod = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(mod)
     return mod
 
 
+def read_manifest(path):
+    """ Read `HOSTS` and `STREAM_TYPE` of a plugin without importing it. Both
+    should be assigned literal values at the module level; otherwise the
+    plugin has to be imported to read them.
+
+    :param str path: the path of the plugin file.
+    :return: the `hosts` and the stream `type`.
+    :rtype: dict
+    """
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), str(path))
+    values = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in ('HOSTS', 'STREAM_TYPE'):
+                    try:
+                        values[target.id] = ast.literal_eval(node.value)
+                    except ValueError:
+                        pass
+    if 'HOSTS' not in values or 'STREAM_TYPE' not in values:
+        mod = load_plugin(path)
+        values = {'HOSTS': mod.HOSTS, 'STREAM_TYPE': mod.STREAM_TYPE}
+    return {'hosts': list(values['HOSTS']), 'type': values['STREAM_TYPE']}
+
+
 def make_filename(title):
     """ Create a descriptive and safe filename from the title.
 
@@ -70,39 +188,54 @@ def make_filename(title):
     return re.sub('[^a-zA-z0-9]+', '_', title)
 
 
-def merge_files(path):
+def merge_files(path, files=None):
     """ Merge video and audio files after downloading.
 
     :param str path: the base path, minus file extensions.
-    :return: None
+    :param list(tuple) files: the stream files as (path, container, type,
+                              codec) tuples. Default: the files named
+                              `{path}.{container}.{type}.{codec}` in the
+                              folder of `path`.
+    :return: the path of the output file.
+    :rtype: str
+    :raises subprocess.CalledProcessError: if ffmpeg fails.
     """
     p = pathlib.Path(path)
     folder = p.parent
     filename = p.parts[-1]
-    audio, video = '', ''
-    for item in os.listdir(folder):
-        properties = item.split('.')
-        try:
-            if properties[2] in ['audio', 'video'] and properties[0] == filename:
-                name, container, type_, codec = properties
-            else:
+    if files is None:
+        files = []
+        for item in os.listdir(folder):
+            if not item.startswith(f'{filename}.'):
                 continue
-        except IndexError:
+            # The codec may contain dots, e.g. 'avc1.4d401f'.
+            properties = item[len(filename) + 1:].split('.', 2)
+            if len(properties) == 3:
+                files.append((folder / item, *properties))
+    audio, video = '', ''
+    for item, container, type_, codec in files:
+        if type_ not in ('audio', 'video', 'audio+video'):
             continue
-        out_file = folder / f'{filename}.{container}'
         if type_ == 'audio':
-            audio = folder / item
-        if type_ == 'video' or type_ == 'audio+video':
-            video = folder / item
+            audio, audio_codec = item, codec
+        else:
+            video, video_codec = item, codec
+        out_file = folder / f'{filename}.{container}'
     if audio and video:
-        subprocess.call(f'ffmpeg -i {audio} -i {video} -c:a copy -c:v copy {out_file}',
-                        shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cmd = ['ffmpeg', '-y', '-i', str(audio), '-i', str(video),
+               '-c:a', 'copy', '-c:v', 'copy', str(out_file)]
+        returncode = subprocess.call(cmd, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
         os.remove(audio)
         os.remove(video)
     elif audio:
-        out_file = folder / f'{filename}.{codec}'
+        out_file = folder / f'{filename}.{audio_codec}'
         os.rename(audio, out_file)
     elif video:
-        out_file = folder / f'{filename}.{codec}'
+        out_file = folder / f'{filename}.{video_codec}'
         os.rename(video, out_file)
-    return str(out_file)
\ No newline at end of file
+    else:
+        return None
+    return str(out_file)
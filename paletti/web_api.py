@@ -3,59 +3,169 @@
 """ Provide an easy and intuitive way to fetch data from streaming
 websites. """
 
+import asyncio
+import concurrent.futures
 import functools
 import os
+import pickle
+import queue
 import subprocess
+import threading
+import time
+import types
+import urllib.parse
 from tempfile import gettempdir
 from pathlib import Path
 
 import urllib3
 import urllib3.util
+import caching
+import postprocessing
+import proxy
+import registry
+import selection
+import session
+import throttle
 import utils
+from async_downloader import AsyncDownload
 from downloader import Download
 
 urllib3.disable_warnings()
 
+METADATA_TTL = 21600
+STREAMS_TTL = 1800
+STREAM_EXPIRY_MARGIN = 300
+METADATA_BATCH_SIZE = 50
 
-def cache(func):
-    """ A decorator function which caches the results of requests.
+_metadata_flight = caching.SingleFlight()
+plugins = registry.PluginRegistry()
+
+
+def _cache_key(func, args, kwargs):
+    # Plugins are passed as modules, which are keyed by their name and
+    # version, so results of a plugin are not used after it was reloaded.
+    args = tuple(f'{a.__name__}@{getattr(a, "__plugin_version__", None)}'
+                 if isinstance(a, types.ModuleType) else a for a in args)
+    key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        key = repr(key)
+    return key
+
+
+def _metadata_ttl(item):
+    """ The time to live of a metadata dict in the cache. Stream urls
+    usually expire after some time, which is given by an `expire` timestamp
+    in the url, so metadata with streams is only kept until then.
+
+    :param dict item: the metadata.
+    :return: the time to live in seconds.
+    :rtype: float
+    """
+    if not isinstance(item, dict):
+        return METADATA_TTL
+    streams_ = item.get('streams') or []
+    expires = []
+    for stream in streams_:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(stream.get('url', '')).query)
+        if 'expire' in query and query['expire'][0].isdigit():
+            expires.append(int(query['expire'][0]))
+    if expires:
+        return max(0, min(expires) - time.time() - STREAM_EXPIRY_MARGIN)
+    return STREAMS_TTL if streams_ else METADATA_TTL
+
+
+def cache(func=None, maxsize=1024, ttl=None):
+    """ A decorator function which caches the results of requests. It can be
+    used as `@cache`, or with options as `@cache(maxsize=100, ttl=60)`. The
+    in-memory cache of a decorated function is available as its `cache`
+    attribute. If a cache directory is configured (see `configure_cache`),
+    results are also stored there and shared with other processes.
+    Concurrent calls with the same arguments call the function only once.
+    The `lookup` and `put` attributes of the decorated function read and
+    write the cache directly.
 
     :param callable func: the decorated function.
+    :param int maxsize: the maximum number of cached results. The least
+                        recently used results are evicted first.
+    :param ttl: the time to live of a result in seconds, a callable which
+                returns the time to live for a result, or None if results
+                never expire.
     :return: the wrapper.
     :rtype: callable
     """
-    cache_list = []
+    if func is None:
+        return functools.partial(cache, maxsize=maxsize, ttl=ttl)
+    store = caching.LRUCache(maxsize)
+    flight = caching.SingleFlight()
+
+    def cached(key, count=True):
+        media_item = store.get(key, caching.MISSING, count=count)
+        if media_item is not caching.MISSING:
+            return media_item
+        backend = caching.get_backend()
+        entry = caching.MISSING if backend is None else backend.lookup(key)
+        if entry is caching.MISSING:
+            return entry
+        media_item, item_ttl = entry
+        store.set(key, media_item, item_ttl)
+        return media_item
+
+    def save(key, media_item):
+        item_ttl = ttl(media_item) if callable(ttl) else ttl
+        store.set(key, media_item, item_ttl)
+        backend = caching.get_backend()
+        if backend is not None:
+            try:
+                backend.set(key, media_item, item_ttl)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # Results which can't be stored are only cached in memory.
+                pass
+
+    def load(key, args, kwargs):
+        # Another thread may have loaded it in the meantime.
+        media_item = cached(key, count=False)
+        if media_item is caching.MISSING:
+            media_item = func(*args, **kwargs)
+            save(key, media_item)
+        return media_item
 
     @functools.wraps(func)
-    def wrapper(*args):
-        for item in cache_list:
-            if item['url'] == args[1]:
-                return item
-        media_item = func(*args)
-        cache_list.append(media_item)
+    def wrapper(*args, **kwargs):
+        key = _cache_key(func, args, kwargs)
+        media_item = store.get(key, caching.MISSING)
+        if media_item is caching.MISSING:
+            # Concurrent calls for the same key wait for one lookup.
+            media_item = flight.do(key, load, key, args, kwargs)
         return media_item
 
+    def lookup(*args, **kwargs):
+        """ Get the cached result for the arguments without calling the
+        function, or `caching.MISSING`. """
+        return cached(_cache_key(func, args, kwargs))
+
+    def put(media_item, *args, **kwargs):
+        """ Cache a result for the arguments. """
+        save(_cache_key(func, args, kwargs), media_item)
+
+    wrapper.cache = store
+    wrapper.lookup = lookup
+    wrapper.put = put
     return wrapper
 
 
 def module(func):
     """ A decorator function which provides the necessary plugin modules.
+    The plugin is looked up in the shared `plugins` registry.
 
     :param callable func: the decorated function.
     :return: the wrapper.
     :rtype: callable
     """
-    plugin_list = utils.find_modules('plugins')
-
     @functools.wraps(func)
     def wrapper(plugin_name_or_url, *args, **kwargs):
-        host = urllib3.util.parse_url(plugin_name_or_url).host
-        for item in plugin_list:
-            if host == item['name'] or host in item['hosts']:
-                mod = item['module']
-                break
-        else:
-            raise ModuleNotFoundError
+        mod = plugins.find(plugin_name_or_url)['module']
         if not args:
             args = (plugin_name_or_url,)
         return func(mod, *args, **kwargs)
@@ -64,37 +174,18 @@ def module(func):
 
 
 def _filter_stream(streams_, type_, quality, container):
-    """ Look up the properties of the video streams and filter by keyword
-    arguments. A certain level of interpretation is used, if the exact stream
-    is not found. It will only return None if the container format
-    is not provided.
-
-    :param tuple(str) args: an arbitrary number of values. Last argument is the
-                            dict.
-    :return: True if all values were present, False otherwise.
-    :rtype: bool
-    """
-    streams_ = sorted(streams_, key=lambda k: k['quality_int'], reverse=True)
-    result = [s for s in streams_ if s['type'] == type_]
-    if not result:
-        if type_ == 'audio':
-            return None
-        result = [s for s in streams_ if s['type'] == 'audio+video']
-    result_ = [s for s in result if s['container'] == container]
-    if not result_:
-        if type_ == 'video':
-            result_ = [s for s in streams_ if s['type'] == 'audio+video']
-        if not result_:
-            print(f'Container {container} not available, choosing another one.')
-            return None
-    best_available = result_[0]['quality']
-    if quality == 'best':
-        result__ = [s for s in result_ if s['quality'] == best_available]
-    else:
-        result__ = [s for s in result_ if s['quality'] == quality]
-        if not result__:
-            result__ = [s for s in result_ if s['quality'] == best_available]
-    return result__[0]
+    """ Select a stream of a type from a list of stream dicts, see
+    `selection.StreamIndex.select`. `streams` uses the cached index of the
+    metadata instead.
+
+    :param list(dict) streams_: the stream dicts.
+    :param str type_: the stream type.
+    :param str quality: the quality.
+    :param str container: the container format.
+    :return: the stream dict, or None.
+    :rtype: dict
+    """
+    return selection.StreamIndex(streams_).select(type_, quality, container)
 
 
 @module
@@ -120,16 +211,14 @@ def channel(plugin, url):
     raise NotImplementedError
 
 
-def download(media_url, folder, audio=True, video=True, subtitles=False, **kwargs):
-    """ Download the streams for the media url.
+def _download_args(media_url, folder, audio, video, subtitles,
+                   embed_thumbnail=False, **kwargs):
+    """ Select the streams and the output path for a download, and write
+    the subtitles if requested.
 
-    :param str media_url: the url.
-    :param str folder: the local folder for the output.
-    :param bool audio: download audio.
-    :param bool video: download video.
-    :param bool subtitles: download subtitles.
-    :param kwargs: additional video properties (see `streams`).
-    :return: a `Download` instance.
+    :return: the stream dicts, the output path and the postprocessing, or
+             None if the requested streams are not available.
+    :rtype: tuple(list(dict), str, callable)
     """
     streams_dict = streams(media_url, **kwargs)
     md = metadata(media_url)
@@ -142,17 +231,117 @@ def download(media_url, folder, audio=True, video=True, subtitles=False, **kwarg
     if not audio:
         streams_dict[0] = None
     filepath = os.path.join(folder, fn)
+    job = {}
     if subtitles:
         subs = _subtitles(media_url, lang=subtitles)
         if subs:
             with open(f'{filepath}.srt', 'w') as f:
                 f.write(subs)
-    d = Download(streams_dict, f'{filepath}', utils.merge_files)
+            job['subtitles'] = f'{filepath}.srt'
+    if embed_thumbnail:
+        job['thumbnail'] = thumbnail(media_url, size='big')
+    return streams_dict, filepath, functools.partial(postprocessing.postprocess, **job)
+
+
+def configure_cache(directory=None, maxsize=65536):
+    """ Store the results of `metadata` and other cached lookups in a
+    database in `directory`, in addition to memory. All processes which use
+    the same directory share the cached results, also across restarts.
+
+    :param str directory: the cache directory, or None to cache in memory
+                          only.
+    :param int maxsize: the maximum number of results in the database.
+    :return: None
+    """
+    caching.configure(directory=directory, maxsize=maxsize)
+
+
+def configure_postprocessing(workers=2, queue_size=16):
+    """ Set the size of the postprocessing pipeline shared by all downloads.
+
+    :param int workers: the number of downloads which are postprocessed
+                        (i.e. the number of ffmpeg processes) at the same
+                        time.
+    :param int queue_size: the number of finished downloads which may wait
+                           for a worker; further downloads block until
+                           there is room.
+    :return: None
+    """
+    postprocessing.configure(workers=workers, queue_size=queue_size)
+
+
+def download(media_url, folder, audio=True, video=True, subtitles=False,
+             segments=1, output_mode='file', embed_thumbnail=False, mux=False,
+             strategy='parallel', **kwargs):
+    """ Download the streams for the media url. Once the download is
+    finished, the streams are merged and the subtitles and thumbnail are
+    embedded on the shared postprocessing pipeline (see
+    `configure_postprocessing`).
+
+    :param str media_url: the url.
+    :param str folder: the local folder for the output.
+    :param bool audio: download audio.
+    :param bool video: download video.
+    :param str subtitles: the language of the subtitles to download and
+                          embed, or False.
+    :param int segments: the number of parallel byte ranges per stream.
+    :param str output_mode: how the files are written: 'file', 'pwrite' or
+                            'mmap' (see `downloader.OutputFile`).
+    :param bool embed_thumbnail: embed the thumbnail as cover art.
+    :param bool mux: remux audio and video into the final file while they
+                     are downloaded, if their containers allow it (see
+                     `downloader.Download`).
+    :param str strategy: 'parallel' for the best throughput, or
+                         'sequential' to make the beginning playable as
+                         early as possible (see `downloader.Download`).
+    :param kwargs: additional video properties (see `streams`).
+    :return: a `Download` instance.
+    """
+    args = _download_args(media_url, folder, audio, video, subtitles,
+                          embed_thumbnail, **kwargs)
+    if not args:
+        return None
+    streams_dict, filepath, pp = args
+    d = Download(streams_dict, f'{filepath}', pp,
+                 segments=segments, output_mode=output_mode, mux=mux,
+                 strategy=strategy)
     return d
 
 
+async def download_async(media_url, folder, audio=True, video=True,
+                         subtitles=False, segments=1, output_mode='pwrite',
+                         embed_thumbnail=False, **kwargs):
+    """ The asyncio version of `download`. The plugin is queried in the
+    default executor, the streams are analyzed with non-blocking requests.
+
+    :return: an `AsyncDownload` instance, call `start()` or await `run()`.
+    """
+    loop = asyncio.get_event_loop()
+    args = await loop.run_in_executor(None, functools.partial(
+        _download_args, media_url, folder, audio, video, subtitles,
+        embed_thumbnail, **kwargs))
+    if not args:
+        return None
+    streams_dict, filepath, pp = args
+    d = AsyncDownload(streams_dict, f'{filepath}', pp,
+                      segments=segments, output_mode=output_mode)
+    await d.analyze()
+    return d
+
+
+def limit_bandwidth(rate, host=None):
+    """ Limit the bandwidth of all downloads together, or of all downloads
+    from one host. The limit applies to running downloads as well.
+
+    :param int rate: the limit in bytes per second, or None to remove it.
+    :param str host: the host. Default: the limit for all hosts.
+    :return: None
+    """
+    throttle.limit(rate, host)
+
+
 @module
-@cache
+@cache(maxsize=4096, ttl=_metadata_ttl)
 def metadata(plugin, media_url):
     """ Fetch information for the specified media url and return a
     dict.
@@ -164,12 +353,119 @@ def metadata(plugin, media_url):
     return plugin.get_metadata(media_url)
 
 
-def play(media_url, **kwargs):
-    audio, video = streams(media_url, **kwargs)
-    audio_stream = audio['url']
-    video_stream = video['url']
-    cmd = f'mpv "{video_stream}" --audio-file "{audio_stream}"'
-    subprocess.Popen(cmd, shell=True)#, stdout=subprocess.PIPE)
+async def metadata_async(media_url):
+    """ The asyncio version of `metadata`. Since the plugins are blocking,
+    the lookup runs in the default executor. Concurrent calls for the same
+    url share one lookup.
+
+    :param str media_url: the url of the media page.
+    :rtype: dict
+    """
+    loop = asyncio.get_event_loop()
+    return await _metadata_flight.do_async(
+        media_url, lambda: loop.run_in_executor(None, metadata, media_url))
+
+
+@module
+def _plugin(plugin, media_url):
+    return plugin
+
+
+def _metadata_bulk(plugin, urls):
+    result = plugin.get_metadata_many(urls)
+    for url, item in result.items():
+        metadata.put(item, plugin, url)
+    return result
+
+
+def metadata_many(urls, max_workers=8):
+    """ Fetch the metadata of many media urls at the same time. Cached
+    results are returned first, the others are fetched on a pool of
+    `max_workers` threads. If a plugin has a `get_metadata_many(urls)`
+    function, which returns a dict of url and metadata, its urls are fetched
+    in batches of `METADATA_BATCH_SIZE` through it.
+
+    :param list(str) urls: the media urls. Every url is only fetched and
+                           returned once.
+    :param int max_workers: the maximum number of concurrent fetches.
+    :return: a generator of (url, metadata, error) tuples in the order the
+             results arrive. Either the metadata or the exception is None.
+    :rtype: generator
+    """
+    groups = {}
+    for url in dict.fromkeys(urls):
+        try:
+            plugin = _plugin(url)
+        except ModuleNotFoundError as e:
+            yield url, None, e
+            continue
+        item = metadata.lookup(plugin, url)
+        if item is not caching.MISSING:
+            yield url, item, None
+        else:
+            groups.setdefault(id(plugin), (plugin, []))[1].append(url)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+    jobs = {}
+    try:
+        for plugin, group in groups.values():
+            if hasattr(plugin, 'get_metadata_many'):
+                for i in range(0, len(group), METADATA_BATCH_SIZE):
+                    batch = group[i:i + METADATA_BATCH_SIZE]
+                    jobs[pool.submit(_metadata_bulk, plugin, batch)] = batch
+            else:
+                for url in group:
+                    jobs[pool.submit(metadata, url)] = url
+        for job in concurrent.futures.as_completed(jobs):
+            urls_ = jobs[job]
+            try:
+                result = job.result()
+            except Exception as e:
+                for url in [urls_] if isinstance(urls_, str) else urls_:
+                    yield url, None, e
+                continue
+            if isinstance(urls_, str):
+                yield urls_, result, None
+                continue
+            for url in urls_:
+                if url in result:
+                    yield url, result[url], None
+                else:
+                    yield url, None, KeyError(url)
+    finally:
+        # The lookups which haven't started yet are dropped when the caller
+        # stops early.
+        for job in jobs:
+            job.cancel()
+        pool.shutdown(wait=False)
+
+
+def play(media_url, folder=None, **kwargs):
+    """ Play the media url with mpv. The streams are played through the local
+    caching proxy (see `proxy.StreamProxy`), which keeps what has been
+    played in `folder`. Seeking back doesn't fetch anything again, and a
+    later `download` to the same folder only fetches what is still missing.
+    The cache (the stream files and the journal) stays in the folder until
+    such a download finishes, or until it is deleted.
+
+    :param str media_url: the url.
+    :param str folder: the folder of the cache. Default: the temp folder.
+    :param kwargs: additional video properties (see `streams`).
+    :return: the mpv process.
+    :rtype: subprocess.Popen
+    """
+    args = _download_args(media_url, folder or gettempdir(), True, True,
+                          False, **kwargs)
+    if not args:
+        return None
+    streams_dict, filepath, _ = args
+    server = proxy.get_proxy()
+    audio, video = [server.add(stream, filepath) if stream else None
+                    for stream in streams_dict]
+    cmd = ['mpv', video or audio]
+    if video and audio:
+        cmd.append(f'--audio-file={audio}')
+    return subprocess.Popen(cmd)
 
 
 @module
@@ -195,24 +491,146 @@ def search(plugin, query_or_url, **kwargs):
     return methods[request](query_or_url, **kwargs)
 
 
-def streams(media_url, quality='best', container='webm'):
+def _prefetch(pages, size=1):
+    """ Iterate over `pages`, while the next `size` pages are fetched in a
+    background thread. The fetching stops when the iteration is stopped.
+
+    :param iterator pages: the pages.
+    :param int size: the number of pages fetched in advance.
+    :rtype: generator
+    """
+    pages_ = queue.Queue(max(size, 1))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages_.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    break
+        except Exception as e:
+            put((None, e))
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close()
+            put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = pages_.get()
+            if item is done:
+                return
+            page, error = item
+            if error is not None:
+                raise error
+            yield page
+    finally:
+        stop.set()
+
+
+@module
+def search_iter(plugin, query_or_url, results=0, prefetch=1, **kwargs):
+    """ The iterator version of `search`, which yields the results one by
+    one as soon as their page has arrived. The next `prefetch` pages are
+    fetched in the background meanwhile. Plugins provide the pages with
+    `search_pages`, `playlist_pages`, `channel_pages` and `user_pages`
+    generators, which take the same arguments as the list functions;
+    without them, the whole result is fetched as one page.
+
+    :param module plugin: the plugin.
+    :param str query_or_url: the search query, or a playlist, channel or
+                             user url.
+    :param int results: the number of search results (0 = all).
+    :param int prefetch: the number of pages fetched in advance.
+    :return: a generator of the result dicts.
+    :rtype: generator
+    """
+    request = plugin.parse_userinput(query_or_url)
+    kwargs['results'] = results
+    hooks = {'search_query': 'search_pages',
+             'playlist': 'playlist_pages',
+             'channel': 'channel_pages',
+             'user': 'user_pages'}
+    hook = getattr(plugin, hooks[request], None)
+    if hook is not None:
+        pages = hook(query_or_url, **kwargs)
+    else:
+        def single_page():
+            if request == 'search_query':
+                yield plugin.search(query_or_url, **kwargs)
+            elif request == 'playlist':
+                yield plugin.playlist(query_or_url, **kwargs)
+            else:
+                yield {'channel': channel, 'user': user}[request](query_or_url)
+        pages = single_page()
+    count = 0
+    pages = _prefetch(pages, prefetch)
+    try:
+        for page in pages:
+            for item in page:
+                yield item
+                count += 1
+                if results and count >= results:
+                    return
+    finally:
+        pages.close()
+
+
+@module
+@cache(maxsize=4096, ttl=lambda index: _metadata_ttl({'streams': index.streams}))
+def _stream_index(plugin, media_url):
+    """ The stream index of a media url. It is cached like the metadata. """
+    return selection.StreamIndex(metadata(media_url)['streams'])
+
+
+def streams(media_url, quality='best', container='webm', codecs=None,
+            max_bitrate=None):
     """ Given a media url, return the stream dicts.
 
     :param str media_url: the media url.
-    :param str quality: the stream quality (concerns only video files).
-                          Default: '1080p'.
+    :param str quality: the stream quality (concerns only video files):
+                        'best', an exact quality like '720p' or the best
+                        quality up to a limit like '<=720p'. Default: 'best'.
     :param str container: the container format. Usually either mp4 or webm.
                             Default: 'webm'.
+    :param list(str) codecs: the preferred codecs, most preferred first. It
+                             may name audio and video codecs; each stream
+                             type only matches its own.
+    :param int max_bitrate: the maximum bitrate of a stream.
     :return: the audio and video dicts.
     :rtype: tuple(dict, dict)
     """
-    item = metadata(media_url)
-    stream_dicts = item['streams']
-    video_stream = _filter_stream(stream_dicts, 'video', quality, container)
-    audio_stream = _filter_stream(stream_dicts, 'audio', quality, container)
+    index = _stream_index(media_url)
+    options = {'container': container, 'codecs': codecs,
+               'max_bitrate': max_bitrate}
+    video_stream = index.select('video', quality=quality, **options)
+    # The quality selector concerns only video, the best audio is used.
+    audio_stream = index.select('audio', **options)
     return [audio_stream, video_stream]
 
 
+async def streams_async(media_url, **kwargs):
+    """ The asyncio version of `streams`.
+
+    :param str media_url: the media url.
+    :return: the audio and video dicts.
+    :rtype: tuple(dict, dict)
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(streams, media_url, **kwargs))
+
+
 def thumbnail(media_url, size='small'):
     """ Download the thumbnail and return the filepath.
     
@@ -230,8 +648,7 @@ def thumbnail(media_url, size='small'):
     fname = f'{item["id"]}{suffix}'
     filepath = str(Path(folder) / Path(fname))
 
-    http = urllib3.PoolManager()
-    r = http.request('GET', thumb_url)
+    r = session.request('GET', thumb_url)
     with open(filepath, 'wb') as f:
         f.write(r.data)
     return filepath
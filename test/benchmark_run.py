@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+""" Runner for the benchmarks. They run offline against a local server with
+synthetic streams (see `benchmarks.server`), so the results of two versions
+can be compared:
+
+    python benchmark_run.py -o old.json
+    (change something)
+    python benchmark_run.py -o new.json --compare old.json
+
+"""
+
+import argparse
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+root = pathlib.Path(__file__).resolve().parent.parent
+sys.path.append(str(root))
+
+import paletti
+from benchmarks.cases import CASES
+
+
+def revision():
+    """ The git revision of the tree, if there is one.
+
+    :rtype: str
+    """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(case, config):
+    """ Run a case `config.repeat` times and once more with traced memory.
+
+    :return: the median of every result, the number of failed runs and the
+             memory peak.
+    :rtype: dict
+    """
+    runs = [case(config) for _ in range(config.repeat)]
+    if 'skipped' in runs[0]:
+        return runs[0]
+    results = {key: statistics.median(run[key] for run in runs)
+               for key in runs[0] if runs[0][key] is not None and key != 'failed'}
+    if 'failed' in runs[0]:
+        results['failed'] = sum(run['failed'] for run in runs)
+    results['memory_peak'] = case(config, trace_memory=True)['memory_peak']
+    results['runs'] = len(runs)
+    return results
+
+
+def compare(old, new):
+    """ Print the relative change of every result which is in both.
+
+    :param dict old: the old results.
+    :param dict new: the new results.
+    :return: None
+    """
+    print(f'{"case":22s} {"result":24s} {"old":>12s} {"new":>12s} {"change":>8s}',
+          file=sys.stderr)
+    for name, results in new['results'].items():
+        for key, value in results.items():
+            before = old['results'].get(name, {}).get(key)
+            if not isinstance(value, (int, float)) or \
+                    not isinstance(before, (int, float)) or key == 'runs':
+                continue
+            change = f'{(value - before) / before:+8.1%}' if before else ''
+            print(f'{name:22s} {key:24s} {before:12.4g} {value:12.4g} {change:>8s}',
+                  file=sys.stderr)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('cases', nargs='*', choices=[[], *CASES], default=[],
+                        help='the cases to run (default: all)')
+    parser.add_argument('-o', '--output', help='write the results to this '
+                        'json file instead of stdout')
+    parser.add_argument('--compare', help='compare with the results in this '
+                        'json file')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the number of runs per case')
+    parser.add_argument('--size', type=int, default=64,
+                        help='the size of every stream in MiB')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='the delay of every response in seconds')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='the maximum rate per connection in bytes/s')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='the share of stream responses with an error')
+    parser.add_argument('--errors', default='short',
+                        type=lambda value: [e if e == 'short' else int(e)
+                                            for e in value.split(',')],
+                        help='the injected errors, comma-separated: short '
+                        'responses and/or status codes, e.g. short,503,403')
+    parser.add_argument('--media-seconds', type=int, default=30,
+                        help='the length of the media for merge_files')
+    config = parser.parse_args(args)
+    settings = dict(vars(config))
+    config.size *= 1_048_576
+
+    output = {'paletti': paletti.__version__, 'revision': revision(),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'settings': settings, 'results': {}}
+    for name in config.cases or CASES:
+        print(f'Running {name}...', file=sys.stderr)
+        output['results'][name] = run_case(CASES[name], config)
+
+    if config.output:
+        with open(config.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if config.compare:
+        with open(config.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+""" The benchmark cases. Every case takes the settings of the runner and
+returns the results of one run as a dict of numbers.
+"""
+
+import functools
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from paletti import downloader, selection, utils, web_api
+
+from benchmarks import stub_plugin
+from benchmarks.measure import Measurement
+from benchmarks.server import StreamServer, media
+
+GIB = 2 ** 30
+
+
+def download(config, trace_memory=False, segments=1, strategy='parallel'):
+    """ Download an audio and a video stream from the local server. A
+    download which fails because of an injected error is counted in
+    `failed`.
+    """
+    with StreamServer(config.size, config.latency, config.bandwidth,
+                      config.error_rate, config.errors) as server, \
+            tempfile.TemporaryDirectory() as folder:
+        streams = server.metadata('1')['streams']
+        dl = downloader.Download([streams[0], streams[6]],
+                                 os.path.join(folder, 'bench'),
+                                 lambda output, files=None: None,
+                                 segments=segments, strategy=strategy)
+        with Measurement(trace_memory, watch=lambda: dl.progress) as m:
+            dl.start()
+            [t.join() for t in dl.threads]
+        if dl.status not in ('finished', 'failed'):
+            raise RuntimeError(f'The download has {dl.status}: {dl.error}')
+        return dict(m.results, bytes=dl.progress,
+                    throughput=dl.progress / m.results['seconds'],
+                    cpu_per_gib=m.results['cpu_seconds'] / (max(dl.progress, 1) / GIB),
+                    requests=server.counters['requests'],
+                    errors=server.counters['errors'],
+                    failed=int(dl.status == 'failed'))
+
+
+def metadata(config, trace_memory=False, calls=10_000):
+    """ Look up metadata through the stub plugin: the first lookup, cached
+    lookups, concurrent lookups of a new url and `metadata_many`.
+    """
+    with StreamServer(latency=config.latency) as server:
+        stub_plugin.BASE_URL = server.url
+        web_api.plugins.add({'name': 'stub', 'module': stub_plugin,
+                             'hosts': stub_plugin.HOSTS,
+                             'type': stub_plugin.STREAM_TYPE})
+        web_api.metadata.cache.clear()
+        try:
+            url = f'{server.url}/watch?v=1'
+            with Measurement(trace_memory) as m:
+                start = time.perf_counter()
+                web_api.metadata(url)
+                cold = time.perf_counter() - start
+                for _ in range(calls):
+                    web_api.metadata(url)
+                warm = time.perf_counter() - start - cold
+            # Concurrent lookups of the same url share one request.
+            requests = server.counters['requests']
+            threads = [threading.Thread(target=web_api.metadata,
+                                        args=(f'{server.url}/watch?v=2',))
+                       for _ in range(16)]
+            [t.start() for t in threads]
+            [t.join() for t in threads]
+            concurrent = server.counters['requests'] - requests
+            start = time.perf_counter()
+            urls = [f'{server.url}/watch?v={n}' for n in range(100, 150)]
+            errors = [error for _, _, error in web_api.metadata_many(urls) if error]
+            many = time.perf_counter() - start
+            if errors:
+                raise errors[0]
+            stats = web_api.metadata.cache.stats()
+        finally:
+            web_api.plugins.remove('stub')
+        return dict(m.results, cold_seconds=cold,
+                    warm_calls_per_second=calls / warm,
+                    concurrent_requests=concurrent, many_seconds=many,
+                    hit_rate=stats['hits'] / (stats['hits'] + stats['misses']))
+
+
+def filter_stream(config, trace_memory=False, calls=20_000):
+    """ Select streams from the metadata of the local server, with a new
+    index for every selection (`web_api._filter_stream`) and with one index
+    (like `web_api.streams`).
+    """
+    streams = media('http://127.0.0.1', '1')['streams']
+    with Measurement(trace_memory) as m:
+        start = time.perf_counter()
+        for _ in range(calls):
+            web_api._filter_stream(streams, 'video', '720p', 'webm')
+        unindexed = time.perf_counter() - start
+        index = selection.StreamIndex(streams)
+        start = time.perf_counter()
+        for _ in range(calls):
+            index.select('video', '<=720p', 'webm')
+        indexed = time.perf_counter() - start
+    return dict(m.results, calls_per_second=calls / unindexed,
+                indexed_calls_per_second=calls / indexed)
+
+
+def merge_files(config, trace_memory=False):
+    """ Merge an audio and a video file of `config.media_seconds` seconds,
+    which are generated by ffmpeg.
+    """
+    if shutil.which('ffmpeg') is None:
+        return {'skipped': 'ffmpeg not found'}
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'bench')
+        files = [f'{path}.mkv.audio.flac', f'{path}.mkv.video.ffv1']
+        sources = [('sine', 'flac'), ('testsrc=size=640x360:rate=30', 'ffv1')]
+        for filepath, (source, codec) in zip(files, sources):
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi',
+                            '-i', source, '-t', str(config.media_seconds),
+                            '-c', codec, '-f', 'matroska', filepath], check=True)
+        size = sum(os.path.getsize(f) for f in files)
+        with Measurement(trace_memory) as m:
+            utils.merge_files(path, files=[(files[0], 'mkv', 'audio', 'flac'),
+                                           (files[1], 'mkv', 'video', 'ffv1')])
+    return dict(m.results, bytes=size, throughput=size / m.results['seconds'],
+                cpu_per_gib=m.results['cpu_seconds'] / (size / GIB))
+
+
+CASES = {'download': download,
+         'download_segmented': functools.partial(download, segments=4),
+         'download_sequential': functools.partial(download, segments=4,
+                                                  strategy='sequential'),
+         'metadata': metadata,
+         'filter_stream': filter_stream,
+         'merge_files': merge_files}
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+""" Measurements of the benchmark cases, see `Measurement`.
+"""
+
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the CPU time of ffmpeg isn't counted.
+    resource = None
+
+
+def children_cpu():
+    """ The CPU time of the terminated child processes, e.g. ffmpeg.
+
+    :rtype: float
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Measurement:
+    """ Measures the wall time, the CPU time (of this process and its
+    children) and the peak number of threads started by a benchmark case, and
+    optionally the peak of the memory allocated by Python. A thread samples
+    the number of threads and `watch` every `interval` seconds; the first
+    time `watch()` returns a true value is recorded as `first`.
+
+    :param bool trace_memory: trace the memory allocations. This slows down
+                              the case considerably, so the other results of
+                              such a run are not meaningful.
+    :param callable watch: the condition for `first`, e.g. the first byte
+                           of a download.
+    :param float interval: the sampling interval in seconds.
+    """
+    def __init__(self, trace_memory=False, watch=None, interval=0.002):
+        self.trace_memory = trace_memory
+        self.watch = watch
+        self.interval = interval
+        self.results = {}
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self._baseline = threading.active_count() + 1
+        self._threads = self._baseline
+        self._first = None
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._cpu = time.process_time() + children_cpu()
+        self._start = time.perf_counter()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._start
+        cpu = time.process_time() + children_cpu() - self._cpu
+        self._stop.set()
+        self._sampler.join()
+        # Threads which were running before, like the sampler, are not
+        # counted.
+        self.results = {'seconds': wall, 'cpu_seconds': cpu,
+                        'threads_peak': self._threads - self._baseline}
+        if self.watch is not None:
+            self.results['first_seconds'] = self._first
+        if self.trace_memory:
+            self.results['memory_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def _sample(self):
+        while True:
+            self._threads = max(self._threads, threading.active_count())
+            if self._first is None and self.watch is not None and self.watch():
+                self._first = time.perf_counter() - self._start
+            if self._stop.wait(self.interval):
+                return
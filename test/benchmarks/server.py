@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+""" A local HTTP server for the benchmarks, which serves synthetic streams
+and the pages of the stub plugin, see `StreamServer`.
+"""
+
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+# The content of the streams repeats this pattern. It is doubled, so every
+# slice of up to its length can be taken without wrapping around.
+PATTERN = bytes(random.Random(0).getrandbits(8) for _ in range(65_536))
+BLOCK = PATTERN * 2
+
+# (type, container, codec, quality) of the streams of every media item.
+STREAMS = [('audio', 'webm', 'opus', 'medium'), ('audio', 'mp4', 'aac', 'medium')] + \
+          [('video', container, codec, f'{q}p')
+           for container, codec in (('webm', 'vp9'), ('mp4', 'h264'))
+           for q in (144, 240, 360, 480, 720, 1080, 1440, 2160)]
+
+
+def media(base_url, media_id):
+    """ The metadata of a media item, with a stream for every entry of
+    `STREAMS`.
+
+    :param str base_url: the url of the server.
+    :param str media_id: the id.
+    :rtype: dict
+    """
+    streams = [{'type': type_, 'container': container, 'codec': codec,
+                'quality': quality,
+                'quality_int': int(quality[:-1]) if type_ == 'video' else None,
+                'bitrate': 128 if type_ == 'audio' else int(quality[:-1]) * 4,
+                'url': f'{base_url}/stream/{media_id}/{n}?id={media_id}'}
+               for n, (type_, container, codec, quality) in enumerate(STREAMS)]
+    return {'id': media_id, 'title': f'Media {media_id}', 'duration': 600,
+            'author': 'paletti', 'streams': streams}
+
+
+def synthetic(start, end):
+    """ The bytes `start` to `end` (inclusive) of a synthetic stream.
+
+    :return: a generator of blocks of up to 64 KiB.
+    """
+    position = start
+    while position <= end:
+        offset = position % len(PATTERN)
+        block = BLOCK[offset:offset + min(len(PATTERN), end - position + 1)]
+        yield block
+        position += len(block)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._route(body=False)
+
+    def do_GET(self):
+        self._route(body=True)
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            # The client has stopped the download.
+            pass
+
+    def log_message(self, *args):
+        pass
+
+    def _route(self, body):
+        server = self.server.owner
+        server.count('requests')
+        if server.latency:
+            time.sleep(server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.startswith('/stream/'):
+            self._stream(query.get('range'), body)
+        elif url.path == '/metadata':
+            self._json(server.metadata(query['v']), body)
+        elif url.path == '/search':
+            self._json(server.search(query['q'], int(query.get('n', 20))), body)
+        else:
+            self.send_error(404)
+
+    def _json(self, data, body):
+        data = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def _stream(self, range_, body):
+        server = self.server.owner
+        start, end = 0, server.size - 1
+        match = re.match(r'(\d+)-(\d+)', range_ or '')
+        if match:
+            start, end = int(match[1]), min(int(match[2]), end)
+            error = server.inject_error() if end > start else None
+            if error is not None:
+                server.count('errors')
+            if error == 'short':
+                # A short response, which the client has to continue.
+                end = start + (end - start) // 2
+            elif error is not None:
+                self.send_error(error)
+                return
+        self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        began = time.monotonic()
+        sent = 0
+        for block in synthetic(start, end):
+            self.wfile.write(block)
+            sent += len(block)
+            if server.bandwidth:
+                ahead = sent / server.bandwidth - (time.monotonic() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        server.count('bytes', sent)
+
+
+class StreamServer:
+    """ A local HTTP server which serves synthetic streams and the metadata
+    and search results of `stub_plugin`. The streams honor the `range=`
+    url parameter like the streams of the real sites.
+
+    :param int size: the size of every stream in bytes.
+    :param float latency: the delay of every response in seconds.
+    :param int bandwidth: the maximum rate of every connection in bytes per
+                          second, or None.
+    :param float error_rate: the share of the range requests which are
+                             answered with one of the `errors`.
+    :param list errors: the injected errors, chosen at random: 'short'
+                        answers with only half of the requested bytes, like
+                        servers which limit the size of responses, a status
+                        code answers with that error, e.g. 503 (which the
+                        session retries) or 403 (an expired url, which
+                        fails the download).
+    :param int seed: the seed of the error injection.
+    """
+    def __init__(self, size=67_108_864, latency=0.0, bandwidth=None,
+                 error_rate=0.0, errors=('short',), seed=0):
+        self.size = size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.errors = list(errors)
+        self.counters = {'requests': 0, 'bytes': 0, 'errors': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def __repr__(self):
+        return f'<StreamServer: {self.url}>'
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def inject_error(self):
+        """ Decide whether to answer a request with an error.
+
+        :return: one of `errors`, or None.
+        """
+        with self._lock:
+            if self._random.random() < self.error_rate:
+                return self._random.choice(self.errors)
+            return None
+
+    def metadata(self, media_id):
+        """ The metadata of a media item, see `media`.
+
+        :param str media_id: the id.
+        :rtype: dict
+        """
+        return media(self.url, media_id)
+
+    def search(self, query, results):
+        """ The search results for a query.
+
+        :param str query: the query.
+        :param int results: the number of results.
+        :rtype: list(dict)
+        """
+        return [{'type': 'video', 'title': f'{query} {n}',
+                 'url': f'{self.url}/watch?v={n}'} for n in range(results)]
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+""" A plugin for the `StreamServer` of the benchmarks. Set `BASE_URL` to the
+url of the server before use.
+"""
+
+import json
+
+import urllib3
+from urllib3.util import parse_url
+
+HOSTS = ['127.0.0.1']
+STREAM_TYPE = 'audio+video'
+BASE_URL = None
+
+http = urllib3.PoolManager(maxsize=16)
+
+
+def _get(path, **fields):
+    response = http.request('GET', f'{BASE_URL}{path}', fields=fields)
+    return json.loads(response.data)
+
+
+def get_metadata(url):
+    return _get('/metadata', v=parse_url(url).query.split('v=', 1)[1])
+
+
+def parse_userinput(url_or_query):
+    return 'search_query'
+
+
+def search(query, results=20):
+    return _get('/search', q=query, n=results or 20)
@@ -10,7 +10,6 @@ import pathlib
 import random
 import sys
 import threading
-import time
 
 import functional.cases
 
@@ -60,12 +59,13 @@ def report_error(reason, **kwargs):
 @threaded
 def test_download(url):
     d = paletti.download(url, '/tmp')
+    events = d.events()
     d.start()
-    while True:
-        time.sleep(1)
-        if d.status != 'active':
-            break
-        print(f'\r{d.output:.20s}...: {d.progress/1024:7.0f} of {d.filesize/1024:7.0f} kb.', end='')
+    for event in events:
+        if event['event'] == 'progress':
+            stats = event['stats']
+            print(f'\r{d.output:.20s}...: {stats["progress"]/1024:7.0f} of '
+                  f'{stats["filesize"]/1024:7.0f} kb.', end='')
     print('')
 
 
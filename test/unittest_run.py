@@ -14,8 +14,18 @@ sys.path.append(str(root))
 sys.path.append(str(tests))
 
 import paletti.utils
+import test_async_downloader
+import test_caching
 import test_downloader
+import test_journal
 import test_main
+import test_manager
+import test_postprocessing
+import test_proxy
+import test_registry
+import test_selection
+import test_session
+import test_throttle
 import test_utils
 import test_web_api
 
@@ -23,8 +33,18 @@ plugin_tests = paletti.utils.find_modules('tests')
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 
+suite.addTests(loader.loadTestsFromModule(test_async_downloader))
+suite.addTests(loader.loadTestsFromModule(test_caching))
 suite.addTests(loader.loadTestsFromModule(test_downloader))
+suite.addTests(loader.loadTestsFromModule(test_journal))
 suite.addTests(loader.loadTestsFromModule(test_main))
+suite.addTests(loader.loadTestsFromModule(test_manager))
+suite.addTests(loader.loadTestsFromModule(test_postprocessing))
+suite.addTests(loader.loadTestsFromModule(test_proxy))
+suite.addTests(loader.loadTestsFromModule(test_registry))
+suite.addTests(loader.loadTestsFromModule(test_selection))
+suite.addTests(loader.loadTestsFromModule(test_session))
+suite.addTests(loader.loadTestsFromModule(test_throttle))
 suite.addTests(loader.loadTestsFromModule(test_utils))
 suite.addTests(loader.loadTestsFromModule(test_web_api))
 
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+""" Unittests for the `async_downloader` module. To avoid path problems and
+for convienience, this module shouldn't be run directly, use the runner
+instead.
+"""
+
+import asyncio
+import http.server
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from paletti import async_downloader
+
+DATA = bytes(range(256)) * 1000
+# Set to release the handlers of stalled streams.
+STALLED = threading.Event()
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves `DATA` and honors the `range=start-end` url parameter. """
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        if self.path.startswith(('/nohead', '/forbidden')):
+            self.send_error(405)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA)))
+        self.end_headers()
+
+    def do_GET(self):
+        match = re.search(r'range=(\d+)-(\d+)', self.path)
+        body = DATA[int(match[1]):int(match[2]) + 1] if match else DATA
+        if self.path.startswith('/forbidden'):
+            body = b'<html>403 Forbidden</html>'
+        self.send_response(403 if self.path.startswith('/forbidden') else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.path.startswith('/stalled'):
+            # Send nothing after the head.
+            STALLED.wait(10)
+        self.wfile.write(body)
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            # The client has cancelled the download.
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsyncDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/stream?id=1'
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.output = os.path.join(folder.name, 'foo')
+
+    def test_download(self):
+        streams = [{'url': self.url, 'codec': 'opus', 'type': 'audio',
+                    'container': 'webm'},
+                   {'url': self.url, 'codec': 'vp9', 'type': 'video',
+                    'container': 'webm'}]
+        pp = mock.Mock()
+
+        async def run():
+            dl = async_downloader.AsyncDownload(streams, self.output, pp,
+                                                segments=3)
+            self.assertEqual(await dl.analyze(), 2 * len(DATA))
+            await dl.start()
+            return dl
+
+        dl = asyncio.run(run())
+        self.assertEqual(dl.status, 'finished')
+        self.assertEqual(dl.progress, dl.filesize)
+        for stream in streams:
+            with open(dl._filepath(stream), 'rb') as f:
+                self.assertEqual(f.read(), DATA)
+        pp.assert_called_once_with(self.output, files=[
+            (dl._filepath(s), s['container'], s['type'], s['codec']) for s in streams])
+
+    def test_cancel(self):
+        stream = {'url': self.url, 'codec': 'vp9', 'type': 'video',
+                  'container': 'webm'}
+
+        async def run():
+            dl = async_downloader.AsyncDownload([None, stream], self.output,
+                                                mock.Mock())
+            task = dl.start()
+            dl.cancel()
+            await task
+            return dl
+
+        dl = asyncio.run(run())
+        self.assertEqual(dl.status, 'cancelled')
+        self.assertLess(dl.progress, len(DATA))
+
+    def test_pause_write(self):
+        # A write which is running when the download is paused finishes
+        # before the file is closed.
+        stream = {'url': self.url, 'codec': 'vp9', 'type': 'video',
+                  'container': 'webm'}
+        calls = []
+        writing = threading.Event()
+        write = async_downloader.OutputFile.write
+
+        def slow_write(output, offset, data):
+            writing.set()
+            time.sleep(0.2)
+            write(output, offset, data)
+            calls.append('write')
+
+        mock.patch.object(async_downloader.OutputFile, 'write', slow_write).start()
+        close = async_downloader.OutputFile.close
+        mock.patch.object(async_downloader.OutputFile, 'close',
+                          lambda output: calls.append('close') or close(output)).start()
+        self.addCleanup(mock.patch.stopall)
+
+        async def run():
+            dl = async_downloader.AsyncDownload([None, stream], self.output,
+                                                mock.Mock(), sizes=[0, len(DATA)])
+            task = dl.start()
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, writing.wait, 5)
+            dl.pause()
+            await task
+            return dl
+
+        dl = asyncio.run(run())
+        self.assertEqual(dl.status, 'paused')
+        self.assertEqual(calls, ['write', 'close'])
+
+    def test_error_status(self):
+        stream = {'url': self.url.replace('/stream', '/forbidden'),
+                  'codec': 'vp9', 'type': 'video', 'container': 'webm'}
+
+        async def run():
+            dl = async_downloader.AsyncDownload([None, stream], self.output,
+                                                mock.Mock(), sizes=[0, 300])
+            with self.assertRaises(ConnectionError):
+                await dl.start()
+            return dl
+
+        dl = asyncio.run(run())
+        self.assertEqual(dl.status, 'failed')
+        self.assertEqual(dl.progress, 0)
+
+    def test_stalled(self):
+        # A server which stops sending runs into the timeout of the session,
+        # and a cancelled download doesn't wait for it.
+        session = async_downloader.session
+        defaults = session.settings()
+        self.addCleanup(lambda: session.configure(**defaults))
+        self.addCleanup(STALLED.set)
+        stream = {'url': self.url.replace('/stream', '/stalled'),
+                  'codec': 'vp9', 'type': 'video', 'container': 'webm'}
+
+        async def run(cancel):
+            dl = async_downloader.AsyncDownload([None, stream], self.output,
+                                                mock.Mock(), sizes=[0, 300])
+            task = dl.start()
+            if cancel:
+                await asyncio.sleep(0.1)
+                dl.cancel()
+            await task
+            return dl
+
+        session.configure(timeout=0.2)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(run(cancel=False))
+        session.configure(timeout=30)
+        start = time.monotonic()
+        dl = asyncio.run(run(cancel=True))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(dl.status, 'cancelled')
+
+    def test_probe(self):
+        # Without HEAD, the size is taken from the head of a GET response,
+        # whose body isn't read, although the server ignores the range.
+        async def run():
+            dl = async_downloader.AsyncDownload([], self.output, mock.Mock())
+            size = await dl._probe(self.url.replace('/stream', '/nohead'))
+            return size, async_downloader.get_pool()
+
+        size, pool = asyncio.run(run())
+        self.assertEqual(size, len(DATA))
+        self.assertFalse(any(pool._idle.values()))
+
+        # An error page doesn't give the size of the stream.
+        async def run_error():
+            dl = async_downloader.AsyncDownload([], self.output, mock.Mock())
+            with self.assertRaises(ConnectionError):
+                await dl._probe(self.url.replace('/stream', '/forbidden'))
+
+        asyncio.run(run_error())
+
+    def test_keep_alive(self):
+        async def run():
+            pool = async_downloader.ConnectionPool()
+            for _ in range(3):
+                response = await pool.request('GET', self.url + '&range=0-9')
+                self.assertEqual(await response.read(), DATA[:10])
+                pool.release(response)
+            return pool
+
+        pool = asyncio.run(run())
+        self.assertEqual(len(pool._idle[('http', '127.0.0.1', self.server.server_port)]), 1)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+""" Unittests for the `caching` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from paletti import caching
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        mock.patch.object(caching, 'time', mock.Mock(monotonic=lambda: self.now)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_lru(self):
+        c = caching.LRUCache(maxsize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        # 'b' is the least recently used entry now.
+        c.set('c', 3)
+        self.assertNotIn('b', c)
+        self.assertEqual(c.get('b', 'default'), 'default')
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.stats(), {'hits': 1, 'misses': 1, 'evictions': 1,
+                                     'expired': 0, 'size': 2, 'maxsize': 2})
+
+    def test_ttl(self):
+        c = caching.LRUCache(ttl=10)
+        c.set('a', 1)
+        c.set('b', 2, ttl=60)
+        c.set('c', 3, ttl=None)
+        self.now += 30
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.get('b'), 2)
+        self.now += 1000
+        self.assertNotIn('b', c)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(c.stats()['expired'], 2)
+
+    def test_delete_clear(self):
+        c = caching.LRUCache()
+        c.set('a', None)
+        self.assertIn('a', c)
+        c.delete('a')
+        self.assertNotIn('a', c)
+        c.set('b', 2)
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+
+class TestSQLiteCache(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, 'cache.sqlite')
+
+    def test_persistence(self):
+        c = caching.SQLiteCache(self.path)
+        c.set(('metadata', 'http://example.com/1'), {'title': 'foo'}, ttl=60)
+        c.set('expired', 1, ttl=-1)
+        # A second instance, like one in another process, sees the entries.
+        other = caching.SQLiteCache(self.path)
+        value, ttl = other.lookup(('metadata', 'http://example.com/1'))
+        self.assertEqual(value, {'title': 'foo'})
+        self.assertTrue(0 < ttl <= 60)
+        self.assertIsNone(other.get('expired'))
+        self.assertEqual(other.stats()['expired'], 1)
+        other.delete(('metadata', 'http://example.com/1'))
+        self.assertNotIn(('metadata', 'http://example.com/1'), c)
+
+    def test_threads(self):
+        c = caching.SQLiteCache(self.path)
+        threads = [threading.Thread(target=c.set, args=(i, i)) for i in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(sorted(c.get(i) for i in range(8)), list(range(8)))
+
+    def test_prune(self):
+        c = caching.SQLiteCache(self.path, maxsize=3)
+        for i in range(5):
+            c.set(i, i)
+        c.get(0)
+        c.prune()
+        self.assertEqual(len(c), 3)
+        self.assertIn(0, c)
+        self.assertNotIn(1, c)
+        self.assertEqual(c.stats()['evictions'], 2)
+
+    def test_configure(self):
+        self.assertRaises(TypeError, lambda: caching.configure(foo=1))
+        self.addCleanup(caching.configure, directory=None)
+        self.assertIsNone(caching.get_backend())
+        caching.configure(directory=os.path.dirname(self.path))
+        self.assertEqual(caching.get_backend().path, self.path)
+        self.assertIs(caching.get_backend(), caching.get_backend())
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_do(self):
+        flight = caching.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch(n):
+            calls.append(n)
+            started.set()
+            release.wait(5)
+            return n * 2
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(flight.do('k', fetch, 21)))
+            for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        [t.start() for t in threads[1:]]
+        time.sleep(0.1)
+        release.set()
+        [t.join() for t in threads]
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(flight._calls, {})
+
+    def test_do_error(self):
+        flight = caching.SingleFlight()
+        self.assertRaises(KeyError, lambda: flight.do('k', {}.__getitem__, 'x'))
+        self.assertEqual(flight.do('k', len, 'abc'), 3)
+
+    def test_do_async(self):
+        flight = caching.SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def run():
+            return await asyncio.gather(*[flight.do_async('k', fetch) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), ['result'] * 5)
+        self.assertEqual(calls, [1])
+        self.assertEqual(flight._tasks, {})
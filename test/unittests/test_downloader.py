@@ -4,6 +4,11 @@
 convienience, this module shouldn't be run directly, use the runner instead.
 """
 
+import os
+import re
+import subprocess
+import sys
+import tempfile
 import time
 import unittest
 from unittest import mock
@@ -11,6 +16,25 @@ from unittest import mock
 from paletti import downloader
 
 
+def mock_range_pool(data):
+    """ Create a mocked `session.get_pool` whose pool serves `data` and
+    honors the `range=start-end` parameter of the requested url.
+    """
+    def request(method, url, **kwargs):
+        response = mock.Mock(status=200)
+        match = re.search(r'range=(\d+)-(\d+)', url)
+        start, end = (int(match[1]), int(match[2])) if match else (0, len(data) - 1)
+        body = data[start:end + 1]
+        response.headers = {'Content-Length': str(len(body))}
+        response.stream.side_effect = lambda n: (body[i:i + n]
+                                                 for i in range(0, len(body), n))
+        return response
+
+    pool = mock.Mock()
+    pool.return_value.request.side_effect = request
+    return pool
+
+
 class TestDownloader(unittest.TestCase):
 
     def setUp(self):
@@ -19,31 +43,34 @@ class TestDownloader(unittest.TestCase):
         # of 132000 bytes, which means one full and on partial chunk
         # for urllib3.request.stream(1024*128).
         def mock_stream():
-            yield b' ' * (1024*128-33)
+            yield b' ' * (1024*128)
             time.sleep(0.02)
-            yield b' ' * 895
+            yield b' ' * 928
 
+        self.addCleanup(mock.patch.stopall)
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
         streams = ({},
                    {'url': 'http://example.com/audio.mp3',
                     'title': 'Foo',
                     'codec': 'vp9',
                     'type': 'video',
                     'container': 'wbm'})
-        outfile = '/tmp/foobar'
+        outfile = os.path.join(folder.name, 'foobar')
         data = b''
         headers = {'Content-Length': '132000'}
         stream = mock_stream()
-        downloader.urllib3.PoolManager = mock.Mock()
-        downloader.urllib3.PoolManager.return_value.request.return_value.data = data
-        downloader.urllib3.PoolManager.return_value.request.return_value.stream.return_value = stream
-        downloader.urllib3.PoolManager.return_value.request.return_value.headers = headers
+        pool = mock.patch.object(downloader.session, 'get_pool').start()
+        pool.return_value.request.return_value.status = 200
+        pool.return_value.request.return_value.data = data
+        pool.return_value.request.return_value.stream.return_value = stream
+        pool.return_value.request.return_value.headers = headers
 
         self.dl = downloader.Download(streams, outfile, mock.Mock)
         self.dl2 = downloader.Download(streams, outfile, mock.Mock)
         self.assertEqual(self.dl.status, 'idle')
 
-    @mock.patch('builtins.open', create=False)
-    def test_start(self, mock_open):
+    def test_start(self):
         # Start a download, check it's properties, and wait for it to finish.
         self.dl.start()
         self.assertEqual(self.dl.status, 'active')
@@ -52,9 +79,410 @@ class TestDownloader(unittest.TestCase):
         while self.dl.status == 'active':
             pass
         self.assertEqual(self.dl.progress, self.dl.filesize)
+        self.assertEqual(self.dl.stream_progress, [0, 132000])
+        stats = self.dl.stats()
+        self.assertEqual(stats['eta'], 0)
+        self.assertEqual(stats['streams'][1], {'progress': 132000, 'size': 132000,
+                                               'playable': 132000})
 
     def test_cancel(self):
         # Start a new download and cancel it immediately.
         self.dl2.start()
         self.dl2.cancel()
-        self.assertEqual(self.dl2.status, 'cancelled')
\ No newline at end of file
+        self.assertEqual(self.dl2.status, 'cancelled')
+        [t.join() for t in self.dl2.threads]
+
+    def test_known_sizes(self):
+        # No requests are sent if all sizes are known.
+        streams = [{'url': 'http://example.com/a', 'filesize': 10},
+                   {'url': 'http://example.com/v'}]
+        request = mock.patch.object(downloader.session, 'request').start()
+        dl = downloader.Download(streams, '/tmp/foo', mock.Mock, sizes=[None, 20])
+        self.assertEqual(dl.sizes, [10, 20])
+        self.assertEqual(dl.filesize, 30)
+        self.assertFalse(request.called)
+
+    def test_probe_size(self):
+        # Servers which don't answer HEAD requests are asked for the first
+        # byte instead.
+        head = mock.Mock(status=405, headers={})
+        get = mock.Mock(status=206, headers={'Content-Length': '1',
+                                             'Content-Range': 'bytes 0-0/4711'})
+        request = mock.patch.object(downloader.session, 'request').start()
+        request.side_effect = [head, get]
+        self.assertEqual(downloader.probe_size('http://example.com/v'), 4711)
+        request.assert_called_with('GET', 'http://example.com/v',
+                                   headers={'Range': 'bytes=0-0'},
+                                   preload_content=False)
+        # The body is never read.
+        self.assertTrue(get.close.called)
+        self.assertFalse(get.read.called)
+
+        # An error page doesn't give the size of the stream.
+        forbidden = mock.Mock(status=403, headers={'Content-Length': '26'})
+        request.side_effect = [head, forbidden]
+        with self.assertRaises(ConnectionError):
+            downloader.probe_size('http://example.com/v')
+        self.assertTrue(forbidden.close.called)
+
+    def test_output_file(self):
+        # Write the pieces of a file out of order in every mode.
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'foo')
+            for mode in downloader.OutputFile.modes:
+                with open(path, 'wb') as f:
+                    downloader.preallocate_file(f, 10)
+                output_file = downloader.OutputFile(path, 10, mode)
+                output_file.write(6, b'6789')
+                output_file.write(0, b'012345')
+                self.assertEqual(output_file.read(4, 4), b'4567')
+                output_file.close()
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), b'0123456789')
+        self.assertRaises(ValueError, lambda: downloader.OutputFile(path, 10, 'foo'))
+
+    def test_output_modes(self):
+        data = bytes(range(256)) * 1000
+        mock.patch.object(downloader.session, 'get_pool',
+                          mock_range_pool(data)).start()
+        stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                  'type': 'video', 'container': 'webm'}
+        with tempfile.TemporaryDirectory() as folder:
+            for mode, segments in [('pwrite', 1), ('mmap', 1), ('mmap', 3)]:
+                output = os.path.join(folder, f'{mode}{segments}')
+                dl = downloader.Download([None, stream], output, mock.Mock(),
+                                         segments=segments, output_mode=mode)
+                dl.start()
+                [t.join() for t in dl.threads]
+                self.assertEqual(dl.status, 'finished')
+                with open(f'{output}.webm.video.vp9', 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_rate(self):
+        self.dl.activate()
+        self.dl._samples.clear()
+        self.dl._samples.append((time.monotonic() - 2, 0))
+        self.dl._count(1, 2000)
+        self.assertAlmostEqual(self.dl.rate(), 1000, delta=50)
+        self.assertAlmostEqual(self.dl.stats()['eta'], 130, delta=10)
+
+    def test_short_response(self):
+        # A range which is sent in two responses is continued, a response
+        # without data is an error.
+        data = bytes(range(256)) * 10
+        responses = [data[:1000], data[1000:], b'']
+
+        def request(method, url, **kwargs):
+            body = responses.pop(0)
+            return mock.Mock(status=200, headers={'Content-Length': str(len(body))},
+                             stream=mock.Mock(return_value=iter([body])))
+
+        http = mock.Mock(request=request)
+        stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                  'type': 'video', 'container': 'webm'}
+        dl = downloader.Download([None, stream], self.dl.output, mock.Mock(),
+                                 sizes=[0, len(data)])
+        dl.activate()
+        dl._prepare(stream)
+        output_file = downloader.OutputFile(dl._filepath(stream), len(data))
+        self.assertTrue(dl._fetch_range(http, stream, output_file, 0, len(data) - 1))
+        self.assertEqual(dl.progress, len(data))
+        self.assertRaises(ConnectionError,
+                          lambda: dl._fetch_range(http, stream, output_file, 0, 9))
+        output_file.close()
+
+    def test_error_status(self):
+        # An error page is never written as stream data, and a server which
+        # ignores the range is noticed.
+        def request(method, url, **kwargs):
+            body = b'<html>403 Forbidden</html>'
+            return mock.Mock(status=403, headers={'Content-Length': str(len(body))},
+                             stream=mock.Mock(return_value=iter([body])))
+
+        pool = mock.patch.object(downloader.session, 'get_pool').start()
+        pool.return_value.request.side_effect = request
+        stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                  'type': 'video', 'container': 'webm'}
+        dl = downloader.Download([None, stream], self.dl.output, mock.Mock(),
+                                 sizes=[0, 300])
+        dl.start()
+        [t.join() for t in dl.threads]
+        self.assertEqual(dl.status, 'failed')
+        self.assertIsInstance(dl.error, ConnectionError)
+        self.assertEqual(dl.progress, 0)
+        self.assertEqual(dl._journal.completed(dl._filepath(stream)), 0)
+        url = 'http://example.com/video?id=1&range=10-19'
+        downloader.check_range_response(url, 206, None, 10, 19)
+        downloader.check_range_response(url, 200, '10', 10, 19)
+        downloader.check_range_response(url, 200, '300', 0, 19)
+        for status, length in [(200, '300'), (200, None), (503, '10')]:
+            self.assertRaises(ConnectionError, downloader.check_range_response,
+                              url, status, length, 10, 19)
+
+    def test_events(self):
+        data = bytes(range(256)) * 1000
+        mock.patch.object(downloader.session, 'get_pool',
+                          mock_range_pool(data)).start()
+        stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                  'type': 'video', 'container': 'webm'}
+        dl = downloader.Download([None, stream], self.dl.output, mock.Mock(),
+                                 segments=2)
+        dl.progress_interval = 0
+        progress = []
+        dl.subscribe(progress.append, events=['progress'])
+        events = dl.events(timeout=5)
+        dl.start()
+        names = [event['event'] for event in events]
+        self.assertEqual(names[0], 'started')
+        self.assertEqual(names[-3:], ['stream_finished', 'postprocessing', 'finished'])
+        self.assertEqual(len(progress), names.count('progress'))
+        self.assertEqual(progress[-1]['stats']['progress'], len(data))
+        self.assertEqual(dl._subscribers, [(progress.append, {'progress'})])
+
+    def test_failed(self):
+        pool = mock.patch.object(downloader.session, 'get_pool').start()
+        pool.return_value.request.side_effect = ConnectionError('Network down')
+        events = self.dl.events(timeout=5)
+        self.dl.start()
+        event = list(events)[-1]
+        self.assertEqual(event['event'], 'failed')
+        self.assertIsInstance(event['error'], ConnectionError)
+        self.assertEqual(self.dl.status, 'failed')
+
+    def test_segment_ranges(self):
+        self.assertEqual(downloader.segment_ranges(10, 3),
+                         [(0, 3), (4, 6), (7, 9)])
+        self.assertEqual(downloader.segment_ranges(2, 4), [(0, 0), (1, 1)])
+
+    def test_segmented(self):
+        # Fetch a stream as four ranges and check that every byte ended up
+        # at the right offset.
+        data = bytes(range(256)) * 1000
+        mock.patch.object(downloader.session, 'get_pool',
+                          mock_range_pool(data)).start()
+        with tempfile.TemporaryDirectory() as folder:
+            stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                      'type': 'video', 'container': 'webm'}
+            pp = mock.Mock()
+            dl = downloader.Download([None, stream], os.path.join(folder, 'x'),
+                                     pp, segments=4)
+            dl.start()
+            [t.join() for t in dl.threads]
+            self.assertEqual(dl.status, 'finished')
+            self.assertEqual(dl.progress, len(data))
+            with open(os.path.join(folder, 'x.webm.video.vp9'), 'rb') as f:
+                self.assertEqual(f.read(), data)
+            pp.assert_called_once_with(
+                dl.output, files=[(os.path.join(folder, 'x.webm.video.vp9'),
+                                   'webm', 'video', 'vp9')])
+
+    def test_sequential_ranges(self):
+        self.assertEqual(downloader.sequential_ranges([(0, 99)], 30, 25),
+                         [(0, 29), (30, 54), (55, 79), (80, 99)])
+        self.assertEqual(downloader.sequential_ranges([(10, 19), (40, 59)], 30, 15),
+                         [(10, 19), (40, 54), (55, 59)])
+
+    def test_sequential(self):
+        # The beginnings of both streams come first, then the rest in order.
+        data = bytes(range(256)) * 1000
+        pool = mock_range_pool(data)
+        mock.patch.object(downloader.session, 'get_pool', pool).start()
+        with tempfile.TemporaryDirectory() as folder:
+            streams = [{'url': 'http://example.com/audio?id=1', 'codec': 'opus',
+                        'type': 'audio', 'container': 'webm'},
+                       {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                        'type': 'video', 'container': 'webm'}]
+            dl = downloader.Download(streams, os.path.join(folder, 'x'),
+                                     mock.Mock(), segments=2,
+                                     strategy='sequential')
+            dl.head_size, dl.piece_size = 10_000, 50_000
+            dl.start()
+            [t.join() for t in dl.threads]
+            self.assertEqual(dl.status, 'finished')
+            for stream in streams:
+                with open(dl._filepath(stream), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+        ranges = [re.search(r'range=(\d+)-', c.args[1])[1]
+                  for c in pool.return_value.request.call_args_list
+                  if 'range=' in c.args[1]]
+        self.assertEqual(ranges[:2], ['0', '0'])
+        self.assertNotIn('0', ranges[2:])
+        self.assertEqual(dl.playable(), [len(data), len(data)])
+        self.assertRaises(ValueError, downloader.Download, streams, 'x',
+                          mock.Mock(), strategy='random')
+
+    def test_playable(self):
+        with tempfile.TemporaryDirectory() as folder:
+            stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                      'type': 'video', 'container': 'webm'}
+            dl = downloader.Download([None, stream], os.path.join(folder, 'x'),
+                                     mock.Mock(), sizes=[None, 100])
+            self.assertEqual(dl.playable(), [0, 0])
+            dl._prepare(stream)
+            dl._journal.add(dl._filepath(stream), 0, 9)
+            dl._journal.add(dl._filepath(stream), 20, 29)
+            # Only the bytes up to the first gap are playable.
+            self.assertEqual(dl.playable(), [0, 10])
+
+    def test_throttle(self):
+        # Every chunk is passed through the bandwidth limiter of its host.
+        data = bytes(range(256)) * 1000
+        mock.patch.object(downloader.session, 'get_pool',
+                          mock_range_pool(data)).start()
+        limiter = mock.patch.object(downloader.throttle, 'throttle').start()
+        with tempfile.TemporaryDirectory() as folder:
+            stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                      'type': 'video', 'container': 'webm'}
+            dl = downloader.Download([None, stream], os.path.join(folder, 'x'),
+                                     mock.Mock())
+            dl.start()
+            [t.join() for t in dl.threads]
+        self.assertEqual(dl.status, 'finished')
+        self.assertEqual({c.args[0] for c in limiter.call_args_list}, {'example.com'})
+        self.assertEqual(sum(c.args[1] for c in limiter.call_args_list), len(data))
+
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'FIFOs are not supported.')
+    def test_mux(self):
+        # Both streams go through pipes into a stand-in for ffmpeg, which
+        # concatenates its inputs, without any stream files.
+        data = bytes(range(256)) * 1000
+        mock.patch.object(downloader.session, 'get_pool',
+                          mock_range_pool(data)).start()
+        popen = subprocess.Popen
+        script = 'import sys; open(sys.argv[-1], "wb").write(b"".join(' \
+                 'open(p, "rb").read() for p in sys.argv[1:-1]))'
+
+        def ffmpeg(cmd, **kwargs):
+            inputs = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == '-i']
+            return popen([sys.executable, '-c', script, *inputs, cmd[-1]], **kwargs)
+        mock.patch('subprocess.Popen', ffmpeg).start()
+        with tempfile.TemporaryDirectory() as folder:
+            streams = [{'url': 'http://example.com/audio?id=1', 'codec': 'opus',
+                        'type': 'audio', 'container': 'webm'},
+                       {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                        'type': 'video', 'container': 'webm'}]
+            pp = mock.Mock()
+            dl = downloader.Download(streams, os.path.join(folder, 'x'), pp,
+                                     mux=True)
+            dl.start()
+            [t.join() for t in dl.threads]
+            self.assertEqual(dl.status, 'finished')
+            self.assertEqual(os.listdir(folder), ['x.webm'])
+            with open(os.path.join(folder, 'x.webm'), 'rb') as f:
+                self.assertEqual(f.read(), data + data)
+        pp.assert_called_once_with(dl.output, files=[],
+                                   result=os.path.join(folder, 'x.webm'))
+        # Containers which need seeking are downloaded to files.
+        streams[1]['container'] = 'mp4'
+        self.assertFalse(downloader.Download(streams, 'x', pp, mux=True).mux)
+
+    def test_resume(self):
+        # Interrupt a download after the first range and check that a new
+        # download only fetches the rest.
+        data = bytes(range(256)) * 1000
+        pool = mock_range_pool(data)
+        mock.patch.object(downloader.session, 'get_pool', pool).start()
+        mock.patch.object(downloader, 'segment_ranges',
+                          return_value=[(0, 99_999), (100_000, 255_999)]).start()
+        with tempfile.TemporaryDirectory() as folder:
+            stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                      'type': 'video', 'container': 'webm'}
+            output = os.path.join(folder, 'x')
+            dl = downloader.Download([None, stream], output, mock.Mock(),
+                                     segments=2)
+            dl.status = 'active'
+            dl._prepare(stream, preallocate=True)
+            output_file = downloader.OutputFile(dl._filepath(stream), len(data))
+            dl._fetch_range(pool(), stream, output_file, 0, 99_999)
+            output_file.close()
+            self.assertTrue(os.path.exists(f'{output}.journal'))
+
+            pool.return_value.request.reset_mock()
+            dl = downloader.Download([None, stream], output, mock.Mock(),
+                                     segments=2)
+            dl.start()
+            [t.join() for t in dl.threads]
+            self.assertEqual(dl.status, 'finished')
+            urls = [c[0][1] for c in pool.return_value.request.call_args_list]
+            self.assertIn('http://example.com/video?id=1&range=100000-255999', urls)
+            self.assertNotIn('http://example.com/video?id=1&range=0-99999', urls)
+            with open(f'{output}.webm.video.vp9', 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertFalse(os.path.exists(f'{output}.journal'))
+
+    def test_resume_expired(self):
+        # The url expires after the first range. The error page is not
+        # recorded, so a download with a new url fetches the rest.
+        data = bytes(range(256)) * 1000
+        pool = mock_range_pool(data)
+        serve = pool.return_value.request.side_effect
+
+        def request(method, url, **kwargs):
+            if 'range=0-' in url:
+                return serve(method, url, **kwargs)
+            body = b'<html>403 Forbidden</html>'
+            return mock.Mock(status=403, headers={'Content-Length': str(len(body))},
+                             stream=mock.Mock(return_value=iter([body])))
+
+        pool.return_value.request.side_effect = request
+        mock.patch.object(downloader.session, 'get_pool', pool).start()
+        mock.patch.object(downloader, 'segment_ranges',
+                          return_value=[(0, 99_999), (100_000, 255_999)]).start()
+        with tempfile.TemporaryDirectory() as folder:
+            stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                      'type': 'video', 'container': 'webm'}
+            output = os.path.join(folder, 'x')
+            dl = downloader.Download([None, stream], output, mock.Mock(),
+                                     segments=2, sizes=[0, len(data)])
+            dl.start()
+            [t.join() for t in dl.threads]
+            self.assertEqual(dl.status, 'failed')
+            self.assertEqual(dl._journal.missing(dl._filepath(stream), 0, len(data) - 1),
+                             [(100_000, 255_999)])
+
+            pool.return_value.request.side_effect = serve
+            stream = dict(stream, url='http://example.com/video?id=2')
+            dl = downloader.Download([None, stream], output, mock.Mock(),
+                                     segments=2)
+            dl.start()
+            [t.join() for t in dl.threads]
+            self.assertEqual(dl.status, 'finished')
+            self.assertEqual(dl.progress, len(data))
+            with open(f'{output}.webm.video.vp9', 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_segment_error(self):
+        # A failing segment (or piece) stops the others after their current
+        # chunk, with both strategies.
+        data = bytes(range(256)) * 2000
+        serve = mock_range_pool(data).return_value.request.side_effect
+        failing = {'parallel': 'range=256000-', 'sequential': 'range=101000-'}
+
+        def request(method, url, **kwargs):
+            if failing[dl.strategy] in url:
+                raise ConnectionError('Network down')
+            response = serve(method, url, **kwargs)
+            chunks = list(response.stream(1024))
+
+            def slow(n):
+                for chunk in chunks:
+                    time.sleep(0.005)
+                    yield chunk
+            response.stream.side_effect = slow
+            return response
+
+        pool = mock.patch.object(downloader.session, 'get_pool').start()
+        pool.return_value.request.side_effect = request
+        stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                  'type': 'video', 'container': 'webm'}
+        for strategy in downloader.Download.strategies:
+            with tempfile.TemporaryDirectory() as folder:
+                dl = downloader.Download([None, stream], os.path.join(folder, 'x'),
+                                         mock.Mock(), segments=2, strategy=strategy,
+                                         sizes=[0, len(data)])
+                dl.head_size, dl.piece_size = 1000, 100_000
+                dl.start()
+                [t.join() for t in dl.threads]
+                self.assertEqual(dl.status, 'failed')
+                self.assertIsInstance(dl.error, ConnectionError)
+                self.assertLess(dl.progress, 100_000)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+""" Unittests for the `journal` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import os
+import tempfile
+import unittest
+
+from paletti import journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.stream = os.path.join(folder.name, 'foo.webm.video.vp9')
+        self.path = os.path.join(folder.name, 'foo.journal')
+        open(self.stream, 'wb').close()
+
+    def test_merge_ranges(self):
+        self.assertEqual(journal.merge_ranges([[5, 9], [0, 4], [20, 30], [25, 26]]),
+                         [[0, 9], [20, 30]])
+
+    def test_resume(self):
+        j = journal.Journal(self.path)
+        self.assertFalse(j.open(self.stream, 'http://example.com/1', 100))
+        j.add(self.stream, 0, 9)
+        j.add(self.stream, 50, 59)
+        # A new journal for the same path picks up the recorded ranges.
+        j = journal.Journal(self.path)
+        self.assertTrue(j.open(self.stream, 'http://example.com/2', 100))
+        self.assertEqual(j.completed(self.stream), 20)
+        self.assertEqual(j.missing(self.stream, 0, 99), [(10, 49), (60, 99)])
+        self.assertEqual(j.missing(self.stream, 52, 55), [])
+
+    def test_size_changed(self):
+        j = journal.Journal(self.path)
+        j.open(self.stream, 'http://example.com/1', 100)
+        j.add(self.stream, 0, 9)
+        j = journal.Journal(self.path)
+        self.assertFalse(j.open(self.stream, 'http://example.com/1', 101))
+        self.assertEqual(j.completed(self.stream), 0)
+
+    def test_remove(self):
+        j = journal.Journal(self.path)
+        j.open(self.stream, 'http://example.com/1', 100)
+        self.assertTrue(os.path.exists(self.path))
+        j.remove()
+        self.assertFalse(os.path.exists(self.path))
+        # Later changes are not saved.
+        j.add(self.stream, 0, 9)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_size(self):
+        j = journal.Journal(self.path)
+        j.open(self.stream, 'http://example.com/1', 100)
+        self.assertEqual(j.size(self.stream, 'http://example.com/1'), 100)
+        # The size of another url may be different.
+        self.assertIsNone(j.size(self.stream, 'http://example.com/2'))
+
+    def test_get_journal(self):
+        # Ranges recorded through two users of the same file add up.
+        first = journal.get_journal(self.path)
+        second = journal.get_journal(os.path.join(os.path.dirname(self.path),
+                                                  '.', 'foo.journal'))
+        self.assertIs(first, second)
+        first.open(self.stream, 'http://example.com/1', 100)
+        first.add(self.stream, 0, 9)
+        second.add(self.stream, 50, 59)
+        self.assertEqual(journal.Journal(self.path).completed(self.stream), 20)
@@ -4,6 +4,9 @@
 convienience, this module shouldn't be run directly, use the runner instead.
 """
 
+import os
+import pathlib
+import tempfile
 import unittest
 from unittest import mock
 
@@ -12,12 +15,60 @@ from paletti import main
 
 class TestMain(unittest.TestCase):
 
-    @mock.patch('builtins.open', create=False)
-    def test_get_plugins_from_repo(self, mock_open):
-        data = b'plugin_one\nplugin_two\n_example_plugin'
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.plugins = pathlib.Path(folder.name) / 'plugins'
+        self.mirror = pathlib.Path(folder.name) / 'mirror'
+        self.plugins.mkdir()
+        mock.patch.object(main, 'PLUGIN_FOLDER', str(self.plugins)).start()
+        self.addCleanup(mock.patch.stopall)
+        for name in ('plugin_one', 'plugin_two'):
+            (self.mirror / name).mkdir(parents=True)
+            for filename in (f'{name}.py', 'test_unittest.py'):
+                (self.mirror / name / filename).write_text(f'# {filename}\n')
+        (self.mirror / 'index.txt').write_text('plugin_one\nplugin_two\n')
 
-        main.urllib3.HTTPSConnectionPool = mock.Mock()
-        main.urllib3.HTTPSConnectionPool.return_value.request.return_value.data = data
+    def test_get_plugins_from_repo(self):
+        written = main.get_plugins_from_repo(self.mirror.as_uri())
+        self.assertEqual(sorted(written),
+                         sorted(str(self.plugins / n / f) for n in ('plugin_one', 'plugin_two')
+                                for f in (f'{n}.py', 'test_unittest.py')))
+        self.assertEqual((self.plugins / 'plugin_two' / 'plugin_two.py').read_text(),
+                         '# plugin_two.py\n')
+        # Nothing has changed, so nothing is written.
+        self.assertEqual(main.get_plugins_from_repo(str(self.mirror)), [])
+        (self.mirror / 'plugin_one' / 'plugin_one.py').write_text('# new\n')
+        self.assertEqual(main.get_plugins_from_repo(str(self.mirror)),
+                         [str(self.plugins / 'plugin_one' / 'plugin_one.py')])
+        self.assertEqual((self.plugins / 'plugin_one' / 'plugin_one.py').read_text(),
+                         '# new\n')
+        # Files which haven't changed are kept, and no temporary folders.
+        self.assertTrue((self.plugins / 'plugin_one' / 'test_unittest.py').exists())
+        self.assertEqual(sorted(os.listdir(self.plugins)),
+                         ['.sync.json', 'plugin_one', 'plugin_two'])
+        self.assertEqual(len(main.get_plugins_from_repo(str(self.mirror), force=True)), 4)
 
-        url = 'https:/github.com/example/example'
-        self.assertIsInstance(main.get_plugins_from_repo(url), list)
\ No newline at end of file
+    def test_get_plugins_from_repo_http(self):
+        def request(method, url, headers):
+            response = mock.Mock(headers={'ETag': '"1"'})
+            path = url.split('/master/plugins/')[1]
+            if headers.get('If-None-Match') == '"1"':
+                response.status = 304
+            elif (self.mirror / path).exists():
+                response.status, response.data = 200, (self.mirror / path).read_bytes()
+            else:
+                response.status = 404
+            return response
+
+        request = mock.patch.object(main.session, 'request', side_effect=request).start()
+        url = 'https://github.com/example/example.git'
+        self.assertEqual(len(main.get_plugins_from_repo(url)), 4)
+        request.assert_any_call(
+            'GET', 'https://raw.githubusercontent.com/example/example/master/plugins/index.txt',
+            headers={})
+        request.reset_mock()
+        self.assertEqual(main.get_plugins_from_repo(url), [])
+        request.assert_any_call(
+            'GET', 'https://raw.githubusercontent.com/example/example/master/plugins/'
+                   'plugin_one/plugin_one.py', headers={'If-None-Match': '"1"'})
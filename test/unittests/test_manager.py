@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+""" Unittests for the `manager` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import os
+import re
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from paletti import downloader, manager
+
+DATA = bytes(range(256)) * 1000
+
+
+def request(method, url, **kwargs):
+    """ Serve `DATA` for the `range=start-end` parameter, or answer 403 for
+    urls of expired streams.
+    """
+    if 'expired' in url:
+        body, status = b'<html>403 Forbidden</html>', 403
+    else:
+        match = re.search(r'range=(\d+)-(\d+)', url)
+        body, status = DATA[int(match[1]):int(match[2]) + 1], 200
+    return mock.Mock(status=status, headers={'Content-Length': str(len(body))},
+                     stream=mock.Mock(return_value=iter([body])))
+
+
+class FakeDownload:
+    """ Mimics the parts of `downloader.Download` used by the manager. Every
+    stream blocks until `release` is set, unless the download is stopped.
+    """
+    def __init__(self, name, log, host='example.com', segments=1):
+        self.name = name
+        self.log = log
+        self.filesize = 200
+        self.progress = 0
+        self.segments = segments
+        self.error = None
+        self.status = 'idle'
+        self.subscribers = []
+        self.streams = [{'url': f'http://{host}/{name}/audio'},
+                        {'url': f'http://{host}/{name}/video'}]
+        self.release = threading.Event()
+
+    def activate(self):
+        self.status = 'active'
+
+    def cancel(self):
+        self.status = 'cancelled'
+
+    def fail(self, error):
+        self.error = error
+        self.status = 'failed'
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def pause(self):
+        self.status = 'paused'
+
+    def download_file(self, stream):
+        self.log.append(stream['url'])
+        while not self.release.wait(0.01):
+            if self.status != 'active':
+                return False
+        self.progress += 100
+        if self.progress == self.filesize:
+            self.status = 'finished'
+            for callback in self.subscribers:
+                callback({'event': 'finished', 'download': self})
+        return True
+
+
+class TestManager(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+
+    def test_priority(self):
+        dm = manager.DownloadManager(workers=1)
+        blocker = FakeDownload('blocker', self.log)
+        dm.add(blocker)
+        while not self.log:
+            pass
+        low = FakeDownload('low', self.log)
+        high = FakeDownload('high', self.log)
+        low.release.set()
+        high.release.set()
+        dm.add(low, priority=0)
+        dm.add(high, priority=5)
+        blocker.release.set()
+        dm.join()
+        dm.shutdown()
+        names = [url.split('/')[3] for url in self.log]
+        self.assertEqual(names, ['blocker', 'high', 'high', 'blocker', 'low', 'low'])
+        self.assertEqual(dm.progress()['progress'], 600)
+        self.assertEqual(dm.progress()['jobs'], {'finished': 3})
+
+    def test_events_and_errors(self):
+        dm = manager.DownloadManager(workers=2)
+        events = []
+        dm.subscribe(events.append)
+        ok = FakeDownload('ok', self.log)
+        ok.release.set()
+        broken = FakeDownload('broken', self.log)
+        broken.download_file = mock.Mock(side_effect=ConnectionError)
+        ok_id = dm.add(ok)
+        broken_id = dm.add(broken)
+        dm.join()
+        dm.shutdown()
+        self.assertEqual(events, [{'event': 'finished', 'download': ok, 'job': ok_id}])
+        self.assertEqual(dm.jobs[broken_id].status, 'failed')
+        self.assertIsInstance(dm.jobs[broken_id].error, ConnectionError)
+
+    def test_host_limit(self):
+        dm = manager.DownloadManager(workers=4, host_limit=2)
+        jobs = [FakeDownload(str(i), self.log) for i in range(3)]
+        for d in jobs:
+            dm.add(d)
+        while len(self.log) < 2:
+            pass
+        # Only two streams for the same host may run at the same time.
+        self.assertEqual(len(self.log), 2)
+        self.assertEqual(dm.progress()['jobs'], {'active': 1, 'queued': 2})
+        for d in jobs:
+            d.release.set()
+        dm.join()
+        dm.shutdown()
+        self.assertEqual(len(self.log), 6)
+
+    def test_pause_resume_cancel(self):
+        dm = manager.DownloadManager(workers=2)
+        first = FakeDownload('first', self.log)
+        second = FakeDownload('second', self.log)
+        first_id = dm.add(first)
+        second_id = dm.add(second)
+        dm.pause(first_id)
+        dm.cancel(second_id)
+        dm.join()
+        self.assertEqual(dm.jobs[first_id].status, 'paused')
+        self.assertEqual(dm.jobs[second_id].status, 'cancelled')
+        first.release.set()
+        dm.resume(first_id)
+        dm.join()
+        dm.shutdown()
+        self.assertEqual(dm.jobs[first_id].status, 'finished')
+
+    def test_download(self):
+        # Run the streams of real downloads on the workers.
+        pool = mock.patch.object(downloader.session, 'get_pool').start()
+        self.addCleanup(mock.patch.stopall)
+        pool.return_value.request.side_effect = request
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        streams = [{'url': 'http://example.com/audio?id=1', 'codec': 'opus',
+                    'type': 'audio', 'container': 'webm'},
+                   {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                    'type': 'video', 'container': 'webm'}]
+        dm = manager.DownloadManager(workers=1)
+        pp = mock.Mock()
+        ok = downloader.Download(streams, os.path.join(folder.name, 'ok'), pp,
+                                 sizes=[len(DATA), len(DATA)])
+        expired = [dict(stream, url=stream['url'] + '&expired=1')
+                   for stream in streams]
+        broken = downloader.Download(expired, os.path.join(folder.name, 'broken'),
+                                     mock.Mock(), sizes=[len(DATA), len(DATA)])
+        ok_id = dm.add(ok)
+        broken_id = dm.add(broken)
+        dm.join()
+        dm.shutdown()
+        self.assertEqual(dm.jobs[ok_id].status, 'finished')
+        pp.assert_called_once_with(ok.output, files=[
+            (ok._filepath(s), s['container'], s['type'], s['codec']) for s in streams])
+        for stream in streams:
+            with open(ok._filepath(stream), 'rb') as f:
+                self.assertEqual(f.read(), DATA)
+        # The second stream of the failed job is never started.
+        self.assertEqual(dm.jobs[broken_id].status, 'failed')
+        self.assertIsInstance(dm.jobs[broken_id].error, ConnectionError)
+        self.assertEqual(pool.return_value.request.call_count, 3)
+        self.assertFalse(os.path.exists(broken._filepath(expired[1])))
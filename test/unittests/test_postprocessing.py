@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+""" Unittests for the `postprocessing` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from paletti import postprocessing
+
+# Stands in for ffmpeg in the mux tests: concatenates the inputs.
+FAKE_FFMPEG = """
+import sys
+with open(sys.argv[-1], 'wb') as out:
+    for path in sys.argv[1:-1]:
+        with open(path, 'rb') as f:
+            out.write(f.read())
+"""
+
+
+def fake_ffmpeg(script=FAKE_FFMPEG, popen=subprocess.Popen):
+    def start(cmd, **kwargs):
+        inputs = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == '-i']
+        return popen([sys.executable, '-c', script, *inputs, cmd[-1]], **kwargs)
+    return mock.patch.object(postprocessing.subprocess, 'Popen', start)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.pipeline = postprocessing.Pipeline(workers=2, queue_size=1)
+        self.addCleanup(self.pipeline.shutdown)
+
+    def test_report(self):
+        steps = {'a': mock.Mock(return_value=0), 'b': mock.Mock(return_value=None)}
+        with mock.patch.dict(postprocessing.STEPS, steps):
+            report = self.pipeline('/tmp/foo', ['/tmp/foo.webm.audio.opus'],
+                                   steps=('a', 'b'), thumbnail='/tmp/foo.jpg')
+        self.assertEqual([(e['step'], e['status']) for e in report],
+                         [('a', 'ok'), ('b', 'skipped')])
+        job = steps['a'].call_args[0][0]
+        self.assertEqual(job['files'], ['/tmp/foo.webm.audio.opus'])
+        self.assertEqual(job['thumbnail'], '/tmp/foo.jpg')
+
+    def test_failed(self):
+        error = subprocess.CalledProcessError(1, ['ffmpeg'])
+        steps = {'a': mock.Mock(side_effect=error), 'b': mock.Mock()}
+        with mock.patch.dict(postprocessing.STEPS, steps):
+            with self.assertRaises(postprocessing.PostprocessingError) as cm:
+                self.pipeline('/tmp/foo', steps=('a', 'b'))
+        self.assertEqual(cm.exception.report[-1]['returncode'], 1)
+        # The chain stops at the failed step.
+        steps['b'].assert_not_called()
+
+    def test_bounded(self):
+        running, release = [], threading.Event()
+
+        def step(job):
+            running.append(job['output'])
+            release.wait(5)
+            return 0
+        with mock.patch.dict(postprocessing.STEPS, {'a': step}):
+            futures = [self.pipeline.submit(str(n), steps=('a',)) for n in range(3)]
+            blocked = threading.Thread(
+                target=lambda: futures.append(self.pipeline.submit('3', steps=('a',))))
+            blocked.start()
+            time.sleep(0.1)
+            # Two jobs run, one waits in the queue and the last submit blocks.
+            self.assertEqual(len(running), 2)
+            self.assertTrue(blocked.is_alive())
+            release.set()
+            blocked.join()
+            [f.result(5) for f in futures]
+        self.assertEqual(sorted(running), ['0', '1', '2', '3'])
+
+
+class TestSteps(unittest.TestCase):
+
+    def test_ffmpeg(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output = os.path.join(folder, 'foo.mkv')
+
+            def run(cmd, **kwargs):
+                with open(cmd[-1], 'w') as f:
+                    f.write('merged')
+                return subprocess.CompletedProcess(cmd, 0)
+            with mock.patch.object(postprocessing.subprocess, 'run', run):
+                self.assertEqual(postprocessing._ffmpeg('-i', 'x', output=output), 0)
+            with open(output) as f:
+                self.assertEqual(f.read(), 'merged')
+            failed = subprocess.CompletedProcess([], 1, stderr=b'error')
+            with mock.patch.object(postprocessing.subprocess, 'run',
+                                   return_value=failed):
+                self.assertRaises(subprocess.CalledProcessError,
+                                  postprocessing._ffmpeg, '-i', 'x', output=output)
+
+    def test_embed_subtitles(self):
+        ffmpeg = mock.patch.object(postprocessing, '_ffmpeg', return_value=0).start()
+        self.addCleanup(mock.patch.stopall)
+        with tempfile.NamedTemporaryFile(suffix='.srt') as subs:
+            self.assertIsNone(postprocessing.embed_subtitles(
+                {'result': '/tmp/foo.ogg', 'subtitles': subs.name}))
+            self.assertEqual(postprocessing.embed_subtitles(
+                {'result': '/tmp/foo.mkv', 'subtitles': subs.name}), 0)
+        self.assertIn('srt', ffmpeg.call_args[0])
+        self.assertIsNone(postprocessing.embed_subtitles({'result': '/tmp/foo.mkv'}))
+
+    def test_merge_muxed(self):
+        # The streams were remuxed while downloading already.
+        job = {'output': '/tmp/foo', 'files': [], 'result': '/tmp/foo.webm'}
+        self.assertIsNone(postprocessing.merge(job))
+        self.assertEqual(job['result'], '/tmp/foo.webm')
+
+
+@unittest.skipUnless(hasattr(os, 'mkfifo'), 'FIFOs are not supported.')
+class TestStreamingMux(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.output = os.path.join(folder.name, 'foo')
+        self.streams = [{'container': 'webm', 'type': 'audio'},
+                        {'container': 'webm', 'type': 'video'}]
+
+    def test_can_mux(self):
+        self.assertTrue(postprocessing.can_mux(self.streams))
+        self.assertFalse(postprocessing.can_mux([None, self.streams[1]]))
+        self.assertFalse(postprocessing.can_mux(
+            [self.streams[0], {'container': 'mp4', 'type': 'video'}]))
+
+    def test_finish(self):
+        with fake_ffmpeg():
+            mux = postprocessing.StreamingMux(self.output, self.streams)
+        # ffmpeg opens the inputs one after another.
+        for index, data in ((0, b'audio'), (1, b'video')):
+            fd = mux.open_input(index)
+            os.write(fd, data)
+            os.close(fd)
+        self.assertEqual(mux.finish(), f'{self.output}.webm')
+        with open(f'{self.output}.webm', 'rb') as f:
+            self.assertEqual(f.read(), b'audiovideo')
+        self.assertFalse(os.path.exists(mux._folder))
+
+    def test_abort(self):
+        with fake_ffmpeg():
+            mux = postprocessing.StreamingMux(self.output, self.streams)
+        fd = mux.open_input(0)
+        self.addCleanup(os.close, fd)
+        mux.abort()
+        # The second input is never opened by the killed process.
+        self.assertIsNone(mux.open_input(1))
+        self.assertFalse(os.path.exists(f'{self.output}.tmp.webm'))
+
+    def test_failed(self):
+        with fake_ffmpeg('exit(1)'):
+            mux = postprocessing.StreamingMux(self.output, self.streams)
+        self.assertRaises(subprocess.CalledProcessError, mux.open_input, 0)
+        self.assertRaises(subprocess.CalledProcessError, mux.finish)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+""" Unittests for the `proxy` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import os
+import re
+import tempfile
+import threading
+import unittest
+import urllib.request
+from unittest import mock
+
+from paletti import downloader, proxy
+
+DATA = bytes(range(256)) * 400
+
+
+def request(method, url, **kwargs):
+    response = mock.Mock(status=200)
+    match = re.search(r'range=(\d+)-(\d+)', url)
+    body = DATA[int(match[1]):int(match[2]) + 1]
+    response.headers = {'Content-Length': str(len(body))}
+    response.stream.side_effect = lambda n: (body[i:i + n]
+                                             for i in range(0, len(body), n))
+    return response
+
+
+class TestProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.output = os.path.join(folder.name, 'foo')
+        self.stream = {'url': 'http://example.com/video?id=1', 'codec': 'vp9',
+                       'type': 'video', 'container': 'webm'}
+        self.pool = mock.patch.object(proxy.session, 'get_pool').start()
+        self.pool.return_value.request.side_effect = request
+        self.proxy = proxy.StreamProxy(read_ahead=20_000)
+        self.addCleanup(self.proxy.shutdown)
+
+    def get(self, url, start=None, end=None):
+        headers = {'Range': f'bytes={start}-{end}'} if start is not None else {}
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as r:
+            return r.status, r.read()
+
+    def test_parse_range(self):
+        self.assertEqual(proxy.parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(proxy.parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(proxy.parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(proxy.parse_range('bytes=900-2000', 1000), (900, 999))
+        self.assertIsNone(proxy.parse_range('bytes=1000-', 1000))
+        self.assertIsNone(proxy.parse_range('items=0-1', 1000))
+
+    def test_ranges(self):
+        url = self.proxy.add(self.stream, self.output, size=len(DATA))
+        self.assertEqual(self.get(url, 50_000, 50_099), (206, DATA[50_000:50_100]))
+        # The read-ahead is cached, so this doesn't hit the server again.
+        self.assertEqual(self.get(url, 50_100, 60_000), (206, DATA[50_100:60_001]))
+        self.assertEqual(self.pool.return_value.request.call_count, 1)
+        self.assertEqual(self.get(url), (200, DATA))
+
+    def test_sparse(self):
+        # Nothing is reserved for the parts which weren't played.
+        self.proxy.add(self.stream, self.output, size=len(DATA))
+        filepath = downloader.stream_path(self.output, self.stream)
+        self.assertEqual(os.path.getsize(filepath), len(DATA))
+        if hasattr(os.stat(filepath), 'st_blocks'):
+            self.assertLess(os.stat(filepath).st_blocks * 512, len(DATA))
+
+    def test_slow_reader(self):
+        # A player which stops reading doesn't hold up the requests for
+        # other ranges of the stream.
+        self.proxy.add(self.stream, self.output, size=len(DATA))
+        cached, = self.proxy._server.streams.values()
+        first = cached.read(0, 19_999)
+        next(first)
+        result = []
+        t = threading.Thread(target=lambda: result.append(
+            b''.join(cached.read(60_000, 60_099))), daemon=True)
+        t.start()
+        t.join(5)
+        first.close()
+        self.assertEqual(result, [DATA[60_000:60_100]])
+
+    def test_error_status(self):
+        self.pool.return_value.request.side_effect = lambda *args, **kwargs: \
+            mock.Mock(status=403, headers={'Content-Length': '9'})
+        self.proxy.add(self.stream, self.output, size=len(DATA))
+        cached, = self.proxy._server.streams.values()
+        self.assertRaises(ConnectionError, lambda: list(cached.read(0, 99)))
+        self.assertEqual(cached.journal.completed(cached.filepath), 0)
+
+    def test_download(self):
+        # A download after the stream was played to the end needs no network.
+        url = self.proxy.add(self.stream, self.output, size=len(DATA))
+        self.get(url)
+        requests = self.pool.return_value.request.call_count
+        probe = mock.patch.object(downloader, 'probe_size').start()
+        pp = mock.Mock()
+        dl = downloader.Download([None, self.stream], self.output, pp)
+        dl.start()
+        [t.join() for t in dl.threads]
+        self.assertEqual(dl.status, 'finished')
+        probe.assert_not_called()
+        self.assertEqual(self.pool.return_value.request.call_count, requests)
+        with open(downloader.stream_path(self.output, self.stream), 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+
+    def test_play_after_download(self):
+        # A finished download removes the stream files and the journal, but
+        # the player keeps playing from the cache.
+        url = self.proxy.add(self.stream, self.output, size=len(DATA))
+        self.get(url, 0, 99)
+        pp = mock.Mock(side_effect=lambda output, files: [os.remove(f) for f, *_ in files])
+        dl = downloader.Download([None, self.stream], self.output, pp)
+        dl.start()
+        [t.join() for t in dl.threads]
+        self.assertEqual(dl.status, 'finished')
+        self.assertEqual(self.get(url, 50_000, 50_099), (206, DATA[50_000:50_100]))
+        self.assertEqual(self.get(url), (200, DATA))
+        self.assertFalse(os.path.exists(f'{self.output}.journal'))
+
+    def test_evict(self):
+        # Streams which aren't read anymore are closed on the next `add`,
+        # and sizes are probed without blocking the proxy.
+        self.proxy.add(self.stream, self.output, size=len(DATA))
+        cached, = self.proxy._server.streams.values()
+        cached.used -= self.proxy.idle_timeout + 1
+        locked = []
+        probe = mock.patch.object(proxy, 'probe_size').start()
+        probe.side_effect = lambda url: locked.append(self.proxy._lock.locked()) \
+            or len(DATA)
+        other = dict(self.stream, codec='opus', type='audio')
+        self.proxy.add(other, self.output)
+        probe.assert_called_once_with(other['url'])
+        self.assertEqual(locked, [False])
+        self.assertNotIn(cached, self.proxy._server.streams.values())
+        self.assertEqual(len(self.proxy._server.streams), 1)
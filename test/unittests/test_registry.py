@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+""" Unittests for the `registry` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from paletti import registry
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin_list = [{'name': 'one', 'module': 'mod_one', 'type': 'video',
+                             'hosts': ['example.com', 'www.example.net']},
+                            {'name': 'two', 'module': 'mod_two', 'type': 'audio',
+                             'hosts': ['*.example.org']}]
+        self.find_modules = mock.patch.object(
+            registry.utils, 'find_modules', return_value=self.plugin_list).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_find(self):
+        plugins = registry.PluginRegistry()
+        find = lambda x: plugins.find(x)['name']
+        self.assertEqual(find('one'), 'one')
+        self.assertEqual(find('http://example.com/watch?v=1'), 'one')
+        self.assertEqual(find('https://www.example.com/watch?v=1'), 'one')
+        self.assertEqual(find('https://m.EXAMPLE.com/watch?v=1'), 'one')
+        self.assertEqual(find('https://example.net/1'), 'one')
+        self.assertEqual(find('https://cdn.eu.example.org/1'), 'two')
+        self.assertRaises(ModuleNotFoundError, lambda: find('https://example.org/1'))
+        self.assertRaises(ModuleNotFoundError, lambda: find('three'))
+        self.assertRaises(ModuleNotFoundError, lambda: find('search query'))
+        # The plugins are only searched once.
+        self.find_modules.assert_called_once_with('plugins')
+
+    def test_add_remove(self):
+        plugins = registry.PluginRegistry()
+        plugins.add({'name': 'three', 'module': 'mod_three', 'type': 'video',
+                     'hosts': ['example.org']})
+        self.assertEqual(plugins.find('http://example.org/1')['name'], 'three')
+        self.assertEqual(len(plugins), 3)
+        plugins.remove('one')
+        self.assertNotIn('one', plugins)
+        self.assertRaises(ModuleNotFoundError, lambda: plugins.find('http://example.com/1'))
+        self.plugin_list.pop()
+        plugins.refresh()
+        self.assertEqual([p['name'] for p in plugins], ['one'])
+
+    def test_refresh(self):
+        plugins = registry.PluginRegistry()
+        one = plugins.find('one')
+        self.plugin_list[0] = dict(self.plugin_list[0], version='2')
+        self.plugin_list.append({'name': 'three', 'module': 'mod_three',
+                                 'type': 'video', 'hosts': []})
+        self.assertEqual(plugins.refresh(), {'one', 'three'})
+        self.assertIsNot(plugins.find('one'), one)
+        self.assertEqual(plugins.refresh(), set())
+
+    def test_reload(self):
+        # Change a plugin on disk, the registry swaps it in while the old
+        # module stays usable.
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        mock.patch.stopall()
+        mock.patch.object(registry.utils, 'PLUGIN_FOLDER', folder.name).start()
+        os.mkdir(os.path.join(folder.name, 'foo'))
+        path = os.path.join(folder.name, 'foo', 'foo.py')
+        with open(path, 'w') as f:
+            f.write('HOSTS = ["example.com"]\nSTREAM_TYPE = "video"\nVERSION = 1\n')
+        plugins = registry.PluginRegistry()
+        old = plugins.find('http://example.com/1')['module']
+        self.assertEqual(old.__name__, 'plugins.foo.foo')
+        with open(path, 'w') as f:
+            f.write('HOSTS = ["example.com"]\nSTREAM_TYPE = "video"\nVERSION = 2\n')
+        os.utime(path, ns=(0, 0))
+        plugins.watch(interval=0.01)
+        self.addCleanup(plugins.unwatch)
+        for _ in range(500):
+            if plugins.find('foo')['version'].startswith('0-'):
+                break
+            time.sleep(0.01)
+        new = plugins.find('http://example.com/1')['module']
+        self.assertEqual((old.VERSION, new.VERSION), (1, 2))
+        self.assertNotEqual(old.__plugin_version__, new.__plugin_version__)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+""" Unittests for the `selection` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import unittest
+
+from paletti import selection
+
+STREAMS = [{'id': 1, 'type': 'video', 'container': 'webm', 'codec': 'vp9',
+            'quality': '1080p', 'quality_int': '1080', 'bitrate': 4000},
+           {'id': 2, 'type': 'video', 'container': 'webm', 'codec': 'vp9',
+            'quality': '720p', 'quality_int': '720', 'bitrate': 2000},
+           {'id': 3, 'type': 'video', 'container': 'webm', 'codec': 'av1',
+            'quality': '720p', 'quality_int': 720, 'bitrate': 1500},
+           {'id': 4, 'type': 'video', 'container': 'webm', 'codec': 'vp9',
+            'quality': '360p', 'quality_int': '360', 'bitrate': 500},
+           {'id': 5, 'type': 'video', 'container': 'webm', 'codec': 'vp9',
+            'quality': '2160p', 'quality_int': '2160', 'bitrate': 12000},
+           {'id': 6, 'type': 'audio', 'container': 'webm', 'codec': 'opus',
+            'quality': 'medium', 'quality_int': None, 'bitrate': 128},
+           {'id': 7, 'type': 'audio+video', 'container': 'mp4', 'codec': 'avc1',
+            'quality': '720p', 'quality_int': '720'}]
+
+
+class TestSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.index = selection.StreamIndex(STREAMS)
+
+    def select(self, *args, **kwargs):
+        stream = self.index.select(*args, **kwargs)
+        return stream and stream['id']
+
+    def test_quality_value(self):
+        self.assertEqual(selection.quality_value({'quality_int': '1080'}), 1080)
+        self.assertEqual(selection.quality_value({'quality': '720p60'}), 720)
+        self.assertEqual(selection.quality_value({'quality': 'medium'}), 0)
+
+    def test_parse_quality(self):
+        self.assertEqual(selection.parse_quality('best'), ('best', 0))
+        self.assertEqual(selection.parse_quality('720p'), ('==', 720))
+        self.assertEqual(selection.parse_quality('<=720p'), ('<=', 720))
+        self.assertEqual(selection.parse_quality(480), ('<=', 480))
+        self.assertEqual(selection.parse_quality('medium'), ('==', None))
+
+    def test_select(self):
+        # The qualities are compared as numbers, not as strings.
+        self.assertEqual(self.select('video'), 5)
+        self.assertEqual(self.select('video', '720p'), 2)
+        self.assertEqual(self.select('video', '480p'), 5)
+        self.assertEqual(self.select('video', '<=1080p'), 1)
+        self.assertEqual(self.select('video', '<=480p'), 4)
+        self.assertEqual(self.select('video', '<=240p'), 4)
+        self.assertEqual(self.select('audio', 'medium'), 6)
+        self.assertEqual(self.select('audio', container='mp4'), None)
+        # Other containers are only used for video.
+        self.assertEqual(self.select('video', container='mp4'), 7)
+
+    def test_select_codecs_bitrate(self):
+        self.assertEqual(self.select('video', '720p', codecs=['av1', 'vp9']), 3)
+        self.assertEqual(self.select('video', codecs=['av1']), 3)
+        self.assertEqual(self.select('video', codecs=['h265']), 5)
+        self.assertEqual(self.select('video', max_bitrate=2500), 2)
+        # Above every bitrate, the lowest one is used.
+        self.assertEqual(self.select('video', max_bitrate=100), 4)
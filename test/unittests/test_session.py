@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+""" Unittests for the `session` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import unittest
+
+from paletti import session
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        defaults = dict(session._config)
+        self.addCleanup(lambda: session.configure(**defaults))
+
+    def test_configure(self):
+        self.assertRaises(TypeError, lambda: session.configure(foo=1))
+        session.configure(maxsize=3, host_maxsize={'example.com': 7})
+        shared = session.get_pool('http://example.org/foo')
+        own = session.get_pool('http://example.com/foo')
+        self.assertIs(shared, session.get_pool())
+        self.assertIsNot(shared, own)
+        self.assertEqual(own.connection_pool_kw['maxsize'], 7)
+        self.assertEqual(shared.connection_pool_kw['maxsize'], 3)
+        self.assertEqual(session.settings()['maxsize'], 3)
+
+    def test_proxy(self):
+        session.configure(proxy='http://localhost:3128')
+        self.assertEqual(session.get_pool().proxy.host, 'localhost')
+
+    def test_stats(self):
+        pool = session.get_pool()
+        pool.connection_from_url('http://example.com/foo')
+        stats = session.stats()
+        self.assertEqual(stats['http://example.com:80'],
+                         {'connections': 0, 'requests': 0, 'idle': 0})
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+""" Unittests for the `throttle` module. To avoid path problems and for
+convienience, this module shouldn't be run directly, use the runner instead.
+"""
+
+import unittest
+from unittest import mock
+
+from paletti import throttle
+
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.time = mock.Mock(monotonic=lambda: self.now)
+        mock.patch.object(throttle, 'time', self.time).start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(throttle._hosts.clear)
+        self.addCleanup(throttle.limit, None)
+
+    def test_unlimited(self):
+        bucket = throttle.TokenBucket()
+        self.assertEqual(bucket.reserve(10 ** 9), 0)
+        self.assertEqual(throttle.delay('example.com', 10 ** 9), 0)
+
+    def test_reserve(self):
+        bucket = throttle.TokenBucket(1000)
+        # The bucket starts empty, so every reservation has to wait for the
+        # ones before it.
+        self.assertEqual(bucket.reserve(500), 0.5)
+        self.assertEqual(bucket.reserve(500), 1.0)
+        self.now += 3
+        # Idle time refills the bucket only up to the burst size.
+        self.assertEqual(bucket.reserve(1000), 0)
+        self.assertEqual(bucket.reserve(250), 0.25)
+
+    def test_set_rate(self):
+        bucket = throttle.TokenBucket(1000)
+        bucket.set_rate(2000, burst=4000)
+        self.now += 3
+        self.assertEqual(bucket.reserve(4000), 0)
+        bucket.set_rate(None)
+        self.assertEqual(bucket.reserve(4000), 0)
+
+    def test_limit_host(self):
+        throttle.limit(1000)
+        throttle.limit(100, host='example.com')
+        self.assertEqual(throttle.delay('example.org', 100), 0.1)
+        # The slower of both limits counts.
+        self.assertEqual(throttle.delay('example.com', 100), 1.0)
+        throttle.limit(None, host='example.com')
+        self.assertNotIn('example.com', throttle._hosts)
+
+    def test_throttle(self):
+        throttle.throttle('example.com', 100)
+        self.time.sleep.assert_not_called()
+        throttle.limit(1000)
+        throttle.throttle('example.com', 100)
+        self.time.sleep.assert_called_once_with(0.1)
@@ -4,26 +4,96 @@
 convienience, this module shouldn't be run directly, use the runner instead.
 """
 
+import os
+import sys
+import tempfile
 import unittest
 from unittest import mock
 
 from paletti import utils
 
 
+PLUGIN = '''
+import sys
+
+HOSTS = ['example.com']
+STREAM_TYPE = 'audio+video'
+sys.imported_plugins = getattr(sys, 'imported_plugins', 0) + 1
+'''
+
+
 class TestUtils(unittest.TestCase):
 
+    def test_find_modules(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        mock.patch.object(utils, 'PLUGIN_FOLDER', folder.name).start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(lambda: vars(sys).pop('imported_plugins', None))
+        os.mkdir(os.path.join(folder.name, 'foo'))
+        path = os.path.join(folder.name, 'foo', 'foo.py')
+        with open(path, 'w') as f:
+            f.write(PLUGIN)
+
+        plugin, = utils.find_modules('plugins')
+        self.assertEqual((plugin['name'], plugin['hosts'], plugin['type']),
+                         ('foo', ['example.com'], 'audio+video'))
+        # The plugin is only imported on first use.
+        self.assertFalse(hasattr(sys, 'imported_plugins'))
+        self.assertEqual(plugin['module'].HOSTS, ['example.com'])
+        self.assertEqual(plugin['module'].HOSTS, ['example.com'])
+        self.assertEqual(sys.imported_plugins, 1)
+
+        # The manifest is cached until the plugin changes.
+        self.assertTrue(os.path.exists(os.path.join(folder.name, utils.MANIFEST_NAME)))
+        with mock.patch.object(utils, 'read_manifest') as read_manifest:
+            utils.find_modules('plugins')
+            read_manifest.assert_not_called()
+        with open(path, 'w') as f:
+            f.write(PLUGIN.replace('example.com', 'example.org'))
+        os.utime(path, ns=(0, 0))
+        plugin, = utils.find_modules('plugins')
+        self.assertEqual(plugin['hosts'], ['example.org'])
+
+        # The folder which a plugin import has put on sys.path meanwhile
+        # stays there.
+        folder = os.path.dirname(path)
+        sys.path.insert(0, folder)
+        self.addCleanup(sys.path.remove, folder)
+        utils.find_modules('plugins')
+        self.assertIn(folder, sys.path)
+
+    def test_read_manifest(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.py') as f:
+            f.write('HOSTS = ["a.com"] + ["b.com"]\nSTREAM_TYPE = "video"\n')
+            f.flush()
+            # The hosts aren't a literal, so the plugin is imported.
+            self.assertEqual(utils.read_manifest(f.name),
+                             {'hosts': ['a.com', 'b.com'], 'type': 'video'})
+
     def test_make_filename(self):
         self.assertEqual(utils.make_filename('aw iw))(""23+*.,!!'), 'aw_iw_23_')
 
     def test_merge_files(self):
         mock_listdir = ['foo.webm.video.vp9', 'bar.mp4.audio.aac',
                         'bar.mp4.video.ac1', 'baz.webm.audio.opus',
-                        'otherfile.txt', 'something.log.2.old']
-        utils.os.listdir = mock.Mock(return_value=mock_listdir)
-        utils.os.rename = mock.Mock()
-        utils.os.remove = mock.Mock()
-        utils.subprocess.call = mock.Mock()
+                        'otherfile.txt', 'something.log.2.old',
+                        'quux.mp4.audio.mp4a.40.2', 'quux.mp4.video.avc1.4d401f']
+        mock.patch.object(utils.os, 'listdir', return_value=mock_listdir).start()
+        mock.patch.object(utils.os, 'rename').start()
+        mock.patch.object(utils.os, 'remove').start()
+        call = mock.patch.object(utils.subprocess, 'call', return_value=0).start()
+        self.addCleanup(mock.patch.stopall)
         self.assertEqual(utils.merge_files('foo'), 'foo.vp9')
         self.assertEqual(utils.merge_files('bar'), 'bar.mp4')
         self.assertEqual(utils.merge_files('baz'), 'baz.opus')
+        # Codecs may contain dots.
+        self.assertEqual(utils.merge_files('quux'), 'quux.mp4')
+        self.assertEqual(call.call_args[0][0][3:6:2],
+                         ['quux.mp4.audio.mp4a.40.2', 'quux.mp4.video.avc1.4d401f'])
+        self.assertEqual(utils.merge_files('qux', files=[
+            ('/tmp/qux.webm.audio.opus', 'webm', 'audio', 'opus')]), 'qux.opus')
+        call.return_value = 1
+        self.assertRaises(utils.subprocess.CalledProcessError,
+                          lambda: utils.merge_files('bar'))
 
@@ -5,6 +5,10 @@ convienience, this module shouldn't be run directly, use the runner instead.
 """
 
 import importlib
+import tempfile
+import threading
+import time
+import types
 import unittest
 from collections import namedtuple
 from unittest import mock
@@ -63,6 +67,162 @@ class TestWebAPI(unittest.TestCase):
             return {'url': testitem}
         self.assertIsInstance(f('foo', 'http://example.com/213'), dict)
         self.assertIsInstance(f('foo', 'http://example.com/123'), dict)
+        f('foo', 'http://example.com/123')
+        self.assertEqual(f.cache.stats()['hits'], 1)
+
+    def test_cache_options(self):
+        calls = []
+
+        @web_api.cache(maxsize=1, ttl=lambda item: item['ttl'])
+        def f(plugin, testitem):
+            calls.append(testitem)
+            return {'url': testitem, 'ttl': 0 if testitem == 'old' else 60}
+        f('foo', 'old')
+        f('foo', 'old')
+        f('foo', 'new')
+        f('foo', 'new')
+        self.assertEqual(calls, ['old', 'old', 'new'])
+
+    def test_cache_concurrent(self):
+        calls = []
+        release = threading.Event()
+
+        @web_api.cache
+        def f(plugin, testitem):
+            calls.append(testitem)
+            release.wait(5)
+            return {'url': testitem}
+        threads = [threading.Thread(target=f, args=('foo', 'http://example.com/1'))
+                   for _ in range(4)]
+        [t.start() for t in threads]
+        time.sleep(0.1)
+        release.set()
+        [t.join() for t in threads]
+        self.assertEqual(calls, ['http://example.com/1'])
+
+    def test_streams(self):
+        streams = [{'type': 'video', 'container': 'webm', 'quality': '1080p',
+                    'quality_int': '1080', 'url': 'http://example.com/v1080'},
+                   {'type': 'video', 'container': 'webm', 'quality': '720p',
+                    'quality_int': '720', 'url': 'http://example.com/v720'},
+                   {'type': 'audio', 'container': 'webm', 'quality': 'medium',
+                    'quality_int': '160', 'bitrate': 160, 'url': 'http://example.com/a'},
+                   {'type': 'audio', 'container': 'webm', 'quality': 'low',
+                    'quality_int': '64', 'bitrate': 64, 'url': 'http://example.com/a64'}]
+        mock.patch.object(web_api, 'metadata', return_value={'streams': streams}).start()
+        index = mock.patch.object(web_api.selection, 'StreamIndex',
+                                  wraps=web_api.selection.StreamIndex).start()
+        url = 'http://example.com/123'
+        self.assertEqual(web_api.streams(url), [streams[2], streams[0]])
+        # The quality limits only the video.
+        self.assertEqual(web_api.streams(url, quality='<=720p'), [streams[2], streams[1]])
+        self.assertEqual(web_api.streams(url, quality='<=144p'), [streams[2], streams[1]])
+        # The index is built once and cached.
+        index.assert_called_once_with(streams)
+
+    def test_cache_key(self):
+        old, new = types.ModuleType('plugins.foo.foo'), types.ModuleType('plugins.foo.foo')
+        old.__plugin_version__, new.__plugin_version__ = '1-100', '2-100'
+        # A reloaded plugin doesn't get the results of its old version.
+        self.assertNotEqual(web_api._cache_key(len, (old, 'http://example.com/1'), {}),
+                            web_api._cache_key(len, (new, 'http://example.com/1'), {}))
+
+    def test_cache_persistent(self):
+        calls = []
+
+        def f(plugin, testitem):
+            calls.append(testitem)
+            return {'url': testitem}
+        with tempfile.TemporaryDirectory() as folder:
+            web_api.configure_cache(folder)
+            self.addCleanup(web_api.configure_cache, None)
+            web_api.cache(f)('foo', 'http://example.com/1')
+            # A new in-memory cache, like in a restarted process.
+            result = web_api.cache(f)('foo', 'http://example.com/1')
+        self.assertEqual(result, {'url': 'http://example.com/1'})
+        self.assertEqual(calls, ['http://example.com/1'])
+
+    def test_metadata_many(self):
+        def get_metadata(url):
+            if url.endswith('bad'):
+                raise ConnectionError
+            return {'url': url}
+        single = types.SimpleNamespace(get_metadata=get_metadata)
+        bulk = types.SimpleNamespace(
+            get_metadata=mock.Mock(),
+            get_metadata_many=mock.Mock(side_effect=lambda urls: {
+                u: {'url': u} for u in urls if not u.endswith('missing')}))
+        mock.patch.object(web_api.utils, 'find_modules', return_value=[
+            {'name': 'single', 'module': single, 'hosts': ['example.com']},
+            {'name': 'bulk', 'module': bulk, 'hosts': ['example.org']}]).start()
+        importlib.reload(web_api)
+        web_api.metadata('http://example.com/cached')
+        urls = ['http://example.com/cached', 'http://example.com/1',
+                'http://example.com/bad', 'http://example.org/1',
+                'http://example.org/2', 'http://example.org/missing',
+                'http://example.net/1', 'http://example.com/1']
+        results = {url: (item, error) for url, item, error
+                   in web_api.metadata_many(urls, max_workers=2)}
+        self.assertEqual(set(results), set(urls))
+        self.assertEqual(results['http://example.com/cached'],
+                         ({'url': 'http://example.com/cached'}, None))
+        self.assertEqual(results['http://example.org/2'],
+                         ({'url': 'http://example.org/2'}, None))
+        self.assertIsInstance(results['http://example.com/bad'][1], ConnectionError)
+        self.assertIsInstance(results['http://example.org/missing'][1], KeyError)
+        self.assertIsInstance(results['http://example.net/1'][1], ModuleNotFoundError)
+        bulk.get_metadata_many.assert_called_once_with(
+            ['http://example.org/1', 'http://example.org/2',
+             'http://example.org/missing'])
+        bulk.get_metadata.assert_not_called()
+        # The results of the bulk hook are cached as well.
+        self.assertEqual(web_api.metadata('http://example.org/1'),
+                         {'url': 'http://example.org/1'})
+        bulk.get_metadata.assert_not_called()
+
+    def test_search_iter(self):
+        fetched = []
+
+        def search_pages(query, results):
+            for n in range(100):
+                fetched.append(n)
+                yield [{'title': f'{query} {n}.{i}'} for i in range(3)]
+        paged = types.SimpleNamespace(search_pages=search_pages,
+                                      parse_userinput=lambda q: 'search_query')
+        plain = types.SimpleNamespace(
+            search=mock.Mock(return_value=[{'title': 'a'}, {'title': 'b'}]),
+            parse_userinput=lambda q: 'search_query')
+        mock.patch.object(web_api.utils, 'find_modules', return_value=[
+            {'name': 'paged', 'module': paged, 'hosts': []},
+            {'name': 'plain', 'module': plain, 'hosts': []}]).start()
+        importlib.reload(web_api)
+
+        items = web_api.search_iter('paged', 'foo', results=4, prefetch=2)
+        self.assertEqual(next(items), {'title': 'foo 0.0'})
+        # The following pages are fetched in the background meanwhile.
+        for _ in range(500):
+            if len(fetched) >= 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual([item['title'] for item in items],
+                         ['foo 0.1', 'foo 0.2', 'foo 1.0'])
+        # The fetching stops soon after the iteration.
+        time.sleep(0.3)
+        self.assertLessEqual(len(fetched), 5)
+
+        self.assertEqual(list(web_api.search_iter('plain', 'foo')),
+                         [{'title': 'a'}, {'title': 'b'}])
+        plain.search.assert_called_once_with('foo', results=0)
+
+    def test_metadata_ttl(self):
+        now = web_api.time.time()
+        item = {'streams': [{'url': f'http://example.com/1?expire={int(now) + 3600}'},
+                            {'url': f'http://example.com/2?expire={int(now) + 1200}'}]}
+        self.assertAlmostEqual(web_api._metadata_ttl(item),
+                               1200 - web_api.STREAM_EXPIRY_MARGIN, delta=2)
+        self.assertEqual(web_api._metadata_ttl({'streams': [{'url': 'http://x/'}]}),
+                         web_api.STREAMS_TTL)
+        self.assertEqual(web_api._metadata_ttl({'title': 'foo'}), web_api.METADATA_TTL)
 
     def test_channel(self):
         url = 'http://example.com/123'
@@ -87,16 +247,34 @@ class TestWebAPI(unittest.TestCase):
         self.assertIsInstance(f('http://example.com/123'), dict)
         self.assertRaises(ModuleNotFoundError, lambda: f('no_plugin', '-'))
 
+    def test_play(self):
+        streams = [{'url': 'http://example.com/a'}, {'url': 'http://example.com/v'}]
+        mock.patch.object(web_api, 'streams', return_value=streams).start()
+        mock.patch.object(web_api, 'metadata', return_value={'title': 'mock'}).start()
+        server = mock.patch.object(web_api.proxy, 'get_proxy').start().return_value
+        server.add.side_effect = lambda stream, output: stream['url'][-1]
+        popen = mock.patch.object(web_api.subprocess, 'Popen').start()
+        web_api.play('http://example.com/123', '/tmp')
+        # mpv gets the streams through the caching proxy.
+        popen.assert_called_once_with(['mpv', 'v', '--audio-file=a'])
+        server.add.assert_any_call(streams[0], web_api.os.path.join(
+            '/tmp', web_api.utils.make_filename('mock')))
+
     def test_search(self):
         result = web_api.search('cool_plugin', 'How to shave a ferret')
         self.assertIsNotNone(result)
 
+    def test_limit_bandwidth(self):
+        limit = mock.patch.object(web_api.throttle, 'limit').start()
+        web_api.limit_bandwidth(1000, host='example.com')
+        limit.assert_called_once_with(1000, 'example.com')
+
     @mock.patch('builtins.open', create=False)
     def test_thumbnail(self, mock_open):
         md = {'id': '12345', 'thumbnail_small': 'http://example.com/thumb.jpg'}
         web_api.metadata = mock.Mock(return_value=md)
-        web_api.urllib3.PoolManager = mock.Mock()
-        web_api.urllib3.PoolManager.return_value.request.return_value.data = b'12345'
+        request = mock.patch.object(web_api.session, 'request').start()
+        request.return_value.data = b'12345'
 
         with mock.patch('web_api.open', mock.mock_open()):
             self.assertEqual(web_api.thumbnail('http://example.com/123'), '/tmp/12345.jpg')